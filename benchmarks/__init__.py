@@ -0,0 +1 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
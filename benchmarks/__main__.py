@@ -0,0 +1,8 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
+
+# python -m benchmarks runs the per-command benchmarks, see
+# benchmarks/commands.py for the options.
+
+from benchmarks import commands
+
+commands.main()
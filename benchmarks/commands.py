@@ -0,0 +1,249 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
+
+"""
+Measures throughput and latency of single M commands.
+
+Each benchmark sends one command at a time, as an application would, and
+records how long every round trip took. It stops after number commands or
+once seconds have passed, whichever comes first. Results are printed as a
+table and can be written as JSON to compare runs across commits:
+
+    python -m benchmarks --output before.json
+    python -m benchmarks --value-size 16,4096 --width 10,1000 --latency 0.0005
+
+Unless --server host:port is given, the benchmarks run against an
+in-process mwire_server.MWireServer.
+"""
+
+import json
+import optparse
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import mwire
+import mwire_server
+
+NODE = 'mwirebench'
+
+COMMANDS = ['get', 'set', 'increment', 'next', 'getsubtree']
+
+class Result(object):
+    """
+    The latencies of one benchmark, in seconds.
+    """
+
+    def __init__(self, command, value_size=None, width=None):
+        self.command = command
+        self.value_size = value_size
+        self.width = width
+        self.latencies = []
+        self.seconds = 0.0
+
+    @property
+    def ops_per_sec(self):
+        if not self.seconds:
+            return 0.0
+        return len(self.latencies) / self.seconds
+
+    def percentile(self, percent):
+        """
+        Returns the latency below which percent of the commands completed,
+        by the nearest rank method.
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        rank = int(-(-percent * len(ordered) // 100))
+        return ordered[max(rank, 1) - 1]
+
+    def as_dict(self):
+        return {
+            'command': self.command,
+            'value_size': self.value_size,
+            'width': self.width,
+            'ops': len(self.latencies),
+            'seconds': self.seconds,
+            'ops_per_sec': self.ops_per_sec,
+            'p50_us': _microseconds(self.percentile(50)),
+            'p99_us': _microseconds(self.percentile(99)),
+            'p999_us': _microseconds(self.percentile(99.9)),
+        }
+
+def _microseconds(seconds):
+    if seconds is None:
+        return None
+    return round(seconds * 1e6, 1)
+
+def measure(result, operation, number, seconds):
+    """
+    Calls operation(i) for i in 0..number-1, stopping early once seconds
+    have passed, and records each call's latency in result.
+    """
+    timer = timeit.default_timer
+    latencies = result.latencies
+    started = timer()
+    deadline = started + seconds
+    for i in range(number):
+        before = timer()
+        operation(i)
+        after = timer()
+        latencies.append(after - before)
+        if after > deadline:
+            break
+    result.seconds = timer() - started
+    return result
+
+def _populate(m, subscripts, count, value):
+    # Loaded with a pipeline so setting up costs a few round trips
+    m.mset(NODE, subscripts, (([i], value) for i in range(count)))
+
+def bench_get(m, options, value_size):
+    value = 'x' * value_size
+    keys = min(options.number, 1000)
+    _populate(m, ['get', value_size], keys, value)
+    return measure(Result('get', value_size=value_size),
+                   lambda i: m.get(NODE, ['get', value_size, i % keys]),
+                   options.number, options.seconds)
+
+def bench_set(m, options, value_size):
+    value = 'x' * value_size
+    return measure(Result('set', value_size=value_size),
+                   lambda i: m.set(NODE, ['set', value_size, i % 1000], value),
+                   options.number, options.seconds)
+
+def bench_increment(m, options):
+    return measure(Result('increment'),
+                   lambda i: m.increment(NODE, ['increment', i % 16]),
+                   options.number, options.seconds)
+
+def bench_next(m, options):
+    keys = min(options.number, 1000)
+    _populate(m, ['next'], keys, '1')
+    # Walks the level and starts over from "" at the end
+    state = {'key': ''}
+    def operation(i):
+        key = m.next(NODE, ['next', state['key']])
+        state['key'] = '' if key is None else key
+    return measure(Result('next'), operation, options.number, options.seconds)
+
+def bench_getsubtree(m, options, value_size, width):
+    _populate(m, ['getsubtree', value_size, width], width, 'x' * value_size)
+    return measure(Result('getsubtree', value_size=value_size, width=width),
+                   lambda i: m.getsubtree(NODE, ['getsubtree', value_size, width]),
+                   options.number, options.seconds)
+
+def run(m, options):
+    """
+    Runs the selected benchmarks and returns their Results.
+    """
+    results = []
+    def add(result):
+        results.append(result)
+        report(result)
+    m.kill(NODE, [])
+    try:
+        for command in options.commands:
+            if command == 'get':
+                for size in options.value_sizes:
+                    add(bench_get(m, options, size))
+            elif command == 'set':
+                for size in options.value_sizes:
+                    add(bench_set(m, options, size))
+            elif command == 'increment':
+                add(bench_increment(m, options))
+            elif command == 'next':
+                add(bench_next(m, options))
+            elif command == 'getsubtree':
+                for size in options.value_sizes:
+                    for width in options.widths:
+                        add(bench_getsubtree(m, options, size, width))
+    finally:
+        m.kill(NODE, [])
+    return results
+
+def report(result):
+    data = result.as_dict()
+    print('%-12s %8s %8s %8d %12.0f %10.1f %10.1f %10.1f' % (
+        data['command'],
+        '-' if data['value_size'] is None else data['value_size'],
+        '-' if data['width'] is None else data['width'],
+        data['ops'], data['ops_per_sec'],
+        data['p50_us'], data['p99_us'], data['p999_us']))
+    sys.stdout.flush()
+
+def _revision():
+    # The commit being measured, when run from a git checkout
+    try:
+        output = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return None
+    return output.decode('ascii').strip() or None
+
+def _integers(text):
+    return [int(value) for value in text.split(',') if value]
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m benchmarks [options]')
+    parser.add_option('--server', metavar='HOST:PORT',
+                      help='benchmark an M/Wire server instead of the stand-in')
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds the stand-in server delays every reply')
+    parser.add_option('--commands', default=','.join(COMMANDS),
+                      help='comma separated, from %s' % ','.join(COMMANDS))
+    parser.add_option('--value-size', default='16,1024',
+                      help='comma separated value sizes in bytes')
+    parser.add_option('--width', default='10,100,1000',
+                      help='comma separated GETSUBTREE subtree widths')
+    parser.add_option('--number', type='int', default=10000,
+                      help='most commands per benchmark')
+    parser.add_option('--seconds', type='float', default=2.0,
+                      help='most seconds per benchmark')
+    parser.add_option('--output', metavar='FILE',
+                      help='write the results as JSON to FILE')
+    options, args = parser.parse_args(argv)
+    options.commands = [c for c in options.commands.split(',') if c]
+    for command in options.commands:
+        if command not in COMMANDS:
+            parser.error('unknown command %s' % command)
+    options.value_sizes = _integers(options.value_size)
+    options.widths = _integers(options.width)
+
+    server = None
+    if options.server:
+        host, port = options.server.rsplit(':', 1)
+        port = int(port)
+    else:
+        server = mwire_server.MWireServer(latency=options.latency).start()
+        host, port = server.host, server.port
+    m = mwire.M(host, port)
+    try:
+        print('%-12s %8s %8s %8s %12s %10s %10s %10s' % (
+            'command', 'size', 'width', 'ops', 'ops/sec',
+            'p50 us', 'p99 us', 'p999 us'))
+        results = run(m, options)
+    finally:
+        m.disconnect()
+        if server is not None:
+            server.stop()
+
+    if options.output:
+        document = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'revision': _revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server': options.server or 'stand-in',
+            'latency': None if options.server else options.latency,
+            'results': [result.as_dict() for result in results],
+        }
+        with open(options.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
+
+"""
+Compares mwire.encode_reference against the string concatenation that
+M._subscripts used to build references with.
+
+    python -m benchmarks.reference
+"""
+
+import timeit
+
+import mwire
+
+KEYS = [
+    ('config', []),
+    ('config', ['timeout']),
+    ('test1', [1, 'y', 'hello world']),
+    ('ts', [12345, 1316000000, 'value', 7]),
+]
+
+def legacy_reference(node, subscripts):
+    # M._subscripts before the cached encoder
+    max = len(subscripts) - 1
+    if max > -1:
+        text = '['
+        for i in range(max + 1):
+            try:
+                text = text + '"' + subscripts[i] + '"'
+            except TypeError:
+                text = text + str(subscripts[i])
+            if i < max:
+                text = text + ','
+        return node + text + ']'
+    else:
+        return node
+
+def uncached_reference(node, subscripts):
+    # encode_reference on a cache miss
+    if not subscripts:
+        return node
+    return node + '[' + ','.join([mwire.encode_subscript(s) for s in subscripts]) + ']'
+
+def main(number=200000):
+    implementations = [
+        ('legacy', legacy_reference),
+        ('uncached', uncached_reference),
+        ('cached', mwire.encode_reference),
+    ]
+    print('%-40s %12s %12s %12s' % (('key',) + tuple([name for name, f in implementations])))
+    for node, subscripts in KEYS:
+        timings = []
+        for name, function in implementations:
+            seconds = min(timeit.repeat(lambda: function(node, subscripts),
+                                        number=number, repeat=3))
+            timings.append('%9.0f ns' % (seconds / number * 1e9))
+        print('%-40s %12s %12s %12s' % ((mwire.encode_reference(node, subscripts),) + tuple(timings)))
+
+if __name__ == '__main__':
+    main()
@@ -10,55 +10,333 @@
 #   - PING;         +PONG can be +OK for consistency?
 #   - Inconsistencies with regard to $-1, since it can refer to '' or Null
 
+import atexit
+import bisect
 import csv
+import decimal
+import hashlib
+import itertools
+import math
+import os
+import re
 import socket
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 try:
     from cStringIO import StringIO
 except ImportError:
-    from StringIO import StringIO
+    from io import StringIO
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# The most precise clock for timing commands
+_timer = getattr(time, 'perf_counter', time.time)
 
 CRLF = '\r\n'
+CRLF_BYTES = b'\r\n'
+
+# Commands and replies are handled as native strings; on Python 3 they
+# are UTF-8 encoded on the way out and decoded on the way in.
+if bytes is str:
+    _string_types = basestring
+
+    def _encode(text):
+        return text
+
+    def _decode(data):
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return bytes(data)
+else:
+    _string_types = str
+
+    def _encode(text):
+        return text.encode('utf-8')
+
+    def _decode(data):
+        return str(data, 'utf-8')
+
+def _encode_line(line):
+    # Text is encoded; bytes, bytearrays and memoryviews are sent as is
+    if isinstance(line, _string_types):
+        return _encode(line)
+    return line
+
+def _bytes(data):
+    # Any value as bytes, copying bytearrays and memoryviews
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(_encode_line(data))
+
+REFERENCE_CACHE_SIZE = 4096
+
+if lru_cache is None:
+    # Python 2; the same linked list scheme as functools.lru_cache
+    def lru_cache(maxsize):
+        def decorator(function):
+            # Circular doubly linked list of [previous, next, key, result]
+            # links, the most recently used just before root
+            root = []
+            root[:] = [root, root, None, None]
+            cache = {}
+            lock = threading.Lock()
+            def wrapper(*args):
+                with lock:
+                    link = cache.get(args)
+                    if link is not None:
+                        previous, next, key, result = link
+                        previous[1] = next
+                        next[0] = previous
+                        last = root[0]
+                        last[1] = root[0] = link
+                        link[0] = last
+                        link[1] = root
+                        return result
+                result = function(*args)
+                with lock:
+                    if args not in cache:
+                        if len(cache) >= maxsize:
+                            oldest = root[1]
+                            root[1] = oldest[1]
+                            oldest[1][0] = root
+                            del cache[oldest[2]]
+                        last = root[0]
+                        link = [last, root, args, result]
+                        last[1] = root[0] = cache[args] = link
+                return result
+            def cache_clear():
+                with lock:
+                    cache.clear()
+                    root[:] = [root, root, None, None]
+            wrapper.cache_clear = cache_clear
+            wrapper.__wrapped__ = function
+            return wrapper
+        return decorator
+
+def encode_number(number):
+    """
+    Returns the M canonical form of a number: no exponent, no leading
+    zero before the decimal point and no trailing zeros after it,
+    e.g. 0.50 -> .5, 2.0 -> 2, 1e20 -> 100000000000000000000
+    """
+    if isinstance(number, decimal.Decimal):
+        if not number.is_finite():
+            raise ValueError("%s has no M canonical form" % number)
+        text = format(number, 'f')
+    elif not isinstance(number, float):
+        return str(number)
+    else:
+        text = repr(number)
+        if text in ('nan', 'inf', '-inf'):
+            raise ValueError("%s has no M canonical form" % text)
+        if 'e' in text:
+            text = format(decimal.Decimal(text), 'f')
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+        if text.startswith('0.'):
+            text = text[1:]
+        elif text.startswith('-0.'):
+            text = '-' + text[2:]
+        elif text == '-0':
+            text = '0'
+    return text
+
+def encode_subscript(subscript):
+    # abc -> "abc", say "hi" -> "say ""hi""", 0.5 -> .5
+    if isinstance(subscript, _string_types):
+        return '"' + subscript.replace('"', '""') + '"'
+    if isinstance(subscript, (float, decimal.Decimal)):
+        return encode_number(subscript)
+    if isinstance(subscript, (bytes, bytearray, memoryview)):
+        # As a binary M returns them
+        return encode_subscript(_decode(subscript))
+    return str(subscript)
+
+def encode_reference(node, subscripts):
+    """
+    Returns the reference test1[1,"a","b"] for node test1 and subscripts
+    [1, 'a', 'b']. The most recently used REFERENCE_CACHE_SIZE
+    references are cached, so a repeated key costs a dictionary lookup.
+    """
+    if not isinstance(node, _string_types):
+        # A node name read from a binary M
+        node = _decode(node)
+    if not subscripts:
+        return node
+    try:
+        return _encode_reference(node, tuple(subscripts))
+    except TypeError:
+        # Unhashable subscripts such as bytearrays are not cached
+        return _encode_reference.__wrapped__(node, subscripts)
+
+@lru_cache(maxsize=REFERENCE_CACHE_SIZE)
+def _encode_reference(node, subscripts):
+    return node + '[' + ','.join([encode_subscript(s) for s in subscripts]) + ']'
+
+def decode_subscripts(text):
+    """
+    Returns the subscripts in text, encoded by encode_subscript and
+    separated by commas as GETSUBTREE replies with them:
+    '1,"a ""b"" c",.5' -> [1, 'a "b" c', Decimal('.5')]. Numbers that are not
+    integers are returned as Decimals so that they encode back exactly.
+    """
+    subscripts = []
+    position = 0
+    length = len(text)
+    while position < length:
+        if text[position] == '"':
+            end = position + 1
+            while True:
+                end = text.find('"', end)
+                if end < 0:
+                    raise ProtocolError()
+                if text[end + 1:end + 2] != '"':
+                    break
+                # A doubled quote
+                end += 2
+            subscripts.append(text[position + 1:end].replace('""', '"'))
+            position = end + 1
+        else:
+            end = text.find(',', position)
+            if end < 0:
+                end = length
+            number = text[position:end]
+            if not _CANONIC_NUMBER.match(number):
+                raise ProtocolError()
+            if '.' in number:
+                subscripts.append(decimal.Decimal(number))
+            else:
+                subscripts.append(int(number))
+            position = end
+        if position < length:
+            if text[position] != ',':
+                raise ProtocolError()
+            position += 1
+    return subscripts
+
+# Levels of at most this many subscripts are read with a single GETALLSUBS
+# by iter_keys even for a range, rather than walked with NEXT
+SCAN_SIZE = 1000
 
 class M(object):
     """
     Implementation of the M/Wire protocol.
+
+    With binary set, values are returned as the bytes the server sent
+    rather than decoded to text, and set() takes bytes, bytearrays or
+    memoryviews as well as text, sending them untouched. A codec, if
+    given, converts values at the edge: codec.encode() is applied to
+    every value set and codec.decode() to every value read.
+
+    Any other keyword arguments configure the connections' sockets, e.g.
+    M('localhost', 6330, keepalive=60, receive_buffer=pow(2, 20)); see
+    Connection.
     """
 
-    def __init__(self, host='localhost', port=6330):
-        self._connection = Connection(host, port)
+    def __init__(self, host='localhost', port=6330, connection_pool=None,
+                 cache=None, observers=None, binary=False, codec=None,
+                 **connection_kwargs):
+        if connection_pool is None:
+            connection_pool = ConnectionPool(host, port, binary=binary,
+                                             **connection_kwargs)
+        self._pool = connection_pool
+        self.cache = cache
+        # CommandObservers, called around every command when there are any
+        self.observers = list(observers or [])
+        self.codec = codec
+        self._lock_table = _LockTable(connection_pool)
 
     def connect(self):
-        self._connection.connect()
+        connection = self._pool.get_connection()
+        try:
+            connection.connect()
+        finally:
+            self._pool.release(connection)
 
     def disconnect(self):
-        self._connection.disconnect()
-    
-    def read_length(self, length):
-        return self._connection.read(length)
-    
-    def read_line(self):
-        return self._connection.read()
-    
-    def send_line(self, text):
-        self._connection._sock.sendall(text + CRLF)
+        self._pool.disconnect()
+        
+    def _execute(self, reply, *lines):
+        # Send the command lines and parse the reply straight away;
+        # Pipeline overrides this to queue them instead.
+        connection = self._pool.get_connection()
+        try:
+            if not self.observers:
+                return _call(connection, reply, lines)
+            observation = _Observation(self.observers, lines[0], connection)
+            try:
+                result = _call(connection, reply, lines)
+            except Exception as e:
+                observation.finish(e)
+                raise
+            observation.finish()
+            return result
+        finally:
+            self._pool.release(connection)
+        
+    def _execute_cached(self, reply, command, node, subscripts, text):
+        # Serve reads from the ReadCache when there is one
+        if self.cache is None:
+            return self._execute(reply, text)
+        try:
+            return self.cache.get(text)
+        except KeyError:
+            pass
+        version = self.cache.version
+        value = self._execute(reply, text)
+        self.cache.put(text, command, node, subscripts, value, version)
+        return value
+        
+    def _values(self, reply, shape):
+        # reply, passing the values it reads through the codec
+        codec = self.codec
+        if codec is None:
+            return reply
+        return lambda connection: shape(reply(connection), codec.decode)
+
+    def _invalidate(self, node, subscripts, subtree=False):
+        # Called once a write has been made
+        if self.cache is not None:
+            self.cache.invalidate(node, subscripts, subtree)
+        
+    def _iterate(self, reply, *lines):
+        # Like _execute but for a generator reply; the connection is held
+        # until the generator finishes, and dropped if it is closed early
+        # with part of the reply still unread.
+        connection = self._pool.get_connection()
+        observation = None
+        if self.observers:
+            observation = _Observation(self.observers, lines[0], connection)
+        complete = False
+        try:
+            connection.connect()
+            connection.send_lines(lines)
+            for item in reply(connection):
+                yield item
+            complete = True
+        except Exception as e:
+            if observation is not None:
+                observation.finish(e)
+                observation = None
+            raise
+        finally:
+            if not complete:
+                connection.disconnect()
+            self._pool.release(connection)
+            if observation is not None:
+                # Finished, or closed early by the caller
+                observation.finish()
         
-    def _subscripts(self, subscripts):
-        max = len(subscripts) - 1
-        if max > -1:
-            text = '['
-            for i in range(max + 1):
-                # Attempt to concatenate as a string but if this
-                # fails then we can conclude it's a number.
-                try:
-                    text = text + '"' + subscripts[i] + '"'
-                except TypeError:
-                    text = text + str(subscripts[i])
-                if i < max:
-                    text = text + ','
-            return text + ']'
-        else:
-            return ''
-            
     def decrement(self, node, subscripts):
         return self._increment_decrement(node, subscripts, -1)
         
@@ -66,128 +344,218 @@ class M(object):
         return self._increment_decrement(node, subscripts, -amount)
             
     def _increment_decrement(self, node, subscripts, amount):
-        self.connect()
         #  INCR test1["a","b"]
         #  INCRBY test1["a","b"] 12
         #  DECR test1["a","b"]
         #  DECRBY test1["a","b"] 12
         if amount >= 2:
-            text = 'INCRBY ' + node + self._subscripts(subscripts) + ' ' + str(amount)
+            text = 'INCRBY ' + encode_reference(node, subscripts) + ' ' + str(amount)
         elif amount == 1:
-            text = 'INCR ' + node + self._subscripts(subscripts)
+            text = 'INCR ' + encode_reference(node, subscripts)
         elif amount == -1:
-            text = 'DECR ' + node + self._subscripts(subscripts)
+            text = 'DECR ' + encode_reference(node, subscripts)
         elif amount <= -2:
-            text = 'DECRBY ' + node + self._subscripts(subscripts) + ' ' + str(-amount)
+            text = 'DECRBY ' + encode_reference(node, subscripts) + ' ' + str(-amount)
         else:
             raise ProtocolError()
-        self.send_line(text)
-        # :3, :1
-        text = self.read_line()
-        if text[0] != ':':
-            raise ProtocolError()
-        return int(text[1:])
+        try:
+            return self._execute(_read_integer, text)
+        finally:
+            self._invalidate(node, subscripts)
         
     def exists(self, node, subscripts):
-        self.connect()
         #  EXISTS test1[1,"y"]
-        text = 'EXISTS ' + node + self._subscripts(subscripts)
-        self.send_line(text)
-        text = self.read_line()
-        if text[0] != ':':
-            raise ProtocolError()
-        # :0, :1, :10, :11
-        return int(text[1:])
+        text = 'EXISTS ' + encode_reference(node, subscripts)
+        return self._execute_cached(_read_integer, 'EXISTS', node, subscripts, text)
+
+    def exists_many(self, node, keys, chunk_size=50, concurrency=4):
+        """
+        EXISTS for many subscripts of one global at once; see get_many().
+        """
+        return self._many('exists', node, keys, chunk_size, concurrency)
     
     def function(self):
         raise ToDoError()
 
     def get(self, node, subscripts):
-        self.connect()
         # GET test1["a","b"]
-        text = 'GET ' + node + self._subscripts(subscripts)
-        self.send_line(text)
-        # $5
-        text = self.read_line()
-        if text[0] != '$':
-            raise ProtocolError()
-        # $-1
-        length = int(text[1:])
-        if length < 0:
-            return None
-        # $0
-        if length == 0:
-            # Read the last empty line
-            return self.read_line()
-        # Hello World
-        return self.read_length(length)
+        text = 'GET ' + encode_reference(node, subscripts)
+        return self._execute_cached(self._values(_read_get, _decode_value),
+                                    'GET', node, subscripts, text)
+
+    def get_many(self, node, keys, chunk_size=50, concurrency=4):
+        """
+        GETs node[subscripts] for every list of subscripts in keys and
+        returns an OrderedDict of the values keyed by subscript tuple, in
+        the order of keys. The keys are split into chunks of chunk_size,
+        each sent as one pipeline, and up to concurrency chunks are in
+        flight at once on connections of their own:
+
+            m.get_many('orders', [[42, 'status'], [43, 'status']])
+        """
+        return self._many('get', node, keys, chunk_size, concurrency)
+
+    def _many(self, name, node, keys, chunk_size, concurrency):
+        keys = [tuple(_subscript_list(key)) for key in keys]
+        chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+        def run(chunks):
+            # One pipeline, and so one round trip, a chunk
+            results = []
+            for chunk in chunks:
+                p = self.pipeline(flush_size=0)
+                for key in chunk:
+                    getattr(p, name)(node, key)
+                results.extend(p.execute())
+            return results
+        # Chunks are dealt out so each worker holds one connection at a time
+        workers = max(1, min(concurrency, len(chunks)))
+        calls = [_bound(run, chunks[i::workers]) for i in range(workers)]
+        results = OrderedDict()
+        for i, replies in enumerate(_parallel(calls)):
+            chunked = [chunks[j] for j in range(i, len(chunks), workers)]
+            for key, reply in zip(itertools.chain(*chunked), replies):
+                if isinstance(reply, ResponseError):
+                    raise reply
+                results[key] = reply
+        # Back into the order of keys
+        return OrderedDict([(key, results[key]) for key in keys])
     
     def getallsubs(self, node, subscripts):
-        self.connect()
         # GETALLSUBS test1["a","b"]
-        text = 'GETALLSUBS ' + node + self._subscripts(subscripts)
-        self.send_line(text)
-        # *7
-        text = self.read_line()
-        if text[0] != '*':
-            raise ProtocolError()
-        # Prepare the returning list
-        data = []
-        # Iterate the number of results
-        for i in range(0, int(text[1:]), 2):
-            item = [None, None]
-            data.append(item)
-            # $1 - subscript
-            text = self.read_line()
-            if text[0] != '$':
-                raise ProtocolError()
-            length = int(text[1:])
-            if length > -1:
-                item[0] = self.read_length(length)
-                # $51 - data value
-                text = self.read_line()
-                if text[0] != '$':
-                    raise ProtocolError()
-                length = int(text[1:])
-                if length > -1:
-                    item[1] = self.read_length(length)
-        return data
+        text = 'GETALLSUBS ' + encode_reference(node, subscripts)
+        return self._execute(self._values(_read_getallsubs, _decode_pairs), text)
     
     def getsubtree(self, node, subscripts):
-        self.connect()
         # GETSUBTREE test1["a","b"]
-        text = 'GETSUBTREE ' + node + self._subscripts(subscripts)
-        self.send_line(text)
-        # *7
-        text = self.read_line()
-        if text[0] != '*':
-            raise ProtocolError()
-        # Prepare the returning list
-        data = []
-        # Iterate the number of results
-        for i in range(0, int(text[1:]), 2):
-            item = [None, '']
-            data.append(item)
-            # $1 - subscript
-            text = self.read_line()
-            if text[0] != '$':
-                raise ProtocolError()
-            length = int(text[1:])
-            if length > -1:
-                item[0] = self.read_length(length)
-            # $51 - data value
-            text = self.read_line()
-            if text[0] != '$':
-                raise ProtocolError()
-            length = int(text[1:])
-            if length > -1:
-                item[1] = self.read_length(length)
-        return data
+        text = 'GETSUBTREE ' + encode_reference(node, subscripts)
+        return self._execute(self._values(_read_getsubtree, _decode_pairs), text)
+
+    def getsubtree_array(self, node, subscripts, key_dtype='float64',
+                         value_dtype='float64'):
+        """
+        Reads the subtree below node[subscripts] into a pair of NumPy
+        arrays, the last subscript of each node and its value, for numeric
+        globals such as ts[id,timestamp]=value:
+
+            times, values = m.getsubtree_array('ts', [42], 'int64')
+
+        The reply is parsed straight into arrays sized from its length, a
+        chunk of nodes at a time, without a string for every subscript and
+        value. A node with no value is NaN, so a numeric value_dtype must
+        be a float type if there may be any. Keys and values of other
+        dtypes, such as 'U8', are decoded one at a time instead.
+        node[subscripts] itself is left out.
+        NumPy is only imported when this is called.
+        """
+        import numpy
+        # GETSUBTREE ts[42]
+        text = 'GETSUBTREE ' + encode_reference(node, subscripts)
+        return self._execute(lambda connection: _read_getsubtree_array(
+            connection, numpy, numpy.dtype(key_dtype), numpy.dtype(value_dtype)), text)
+    
+    def iter_allsubs(self, node, subscripts):
+        """
+        Yields the [subscript, value] pairs of getallsubs() as they are
+        read off the socket rather than building the whole list.
+        """
+        # GETALLSUBS test1["a","b"]
+        text = 'GETALLSUBS ' + encode_reference(node, subscripts)
+        return self._iterate(self._values(_iter_getallsubs, _decode_pairs), text)
+    
+    def iter_subtree(self, node, subscripts):
+        """
+        Yields the [subscript, value] pairs of getsubtree() as they are
+        read off the socket rather than building the whole list.
+        """
+        # GETSUBTREE test1["a","b"]
+        text = 'GETSUBTREE ' + encode_reference(node, subscripts)
+        return self._iterate(self._values(_iter_getsubtree, _decode_pairs), text)
+    
+    def iter_keys(self, node, subscripts, reverse=False, prefetch=100,
+                  start=None, stop=None):
+        """
+        Yields the subscripts of the level below node[subscripts] in
+        collation order, or reversed, from start (inclusive) up to stop
+        (exclusive) when given.
+
+        A forward scan of the whole level streams a single GETALLSUBS,
+        whose values are read and discarded, and so does a forward range
+        of a level of at most SCAN_SIZE subscripts, skipping those before
+        start. Otherwise the level is walked with NEXT or PREVIOUS, each
+        depending on the previous reply, so a background thread walks up
+        to prefetch keys ahead of the caller, overlapping the round trips
+        with the caller's own work.
+        """
+        subscripts = list(subscripts)
+        if not reverse:
+            if start is None and stop is None:
+                return (item[0] for item in self.iter_allsubs(node, subscripts))
+            return self._scan_keys(node, subscripts, prefetch, start, stop)
+        return self._prefetched_keys(node, subscripts, True, prefetch, start, stop)
+
+    def _prefetched_keys(self, node, subscripts, reverse, prefetch, start, stop):
+        keys = self._walk_keys(node, subscripts, reverse, start, stop)
+        if not prefetch:
+            return keys
+        return _prefetch(keys, prefetch)
+
+    def _scan_keys(self, node, subscripts, prefetch, start, stop):
+        # GETALLSUBS replies with the size of the level before its keys
+        text = 'GETALLSUBS ' + encode_reference(node, subscripts)
+        items = self._iterate(lambda connection: _iter_getallsubs(connection, True), text)
+        if next(items) > SCAN_SIZE:
+            # Too wide to read through to start; the rest is dropped with
+            # the connection
+            items.close()
+            keys = self._prefetched_keys(node, subscripts, False, prefetch, start, stop)
+            try:
+                for key in keys:
+                    yield key
+            finally:
+                keys.close()
+            return
+        if start is not None:
+            start = _collation_key(start)
+        if stop is not None:
+            stop = _collation_key(stop)
+        for key, value in items:
+            position = _collation_key(key)
+            if start is not None and position < start:
+                continue
+            if stop is not None and position >= stop:
+                # The rest of a small level is read to keep the connection
+                for item in items:
+                    pass
+                return
+            yield key
+    
+    def _walk_keys(self, node, subscripts, reverse, start, stop):
+        step = self.previous if reverse else self.next
+        if start is None:
+            key = step(node, subscripts + [''])
+        elif self.exists(node, subscripts + [start]):
+            # As NEXT and PREVIOUS return it
+            key = start
+            if isinstance(key, (bytes, bytearray, memoryview)):
+                key = _decode(key)
+            elif not isinstance(key, _string_types):
+                key = encode_subscript(key)
+            if self._pool.connection_kwargs.get('binary'):
+                key = _encode(key)
+        else:
+            key = step(node, subscripts + [start])
+        if stop is not None:
+            stop = _collation_key(stop)
+        while key is not None:
+            if stop is not None:
+                position = _collation_key(key)
+                if (position <= stop) if reverse else (position >= stop):
+                    return
+            yield key
+            key = step(node, subscripts + [key])
     
     def halt(self):
-        self.connect()
-        self.send_line('HALT')
-        return True
+        return self._execute(_read_nothing, 'HALT')
             
     def increment(self, node, subscripts):
         return self._increment_decrement(node, subscripts, 1)
@@ -196,288 +564,3048 @@ class M(object):
         return self._increment_decrement(node, subscripts, amount)
             
     def kill(self, node, subscripts):
-        self.connect()
         #  KILL test1["a","b"]
-        text = 'KILL ' + node + self._subscripts(subscripts)
-        self.send_line(text)
-        text = self.read_line()
-        # +ok
-        if text == '+ok':
-            return True
-        else:
-            return False
+        text = 'KILL ' + encode_reference(node, subscripts)
+        try:
+            return self._execute(_read_kill, text)
+        finally:
+            self._invalidate(node, subscripts, True)
     
-    def lock(self, node, subscripts):
-        raise ToDoError()
+    def lock(self, node, subscripts, timeout=None):
+        """
+        Locks node[subscripts] and its descendants for this client,
+        waiting up to timeout seconds, or as long as it takes if None, and
+        returns whether it was locked. Locks are re-entrant: a thread
+        locking a node it already holds only counts it, with no round
+        trip, and must unlock it as many times. Other threads of this
+        client wait for the lock as other clients do.
+        """
+        # LOCK test1["a","b"] 0
+        return self._lock_table.acquire(node, subscripts, timeout)
+
+    def locked(self, node, subscripts, timeout=None):
+        """
+        Holds the lock on node[subscripts] for a with block, raising
+        LockError if it cannot be had within timeout seconds:
+
+            with m.locked('accounts', [42], timeout=5):
+                m.set('accounts', [42, 'balance'], '100')
+        """
+        return _locked(self, node, subscripts, timeout)
     
     def mdate(self):
         raise ToDoError()
     
-    def monitor(self):
-        raise ToDoError()
+    def monitor(self, callback=None, max_queued=10000):
+        """
+        Returns a Monitor delivering the changes made on the server, read
+        over a connection of its own. This client's ReadCache, if it has
+        one, then drops replies changed by other clients too; with
+        max_queued=0 that is all it does.
+        """
+        pool = self._pool
+        return Monitor(pool.host, pool.port, callback, self.cache,
+                       max_queued=max_queued, **pool.connection_kwargs)
     
+    def mset(self, node, subscripts, items, chunk_size=1000,
+             setsubtree=False, progress=None):
+        """
+        Writes the (subscripts, value) pairs of any iterable below
+        node[subscripts], taking chunk_size pairs at a time so the whole
+        data set is never held in memory. Each chunk costs one round trip:
+        a pipeline of SETs, or a single SETSUBTREE if setsubtree is True
+        and the server supports it. progress, if given, is called with the
+        LoadResult after every chunk; the final LoadResult is returned.
+
+            m.mset('ts', [42], ((t, str(v)) for t, v in samples))
+        """
+        result = LoadResult()
+        started = time.time()
+        subscripts = list(subscripts)
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                break
+            if setsubtree:
+                if self._setsubtree(node, subscripts, chunk) is not True:
+                    result.failed += len(chunk)
+            else:
+                p = self.pipeline(flush_size=0)
+                for relative, value in chunk:
+                    # A None value has no node to set
+                    if value is not None:
+                        p.set(node, subscripts + _subscript_list(relative), value)
+                for reply in p.execute():
+                    if reply is not True:
+                        result.failed += 1
+            result.count += len(chunk)
+            result.seconds = time.time() - started
+            if progress is not None:
+                progress(result)
+        return result
+
     def mversion(self):
         raise ToDoError()
 
     def next(self, node, subscripts):
-        text = 'NEXT ' + node + self._subscripts(subscripts)
+        text = 'NEXT ' + encode_reference(node, subscripts)
         return self._next_previous(text, node, subscripts)
         
     def previous(self, node, subscripts):
-        text = 'PREVIOUS ' + node + self._subscripts(subscripts)
+        text = 'PREVIOUS ' + encode_reference(node, subscripts)
         return self._next_previous(text, node, subscripts)
             
     def _next_previous(self, command, node, subscripts):
-        self.connect()
         # NEXT myArray[1,""]
         # PREVIOUS myArray[1,""]
-        self.send_line(command)
-        # $12
-        text = self.read_line()
-        if text[0] != '$':
-            raise ProtocolError()
-        # $-1, $12
-        length = int(text[1:])
-        if length < 0:
-            return None
-        # sub2, 12.98
-        return self.read_length(length)
+        return self._execute(_read_bulk, command)
         
     def ping(self):
-        self.connect()
-        self.send_line('PING')
-        if self.read_line() == '+PONG':
-            return True
-        else:
-            return False
+        return self._execute(_read_pong, 'PING')
+            
+    def pipeline(self, flush_size=1000):
+        """
+        Returns a Pipeline that queues commands against this client's
+        connection and sends them in a single write when executed.
+        """
+        return Pipeline(self, flush_size)
             
     def query(self, node, subscripts):
-        self.connect()
         # QUERY test1["a","b"]
-        text = 'QUERY ' + node + self._subscripts(subscripts)
-        self.send_line(text)
-        # $5
-        text = self.read_line()
-        if text[0] != '$':
-            raise ProtocolError()
-        # $-1
-        length = int(text[1:])
-        if length < 0:
-            return None
-        # test1["a","C"]
-        return self.read_length(length)
+        text = 'QUERY ' + encode_reference(node, subscripts)
+        return self._execute_cached(_read_bulk, 'QUERY', node, subscripts, text)
     
     def queryget(self, node, subscripts):
-        self.connect()
-        data = [None, None]
         # QUERYGET test1["a","b"]
-        text = 'QUERYGET ' + node + self._subscripts(subscripts)
-        self.send_line(text)
-        # *2, $-1
-        text = self.read_line()
-        if text == '$-1':
-            pass
-        elif text != '*2':
-            raise ProtocolError()
-        else:
-            # $14 - node and subscript
-            text = self.read_line()
-            if text[0] != '$':
-                raise ProtocolError()
-            length = int(text[1:])
-            data[0] = self.read_length(length)
-            # $51 - data value
-            text = self.read_line()
-            if text[0] != '$':
-                raise ProtocolError()
-            length = int(text[1:])
-            data[1] = self.read_length(length)
-        return data
+        text = 'QUERYGET ' + encode_reference(node, subscripts)
+        return self._execute(self._values(_read_queryget, _decode_pair), text)
         
     def set(self, node, subscripts, value):
-        self.connect()
         # SET test1["a","b"] 5
         # hello
-        text = 'SET ' + node + self._subscripts(subscripts) + ' ' + str(len(value))
-        self.send_line(text)
-        self.send_line(value)
-        # $11
-        text = self.read_line()
-        if text[0] != "$":
-            return False
-        text = self.read_line()
-        # {"ok":true}
-        if text == '{"ok":true}':
-            return True
-        else:
-            return False
+        if self.codec is not None:
+            value = self.codec.encode(value)
+        value = _encode_line(value)
+        text = 'SET ' + encode_reference(node, subscripts) + ' ' + str(len(value))
+        try:
+            return self._execute(_read_set, text, value)
+        finally:
+            self._invalidate(node, subscripts)
         
     def setsubtree(self, node, subscripts, data):
-        raise ToDoError()
-        self.connect()
+        """
+        Writes the [subscript, value] pairs of data below node[subscripts],
+        returning True if every node was written. Each subscript may be a
+        single subscript or a list of them.
+        """
+        return self.mset(node, subscripts, data).failed == 0
+    
+    def _setsubtree(self, node, subscripts, data):
         # SETSUBTREE test1["a","b"]
-        text = 'SETSUBTREE ' + node + self._subscripts(subscripts)
-        self.send_line(text)
+        lines = ['SETSUBTREE ' + encode_reference(node, subscripts)]
         # *4 - record count following
-        count = len(data)
-        text = '*' + str(2 * count)
-        self.send_line(text)
+        lines.append('*' + str(2 * len(data)))
         # Iterate the records
-        for i in range(count):
+        for relative, value in data:
             # $3 - subscript
-            text = '$' + str(len(data[i][0]) + 2)
-            self.send_line(text)
-            # abc - subscript
-            text = '"' + data[i][0] + '"'
-            self.send_line(text)
+            # "abc" - subscript
+            text = ','.join([encode_subscript(s) for s in _subscript_list(relative)])
+            lines.append('$' + str(len(_encode(text))))
+            lines.append(text)
             # $4 - data value ($-1, None)
-            text = '$' + str(len(data[i][1]) + 2)
-            self.send_line(text)
-            # wxyz - data value
-            text = '"' + data[i][1] + '"'
-            self.send_line(text)
-        text = self.read_line()
-        # {"ok":true}
-        if text == '{"ok":true}':
-            return True
-        else:
-            return False
+            if value is None:
+                lines.append('$-1')
+                continue
+            # "wxyz" - data value
+            if self.codec is not None:
+                value = self.codec.encode(value)
+            value = _bytes(value)
+            value = b'"' + value.replace(b'"', b'""') + b'"'
+            lines.append('$' + str(len(value)))
+            lines.append(value)
+        try:
+            return self._execute(_read_setsubtree, *lines)
+        finally:
+            self._invalidate(node, subscripts, True)
     
+    def transaction(self):
+        """
+        Returns a Transaction buffering writes until it is committed.
+        """
+        return Transaction(self)
+
     def transaction_start(self):
-        raise ToDoError()
+        return self.transaction()
     
-    def transaction_commit(self):
-        raise ToDoError()
+    def transaction_commit(self, transaction):
+        return transaction.commit()
     
-    def transaction_rollback(self):
-        raise ToDoError()
+    def transaction_rollback(self, transaction):
+        transaction.rollback()
 
     def unlock(self, node, subscripts):
-        raise ToDoError()
+        """
+        Releases one hold of the calling thread on node[subscripts],
+        unlocking it on the server once the last is released. Raises
+        LockError if the thread does not hold it.
+        """
+        # UNLOCK test1["a","b"]
+        return self._lock_table.release(node, subscripts)
+
+    def unlock_all(self):
+        """
+        Releases every lock the calling thread holds in one round trip,
+        returning how many were unlocked.
+        """
+        return self._lock_table.release_all()
     
     def version(self):
         raise ToDoError()
 
-def split_csv(line, *args, **kwargs):
-    try:
-        buffer = StringIO(line)
-        reader = csv.reader(buffer, *args, **kwargs)
-        return reader.next()
-    finally:
-        buffer.close()
-        
-class SocketLineReader(object):
-    MAX_LENGTH = pow(2, 19) # 534,288
+class Pipeline(M):
+    """
+    Queues commands and sends them to the server in a single write, then
+    parses the replies in order. Every command method of M is available
+    and returns the pipeline so calls can be chained:
 
-    def __init__(self):
-        self._file = None
+        p = m.pipeline()
+        p.set('test1', ['a'], 'hello').get('test1', ['a'])
+        p.execute() # [True, 'hello']
 
-    def __del__(self):
-        try:
-            self.on_disconnect()
-        except:
-            pass
+    A command the server rejects leaves its ResponseError in the results
+    rather than aborting the rest of the batch. Once flush_size commands
+    are queued they are flushed automatically, keeping the queue bounded.
 
-    def on_connect(self, connection):
-        self._file = connection._sock.makefile('r')
+    mset() and setsubtree() queue a SET for each node, or a SETSUBTREE a
+    chunk, and get_many() and exists_many() a GET or EXISTS for each key,
+    each with a result of its own. The iter_ generators cannot be queued
+    and raise ToDoError.
+    """
 
-    def on_disconnect(self):
-        if self._file is not None:
-            self._file.close()
-            self._file = None
+    def __init__(self, m, flush_size=1000):
+        self._pool = m._pool
+        self.cache = m.cache
+        self.observers = m.observers
+        self.codec = m.codec
+        # Locks are taken straight away, not queued
+        self._lock_table = m._lock_table
+        self.flush_size = flush_size
+        # Whether the last flush wrote anything, even if it then failed
+        self.sent = False
+        self._lines = []
+        self._replies = []
+        self._results = []
+        self._writes = []
 
-    def read(self, length=None):
-        try:
-            if length is None:
-                return self._file.readline()[:-2]
-            else:
-                remaining = length + 2
-                if length <= self.MAX_LENGTH:
-                    return self._file.read(remaining)[:-2]
-                else:
-                    try:
-                        buffer = StringIO()
-                        while remaining > 0:
-                            read_length = min(remaining, self.MAX_LENGTH)
-                            buffer.write(self._file.read(read_length))
-                            remaining -= read_length
-                        buffer.seek(0)
-                        return buffer.read(length)
-                    finally:
-                        buffer.close()
-            
-        except (socket.error, socket.timeout), e:
-            raise ConnectionError("Error while reading from socket: %s" % (e.args,))
+    def __len__(self):
+        return len(self._replies)
 
-class Connection(object):
-    def __init__(self, host='localhost', port=6330):
-        self.host = host
-        self.port = port
-        self.socket_timeout = 5
-        self._sock = None
-        self._reader = SocketLineReader()
+    def _execute(self, reply, *lines):
+        self._lines.extend(lines)
+        self._replies.append(reply)
+        if self.flush_size and len(self._replies) >= self.flush_size:
+            self.flush()
+        return self
 
-    def __del__(self):
+    def _execute_cached(self, reply, command, node, subscripts, text):
+        # Replies are read later, so bypass the cache
+        return self._execute(reply, text)
+
+    def _invalidate(self, node, subscripts, subtree=False):
+        # Not written until flushed
+        if self.cache is not None:
+            self._writes.append((node, subscripts, subtree))
+
+    def _many(self, name, node, keys, chunk_size, concurrency):
+        for key in keys:
+            getattr(self, name)(node, _subscript_list(key))
+        return self
+
+    def mset(self, node, subscripts, items, chunk_size=1000,
+             setsubtree=False, progress=None):
+        # Queued behind the commands before it; there is no progress
+        subscripts = list(subscripts)
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                break
+            if setsubtree:
+                self._setsubtree(node, subscripts, chunk)
+                continue
+            for relative, value in chunk:
+                # A None value has no node to set
+                if value is not None:
+                    self.set(node, subscripts + _subscript_list(relative), value)
+        return self
+
+    def setsubtree(self, node, subscripts, data):
+        return self.mset(node, subscripts, data)
+
+    def iter_allsubs(self, node, subscripts):
+        # Would be read straight away, ahead of the queued commands
+        raise ToDoError()
+
+    def iter_keys(self, node, subscripts, reverse=False, prefetch=100,
+                  start=None, stop=None):
+        raise ToDoError()
+
+    def iter_subtree(self, node, subscripts):
+        raise ToDoError()
+
+    def flush(self):
+        """
+        Sends the queued commands and reads their replies, keeping the
+        results until execute() is called.
+        """
+        if not self._replies:
+            return
+        lines, replies, writes = self._lines, self._replies, self._writes
+        self._lines, self._replies, self._writes = [], [], []
+        self.sent = False
+        connection = self._pool.get_connection()
+        observation = None
+        if self.observers:
+            # The whole batch is one round trip, observed as PIPELINE
+            observation = _Observation(self.observers, 'PIPELINE', connection)
         try:
-            self.disconnect()
+            connection.connect()
+            # Part of a failed write may still reach the server
+            self.sent = True
+            connection.send_lines(lines)
+            for reply in replies:
+                try:
+                    self._results.append(reply(connection))
+                except ResponseError as e:
+                    self._results.append(e)
         except:
-            pass
+            # The replies can no longer be matched to their commands
+            connection.disconnect()
+            self.reset()
+            if observation is not None:
+                observation.finish(sys.exc_info()[1])
+                observation = None
+            raise
+        finally:
+            if observation is not None:
+                observation.finish()
+            self._pool.release(connection)
+            for write in writes:
+                M._invalidate(self, *write)
 
-    def connect(self):
-        if self._sock:
-            return
+    def execute(self):
+        """
+        Flushes any queued commands and returns the results of every
+        command since the last execute(), in the order they were queued.
+        """
         try:
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._sock.settimeout(self.socket_timeout)
-            self._sock.connect((self.host, self.port))
-        except socket.error, e:
-            self._sock = None
-            raise ConnectionError(self._error_message(e))
-        self.on_connect()
+            self.flush()
+            return self._results
+        finally:
+            self._results = []
 
-    def _error_message(self, exception):
-        if len(exception.args) == 1:
-            return "Error connecting to %s:%s. %s." % \
-                (self.host, self.port, exception.args[0])
+    def reset(self):
+        """
+        Discards queued commands and unread results.
+        """
+        self._lines = []
+        self._replies = []
+        self._results = []
+        self._writes = []
+
+class Transaction(Pipeline):
+    """
+    Buffers writes on the client and sends them all at commit, between
+    TSTART and TCOMMIT, in a single write:
+
+        with m.transaction() as t:
+            t.set('accounts', [1, 'balance'], '50')
+            t.increment_by('accounts', [2, 'balance'], 50)
+            t.get('accounts', [1, 'balance']) # '50', from the buffer
+
+    Reads are not buffered. get(), get_many(), exists() and
+    exists_many() answer as if the buffered writes had been made,
+    without a round trip for a node the transaction has set. Other reads
+    go straight to the server and do not see the writes. rollback() only
+    discards the buffer. Leaving a with block commits, or rolls back on
+    an exception. A commit the server accepts with some writes rejected
+    raises CommitError; the rest of the writes have been made.
+    """
+
+    def __init__(self, m):
+        Pipeline.__init__(self, m, flush_size=0)
+        self._m = m
+        # (node, encoded subscripts): value, None if killed
+        self._values = {}
+        # (node, encoded subscripts): amount to add to the server's value
+        self._deltas = {}
+        # (node, encoded subscripts) of the killed subtrees
+        self._killed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.commit()
         else:
-            return "Error %s connecting %s:%s. %s." % \
-                (exception.args[0], self.host, self.port, exception.args[1])
+            self.rollback()
 
-    def on_connect(self):
-        self._reader.on_connect(self)
+    def _killed_below(self, key):
+        # Whether key is in a subtree killed by the transaction
+        for killed in self._killed:
+            if killed[0] == key[0] and key[1][:len(killed[1])] == killed[1]:
+                return True
+        return False
 
-    def disconnect(self):
-        self._reader.on_disconnect()
-        if self._sock is None:
-            return
-        try:
-            self._sock.close()
-        except socket.error:
-            pass
-        self._sock = None
+    def _direct(name):
+        # Sent to the server straight away rather than buffered
+        def method(self, *args, **kwargs):
+            return getattr(self._m, name)(*args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = getattr(M, name).__doc__
+        return method
 
-    def read(self, length=None):
-        try:
-            response = self._reader.read(length)
-        except:
-            self.disconnect()
-            raise
-        if response.__class__ == ResponseError:
-            raise response
-        return response
+    getallsubs = _direct('getallsubs')
+    getsubtree = _direct('getsubtree')
+    getsubtree_array = _direct('getsubtree_array')
+    iter_allsubs = _direct('iter_allsubs')
+    iter_keys = _direct('iter_keys')
+    iter_subtree = _direct('iter_subtree')
+    next = _direct('next')
+    ping = _direct('ping')
+    previous = _direct('previous')
+    query = _direct('query')
+    queryget = _direct('queryget')
 
-class MWireError(Exception):
-    pass
+    del _direct
 
-class ToDoError(MWireError):
-    pass
+    def _buffered(self, key, read):
+        # key's value once the buffered writes are made, read() returning
+        # the server's value when it is needed
+        if key in self._values:
+            return self._values[key]
+        if self._killed_below(key):
+            return None
+        value = read()
+        if key in self._deltas:
+            return self._number_as_value(self._value_number(value) + self._deltas[key])
+        return value
 
-class ProtocolError(MWireError):
-    pass
+    def _value_number(self, value):
+        # The number M takes a value, as get() returns it, to be
+        if value is not None and self.codec is not None:
+            value = self.codec.encode(value)
+        return _number_value(value)
 
-class ConnectionError(MWireError):
-    pass
+    def _number_as_value(self, number):
+        # number as get() would return it from the server
+        value = encode_number(number)
+        if self._pool.connection_kwargs.get('binary'):
+            value = _encode(value)
+        if self.codec is not None:
+            value = self.codec.decode(value)
+        return value
 
-class ResponseError(MWireError):
-    pass
+    def get(self, node, subscripts):
+        return self._buffered(_write_key(node, subscripts),
+                              lambda: self._m.get(node, subscripts))
+
+    def get_many(self, node, keys, chunk_size=50, concurrency=4):
+        values = self._m.get_many(node, keys, chunk_size, concurrency)
+        for key, value in values.items():
+            values[key] = self._buffered(_write_key(node, key), lambda: value)
+        return values
+
+    def _below(self, key, keys):
+        # The keys at or below key
+        level = len(key[1])
+        return [k for k in keys if k[0] == key[0] and k[1][:level] == key[1]]
+
+    def _touched(self, key):
+        # Whether the buffered writes change key or anything below it
+        return bool(self._killed_below(key) or self._below(key, self._killed) or
+                    self._below(key, itertools.chain(self._values, self._deltas)))
+
+    def exists(self, node, subscripts):
+        key = _write_key(node, subscripts)
+        if not self._touched(key):
+            return self._m.exists(node, subscripts)
+        written = self._below(key, itertools.chain(self._values, self._deltas))
+        data = 1 if key in written else 0
+        below = 10 if len(written) > data else 0
+        if self._killed_below(key):
+            # Nothing the server holds there is left
+            return data + below
+        if data and below:
+            return data + below
+        killed = self._below(key, self._killed)
+        existing = self._m.exists(node, subscripts)
+        data = data or existing % 10
+        if not below and existing >= 10:
+            below = 10
+            if killed:
+                # Unless every node below is in a killed subtree
+                below = 0
+                for relative, value in self._m.getsubtree(node, subscripts):
+                    if relative is None:
+                        continue
+                    relative = decode_subscripts(_decode(_bytes(relative)))
+                    subtree = _subscript_list(subscripts) + relative
+                    if not self._killed_below(_write_key(node, subtree)):
+                        below = 10
+                        break
+        return data + below
+
+    def exists_many(self, node, keys, chunk_size=50, concurrency=4):
+        results = self._m.exists_many(node, keys, chunk_size, concurrency)
+        for key in results:
+            if self._touched(_write_key(node, key)):
+                results[key] = self.exists(node, list(key))
+        return results
+
+    def kill(self, node, subscripts):
+        key = _write_key(node, subscripts)
+        level = len(key[1])
+        for written in (self._values, self._deltas):
+            for held in list(written):
+                if held[0] == key[0] and held[1][:level] == key[1]:
+                    del written[held]
+        self._killed.append(key)
+        return Pipeline.kill(self, node, subscripts)
+
+    def set(self, node, subscripts, value):
+        key = _write_key(node, subscripts)
+        self._values[key] = value
+        self._deltas.pop(key, None)
+        return Pipeline.set(self, node, subscripts, value)
+
+    def _increment_decrement(self, node, subscripts, amount):
+        key = _write_key(node, subscripts)
+        if key in self._values:
+            self._values[key] = self._number_as_value(
+                self._value_number(self._values[key]) + amount)
+        elif self._killed_below(key):
+            self._values[key] = self._number_as_value(amount)
+        else:
+            self._deltas[key] = self._deltas.get(key, 0) + amount
+        return Pipeline._increment_decrement(self, node, subscripts, amount)
+
+    def mset(self, node, subscripts, items, chunk_size=1000,
+             setsubtree=False, progress=None):
+        # Buffered as SETs like any other write
+        subscripts = list(subscripts)
+        for relative, value in items:
+            if value is not None:
+                self.set(node, subscripts + _subscript_list(relative), value)
+        return self
+
+    def commit(self):
+        """
+        Sends the buffered writes between TSTART and TCOMMIT in one round
+        trip and returns their replies. TCOMMIT is sent along with them,
+        so writes the server rejects do not stop the others from being
+        committed; CommitError is then raised, holding every reply.
+        """
+        if not self._replies:
+            self.rollback()
+            return []
+        self._lines = ['TSTART'] + self._lines + ['TCOMMIT']
+        self._replies = [_read_ok] + self._replies + [_read_ok]
+        try:
+            results = Pipeline.execute(self)
+        finally:
+            self.rollback()
+        for result in results:
+            if isinstance(result, ResponseError):
+                if result is results[0] or result is results[-1]:
+                    # TSTART or TCOMMIT itself; nothing was committed
+                    raise result
+                results = results[1:-1]
+                rejected = len([r for r in results if isinstance(r, ResponseError)])
+                raise CommitError("Committed, but %d of %d writes were rejected: %s" %
+                                  (rejected, len(results), result), results)
+        return results[1:-1]
+
+    execute = commit
+
+    def rollback(self):
+        """
+        Discards the buffered writes.
+        """
+        self.reset()
+        self._values = {}
+        self._deltas = {}
+        self._killed = []
+
+def _write_key(node, subscripts):
+    # The same key however the node is spelt: a node name read from a
+    # binary M, or a canonical number given as a string
+    if not isinstance(node, _string_types):
+        node = _decode(node)
+    return node, tuple([_canonic_subscript(s) for s in subscripts])
+
+def _canonic_subscript(subscript):
+    text = encode_subscript(subscript)
+    if text[0] == '"' and text != '"-0"' and _CANONIC_NUMBER.match(text[1:-1]):
+        # "1" is the same subscript as 1
+        return text[1:-1]
+    return text
+
+_NUMERIC_PREFIX = re.compile(r'^[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)')
+
+def _number_value(text):
+    # The number M takes a value to be: its leading number, or 0
+    if text is not None and not isinstance(text, _string_types):
+        text = _decode(text)
+    match = _NUMERIC_PREFIX.match(text or '')
+    if match is None:
+        return 0
+    return decimal.Decimal(match.group())
+
+class HashRing(object):
+    """
+    A consistent hash ring. Each member is hashed onto the ring at
+    replicas points and a key belongs to the first member point at or
+    after the key's own hash, so adding or removing a member only moves
+    the keys between its points and their predecessors, about 1/n of
+    them.
+    """
+
+    def __init__(self, members=(), replicas=100):
+        self.replicas = replicas
+        self._hashes = []
+        self._members = {}
+        for member in members:
+            self.add(member)
+
+    def __len__(self):
+        return len(set(self._members.values()))
+
+    def add(self, member):
+        for i in range(self.replicas):
+            point = _ring_hash('%s-%d' % (member, i))
+            if point not in self._members:
+                bisect.insort(self._hashes, point)
+            self._members[point] = member
+
+    def remove(self, member):
+        for point in [p for p, m in self._members.items() if m == member]:
+            del self._members[point]
+            self._hashes.pop(bisect.bisect_left(self._hashes, point))
+
+    def get(self, key):
+        if not self._hashes:
+            raise MWireError("The hash ring is empty")
+        index = bisect.bisect_left(self._hashes, _ring_hash(key))
+        if index == len(self._hashes):
+            index = 0
+        return self._members[self._hashes[index]]
+
+class ShardedM(object):
+    """
+    Spreads globals over several M/Wire servers, each command going to the
+    server a HashRing picks for its global:
+
+        m = ShardedM([('db1', 6330), ('db2', 6330), ('db3', 6330)])
+        m.set('orders', [42], 'pending')
+
+    With shard_by_subscript set, a global's first level subscripts are
+    spread over the servers instead, test1[1,...] and test1[2,...] likely
+    living on different servers. Commands on the whole global are then
+    sent to every server and their replies combined: kill, exists, lock,
+    unlock, the next, previous, getallsubs, iter_allsubs and iter_keys
+    of the first level, and getsubtree, getsubtree_array and iter_subtree,
+    whose rows are merged in collation order. The
+    node after any other, as query and queryget return it, may be below
+    another first level subscript and so on another server; they ask
+    every server and return the first node in collation order.
+
+    ping, halt, connect and disconnect go to every server. mset,
+    get_many, exists_many and pipelines split their commands by server and
+    run them on all servers in parallel. monitor() and transaction() would
+    need the servers' changes merged, or a commit made on several servers
+    at once, and raise ToDoError. Any other keyword arguments are passed
+    on to each M.
+    """
+
+    def __init__(self, servers, shard_by_subscript=False, replicas=100,
+                 **kwargs):
+        self.shard_by_subscript = shard_by_subscript
+        self._kwargs = kwargs
+        self.shards = {}
+        self.ring = HashRing(replicas=replicas)
+        for host, port in servers:
+            self.add_server(host, port)
+
+    def add_server(self, host, port):
+        """
+        Adds a server to the ring. The keys that now hash to it are not
+        moved there; that is left to the caller, e.g. with mwire-dump.
+        """
+        name = '%s:%s' % (host, port)
+        self.shards[name] = M(host, port, **self._kwargs)
+        self.ring.add(name)
+
+    def remove_server(self, host, port):
+        name = '%s:%s' % (host, port)
+        self.ring.remove(name)
+        self.shards.pop(name).disconnect()
+
+    def shard(self, node, subscripts=None):
+        """
+        Returns the M holding node[subscripts], or None if subscripts is
+        empty and the global is spread over every server.
+        """
+        if not self.shard_by_subscript:
+            return self.shards[self.ring.get(node)]
+        if not subscripts:
+            return None
+        return self.shards[self.ring.get(_shard_key(node, subscripts[0]))]
+
+    def _root(self, node):
+        # The server holding the global's unsubscripted value
+        return self.shards[self.ring.get(node)]
+
+    def _all(self, name, *args):
+        shards = list(self.shards.values())
+        return _parallel([_bound(getattr(s, name), *args) for s in shards])
+
+    def _routed(name):
+        def method(self, node, subscripts, *args, **kwargs):
+            subscripts = list(subscripts)
+            shard = self.shard(node, subscripts)
+            if shard is None:
+                # The whole of a global spread over every server
+                spanning = getattr(self, '_spanning_' + name, None)
+                if spanning is None:
+                    shard = self._root(node)
+                else:
+                    return spanning(node, subscripts, *args, **kwargs)
+            return getattr(shard, name)(node, subscripts, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = getattr(M, name).__doc__
+        return method
+
+    def _unsharded(name):
+        # Sent to every server, True only if they all succeed
+        def method(self):
+            return all(self._all(name))
+        method.__name__ = name
+        return method
+
+    decrement = _routed('decrement')
+    decrement_by = _routed('decrement_by')
+    exists = _routed('exists')
+    get = _routed('get')
+    getallsubs = _routed('getallsubs')
+    getsubtree = _routed('getsubtree')
+    getsubtree_array = _routed('getsubtree_array')
+    halt = _unsharded('halt')
+    increment = _routed('increment')
+    increment_by = _routed('increment_by')
+    iter_allsubs = _routed('iter_allsubs')
+    iter_keys = _routed('iter_keys')
+    iter_subtree = _routed('iter_subtree')
+    kill = _routed('kill')
+    lock = _routed('lock')
+    mset = _routed('mset')
+    ping = _unsharded('ping')
+    set = _routed('set')
+    unlock = _routed('unlock')
+
+    del _routed, _unsharded
+
+    def connect(self):
+        self._all('connect')
+
+    def disconnect(self):
+        self._all('disconnect')
+
+    def setsubtree(self, node, subscripts, data):
+        return self.mset(node, subscripts, data).failed == 0
+
+    def locked(self, node, subscripts, timeout=None):
+        return _locked(self, node, subscripts, timeout)
+
+    def unlock_all(self):
+        # On this thread, whose locks they are
+        return sum([m.unlock_all() for m in self.shards.values()])
+
+    def exists_many(self, node, keys, chunk_size=50, concurrency=4):
+        return self._many('exists_many', node, keys, chunk_size, concurrency)
+
+    def get_many(self, node, keys, chunk_size=50, concurrency=4):
+        return self._many('get_many', node, keys, chunk_size, concurrency)
+
+    def _many(self, name, node, keys, *args):
+        # Each server's share of the keys, fetched from them all in parallel
+        keys = [tuple(_subscript_list(key)) for key in keys]
+        shares = OrderedDict()
+        results = {}
+        for key in keys:
+            shard = self.shard(node, key)
+            if shard is None:
+                # The whole global, as exists() or get() would answer
+                results[key] = getattr(self, name[:-len('_many')])(node, [])
+                continue
+            shares.setdefault(id(shard), (shard, []))[1].append(key)
+        for replies in _parallel([_bound(getattr(shard, name), node, share, *args)
+                                  for shard, share in shares.values()]):
+            results.update(replies)
+        return OrderedDict([(key, results[key]) for key in keys])
+
+    def monitor(self, callback=None, max_queued=10000):
+        # A MONITOR connection to every server, their changes merged
+        raise ToDoError()
+
+    def transaction(self):
+        # Writes on different servers cannot be committed together
+        raise ToDoError()
+
+    def pipeline(self, flush_size=1000):
+        """
+        Returns a ShardedPipeline queuing commands on a Pipeline per
+        server, which are executed in parallel.
+        """
+        return ShardedPipeline(self, flush_size)
+
+    # Whole globals spread over every server
+
+    def _spanning_exists(self, node, subscripts):
+        shards = list(self.shards.values())
+        results = _parallel([_bound(s.exists, node, subscripts) for s in shards])
+        # The unsubscripted value is only ever set on the root server
+        value = results[shards.index(self._root(node))] % 10
+        return value + (10 if max(results) >= 10 else 0)
+
+    def _spanning_kill(self, node, subscripts):
+        return all(self._all('kill', node, subscripts))
+
+    def _spanning_lock(self, node, subscripts, timeout=None):
+        # Locked on every server, always in the order of their names so
+        # that two clients locking the whole global cannot each end up
+        # holding part of it
+        deadline = None if timeout is None else time.time() + timeout
+        taken = []
+        try:
+            for name in sorted(self.shards):
+                remaining = None
+                if deadline is not None:
+                    remaining = max(0, deadline - time.time())
+                if not self.shards[name].lock(node, subscripts, remaining):
+                    return False
+                taken.append(self.shards[name])
+            taken = []
+            return True
+        finally:
+            for shard in taken:
+                shard.unlock(node, subscripts)
+
+    def _spanning_unlock(self, node, subscripts):
+        for name in sorted(self.shards):
+            self.shards[name].unlock(node, subscripts)
+        return True
+
+    def _spanning_getallsubs(self, node, subscripts):
+        items = []
+        for result in self._all('getallsubs', node, subscripts):
+            items.extend(result)
+        items.sort(key=lambda item: _collation_key(item[0]))
+        return items
+
+    def _spanning_iter_allsubs(self, node, subscripts):
+        return iter(self._spanning_getallsubs(node, subscripts))
+
+    def _spanning_getsubtree(self, node, subscripts):
+        rows = []
+        for result in self._all('getsubtree', node, subscripts):
+            rows.extend(result)
+        rows.sort(key=lambda row: _subtree_key(row[0]))
+        return rows
+
+    def _spanning_iter_subtree(self, node, subscripts):
+        return iter(self._spanning_getsubtree(node, subscripts))
+
+    def _spanning_getsubtree_array(self, node, subscripts, key_dtype='float64',
+                                   value_dtype='float64'):
+        # Built from the merged rows, as each server's arrays hold only the
+        # last subscripts and not the first level ones to merge them by
+        import numpy
+        keys = []
+        values = []
+        numeric_values = numpy.dtype(value_dtype).kind in 'biufc'
+        for relative, value in self._spanning_getsubtree(node, subscripts):
+            if relative is None:
+                # node[subscripts] itself
+                continue
+            if not isinstance(relative, _string_types):
+                relative = _decode(relative)
+            keys.append(decode_subscripts(relative)[-1])
+            if value is not None and not isinstance(value, _string_types):
+                value = _decode(value)
+            if not value:
+                value = 'nan' if numeric_values else ''
+            values.append(value)
+        return numpy.array(keys, key_dtype), numpy.array(values, value_dtype)
+
+    def _spanning_iter_keys(self, node, subscripts, reverse=False,
+                            prefetch=100, start=None, stop=None):
+        keys = []
+        for shard in self.shards.values():
+            keys.extend(shard.iter_keys(node, subscripts, reverse, prefetch,
+                                        start, stop))
+        keys.sort(key=_collation_key, reverse=reverse)
+        return iter(keys)
+
+    def _next_previous(self, name, node, subscripts, choose):
+        if len(subscripts) != 1 or not self.shard_by_subscript:
+            shard = self.shard(node, subscripts) or self._root(node)
+            return getattr(shard, name)(node, subscripts)
+        keys = [k for k in self._all(name, node, subscripts) if k is not None]
+        if not keys:
+            return None
+        return choose(keys, key=_collation_key)
+
+    def next(self, node, subscripts):
+        return self._next_previous('next', node, list(subscripts), min)
+
+    def query(self, node, subscripts):
+        return self._query('query', node, subscripts, lambda reply: reply)
+
+    def queryget(self, node, subscripts):
+        return self._query('queryget', node, subscripts, lambda reply: reply[0])
+
+    def _query(self, name, node, subscripts, reference):
+        subscripts = list(subscripts)
+        if not self.shard_by_subscript:
+            return getattr(self.shard(node), name)(node, subscripts)
+        replies = [r for r in self._all(name, node, subscripts)
+                   if reference(r) is not None]
+        if not replies:
+            return getattr(self._root(node), name)(node, subscripts)
+        return min(replies, key=lambda reply: _reference_key(reference(reply)))
+
+    def previous(self, node, subscripts):
+        return self._next_previous('previous', node, list(subscripts), max)
+
+    def _spanning_mset(self, node, subscripts, items, chunk_size=1000,
+                       setsubtree=False, progress=None):
+        # Each chunk is split by the server of its first subscripts
+        result = LoadResult()
+        started = time.time()
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                break
+            chunks = {}
+            for relative, value in chunk:
+                relative = _subscript_list(relative)
+                shard = self.shard(node, relative) or self._root(node)
+                chunks.setdefault(shard, []).append((relative, value))
+            calls = [_bound(shard.mset, node, subscripts, shard_items,
+                            chunk_size, setsubtree)
+                     for shard, shard_items in chunks.items()]
+            for loaded in _parallel(calls):
+                result.count += loaded.count
+                result.failed += loaded.failed
+            result.seconds = time.time() - started
+            if progress is not None:
+                progress(result)
+        result.seconds = time.time() - started
+        return result
+
+class ShardedPipeline(object):
+    """
+    Queues commands on a Pipeline for each server of a ShardedM. execute()
+    executes those pipelines in parallel and returns every result in the
+    order the commands were queued. Commands whose reply may come from any
+    server of a global spread over them all cannot be pipelined and raise
+    ToDoError: those on the whole global, query and queryget, and next and
+    previous of the first level.
+    """
+
+    def __init__(self, sharded, flush_size=1000):
+        self._sharded = sharded
+        self.flush_size = flush_size
+        # Whether the last execute() wrote anything to any server
+        self.sent = False
+        self._pipelines = {}
+        # (pipeline, position in its results) of each queued command
+        self._order = []
+        self._counts = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    def _pipeline(self, shard):
+        pipeline = self._pipelines.get(shard)
+        if pipeline is None:
+            pipeline = self._pipelines[shard] = shard.pipeline(self.flush_size)
+            self._counts[shard] = 0
+        return pipeline
+
+    def _routed(name):
+        def method(self, node, subscripts, *args):
+            subscripts = list(subscripts)
+            shard = self._sharded.shard(node, subscripts)
+            if self._sharded.shard_by_subscript and (
+                    shard is None or name in ('query', 'queryget') or
+                    (name in ('next', 'previous') and len(subscripts) == 1)):
+                raise ToDoError()
+            if shard is None:
+                shard = self._sharded._root(node)
+            getattr(self._pipeline(shard), name)(node, subscripts, *args)
+            self._order.append((shard, self._counts[shard]))
+            self._counts[shard] += 1
+            return self
+        method.__name__ = name
+        return method
+
+    decrement = _routed('decrement')
+    decrement_by = _routed('decrement_by')
+    exists = _routed('exists')
+    get = _routed('get')
+    getallsubs = _routed('getallsubs')
+    getsubtree = _routed('getsubtree')
+    increment = _routed('increment')
+    increment_by = _routed('increment_by')
+    kill = _routed('kill')
+    next = _routed('next')
+    previous = _routed('previous')
+    query = _routed('query')
+    queryget = _routed('queryget')
+    set = _routed('set')
+
+    del _routed
+
+    def execute(self):
+        pipelines = list(self._pipelines.items())
+        order = self._order
+        self._pipelines, self._order, self._counts = {}, [], {}
+        try:
+            results = dict(zip([shard for shard, p in pipelines],
+                               _parallel([p.execute for shard, p in pipelines])))
+        finally:
+            self.sent = any([p.sent for shard, p in pipelines])
+        return [results[shard][position] for shard, position in order]
+
+    def reset(self):
+        for pipeline in self._pipelines.values():
+            pipeline.reset()
+        self._pipelines = {}
+        self._order = []
+        self._counts = {}
+
+class _LockTable(object):
+    # The locks an M holds, keyed by (node, subscripts tuple) with their
+    # owning thread and count. The server ties a lock to the connection
+    # that took it, so they are all taken and released on one connection
+    # of their own; if it is lost the server drops them and so does the
+    # table.
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._connection = None
+        # Serialises the commands on the connection
+        self._sending = threading.Lock()
+        self._condition = threading.Condition()
+        self._held = {}
+
+    def _call(self, reply, lines):
+        with self._sending:
+            if self._connection is None:
+                pool = self._pool
+                self._connection = pool.connection_class(pool.host, pool.port,
+                                                         **pool.connection_kwargs)
+            try:
+                return _call(self._connection, reply, lines)
+            except ConnectionError:
+                with self._condition:
+                    self._held.clear()
+                    self._condition.notify_all()
+                raise
+
+    def _conflict(self, key, thread):
+        # Whether another thread holds key, an ancestor or a descendant
+        node, subscripts = key
+        for (held_node, held), entry in self._held.items():
+            if held_node != node or entry[0] is thread:
+                continue
+            level = min(len(held), len(subscripts))
+            if held[:level] == subscripts[:level]:
+                return True
+        return False
+
+    def acquire(self, node, subscripts, timeout=None):
+        key = (node, tuple(subscripts))
+        thread = threading.current_thread()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            entry = self._held.get(key)
+            if entry is not None and entry[0] is thread:
+                entry[1] += 1
+                return True
+            while self._conflict(key, thread):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+            # Claimed, with no holds yet, while the server is asked
+            self._held[key] = [thread, 0]
+        acquired = False
+        try:
+            text = 'LOCK ' + encode_reference(node, subscripts) + ' 0'
+            delay = 0.001
+            # Another client holds it; try again until the deadline
+            while not self._call(_read_integer, [text]):
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    delay = min(delay, remaining)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.1)
+            acquired = True
+            return True
+        finally:
+            with self._condition:
+                if acquired and key in self._held:
+                    self._held[key][1] = 1
+                else:
+                    self._held.pop(key, None)
+                    self._condition.notify_all()
+
+    def release(self, node, subscripts):
+        key = (node, tuple(subscripts))
+        with self._condition:
+            entry = self._held.get(key)
+            if entry is None or entry[0] is not threading.current_thread() \
+                    or not entry[1]:
+                raise LockError("%s is not locked by this thread" %
+                                encode_reference(node, subscripts))
+            entry[1] -= 1
+            if entry[1]:
+                return True
+        self._release([key])
+        return True
+
+    def release_all(self):
+        thread = threading.current_thread()
+        with self._condition:
+            keys = [key for key, entry in self._held.items()
+                    if entry[0] is thread and entry[1]]
+            for key in keys:
+                # Every hold, re-entrant or not
+                self._held[key][1] = 0
+        return self._release(keys)
+
+    def _release(self, keys):
+        # Unlocks keys, whose holds are all released, in one round trip
+        if not keys:
+            return 0
+        lines = ['UNLOCK ' + encode_reference(*key) for key in keys]
+        try:
+            self._call(lambda connection: [_read_ok(connection) for key in keys],
+                       lines)
+        finally:
+            with self._condition:
+                for key in keys:
+                    self._held.pop(key, None)
+                self._condition.notify_all()
+        return len(keys)
+
+@contextmanager
+def _locked(m, node, subscripts, timeout):
+    if not m.lock(node, subscripts, timeout):
+        raise LockError("Timed out locking " + encode_reference(node, subscripts))
+    try:
+        yield m
+    finally:
+        m.unlock(node, subscripts)
+
+def _ring_hash(key):
+    return struct.unpack('>Q', hashlib.md5(_encode(key)).digest()[:8])[0]
+
+def _shard_key(node, subscript):
+    # 1 and "1" are the same subscript so must go to the same server
+    kind, value = _collation_key(subscript)
+    if kind == 0:
+        value = encode_number(value)
+    return node + '[' + value + ']'
+
+def _bound(function, *args):
+    return lambda: function(*args)
+
+def _parallel(calls):
+    # Runs the calls on a thread each, returning their results in order
+    # and raising the first error
+    if len(calls) == 1:
+        return [calls[0]()]
+    results = [None] * len(calls)
+    errors = []
+    def work(index, call):
+        try:
+            results[index] = call()
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(i, call))
+               for i, call in enumerate(calls)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+class ReplicatedM(object):
+    """
+    Sends writes to a primary M/Wire server and spreads reads over its
+    replicas, each read going to the replica with the fewest reads still
+    outstanding:
+
+        m = ReplicatedM(('db1', 6330), [('db2', 6330), ('db3', 6330)])
+
+    Replicas lag the primary, so a read straight after a write may not
+    see it. With read_your_writes set to a number of seconds, reads of a
+    node written within that window, and of its ancestors, descendants
+    and siblings, go to the primary instead. Pipelines, transactions and
+    monitor() use the primary, where every write is made. Any other
+    keyword arguments are passed on to each M.
+    """
+
+    def __init__(self, primary, replicas, read_your_writes=None, **kwargs):
+        self.primary = M(primary[0], primary[1], **kwargs)
+        self.replicas = [M(host, port, **kwargs) for host, port in replicas]
+        self.read_your_writes = read_your_writes
+        self._lock = threading.Lock()
+        self._outstanding = [0] * len(self.replicas)
+        self._turn = 0
+        # (node, encoded subscripts): expiry of the nodes written within
+        # the window, and of every ancestor of one
+        self._written = {}
+        self._ancestors = {}
+        # (expiry, table, key) of both in the order they expire
+        self._expiries = deque()
+
+    def _replica(self, node, scope, claim=True):
+        # Returns (index, M) of the server to read node[scope] from, with
+        # claim counting the read as outstanding on it
+        if not self.replicas or self._pinned(node, scope):
+            return None, self.primary
+        with self._lock:
+            # Ties go round robin
+            outstanding = self._outstanding
+            count = len(outstanding)
+            self._turn = (self._turn + 1) % count
+            index = min([(self._turn + i) % count for i in range(count)],
+                        key=outstanding.__getitem__)
+            if claim:
+                outstanding[index] += 1
+        return index, self.replicas[index]
+
+    def _claim(self, index):
+        if index is not None:
+            with self._lock:
+                self._outstanding[index] += 1
+
+    def _done(self, index):
+        if index is not None:
+            with self._lock:
+                self._outstanding[index] -= 1
+
+    def _expire(self, now):
+        # Drops the entries whose window has passed; called holding _lock
+        expiries = self._expiries
+        while expiries and expiries[0][0] < now:
+            expires, table, key = expiries.popleft()
+            if table.get(key) == expires:
+                del table[key]
+
+    def _pinned(self, node, scope):
+        # Whether node[scope], an ancestor or a descendant was written
+        # within the window, in as many lookups as scope has levels
+        if not self.read_your_writes:
+            return False
+        node, scope = _write_key(node, scope)
+        with self._lock:
+            self._expire(time.time())
+            if not self._written:
+                return False
+            if (node, scope) in self._ancestors:
+                return True
+            for level in range(len(scope) + 1):
+                if (node, scope[:level]) in self._written:
+                    return True
+        return False
+
+    def _wrote(self, node, subscripts):
+        if not self.read_your_writes:
+            return
+        node, subscripts = _write_key(node, subscripts)
+        now = time.time()
+        expires = now + self.read_your_writes
+        entries = [(self._written, (node, subscripts))]
+        entries.extend([(self._ancestors, (node, subscripts[:level]))
+                        for level in range(len(subscripts))])
+        with self._lock:
+            self._expire(now)
+            for table, key in entries:
+                table[key] = expires
+                self._expiries.append((expires, table, key))
+
+    def _write(name):
+        def method(self, node, subscripts, *args, **kwargs):
+            try:
+                return getattr(self.primary, name)(node, subscripts, *args, **kwargs)
+            finally:
+                self._wrote(node, subscripts)
+        method.__name__ = name
+        method.__doc__ = getattr(M, name).__doc__
+        return method
+
+    def _read(name, sibling=False, level=None):
+        # sibling reads scan the level holding subscripts[-1]; level reads
+        # are confined to the first levels of the global
+        def method(self, node, subscripts, *args, **kwargs):
+            scope = tuple(subscripts)
+            if sibling:
+                scope = scope[:-1]
+            if level is not None:
+                scope = scope[:level]
+            iterate = name.startswith('iter_')
+            index, m = self._replica(node, scope, not iterate)
+            if iterate:
+                # Outstanding from its first item until it finishes, so a
+                # generator never started is never counted
+                return _counted(getattr(m, name)(node, subscripts, *args, **kwargs),
+                                self._claim, self._done, index)
+            try:
+                return getattr(m, name)(node, subscripts, *args, **kwargs)
+            finally:
+                self._done(index)
+        method.__name__ = name
+        method.__doc__ = getattr(M, name).__doc__
+        return method
+
+    decrement = _write('decrement')
+    decrement_by = _write('decrement_by')
+    exists = _read('exists')
+    # Any of the keys may have been written
+    exists_many = _read('exists_many', level=0)
+    get = _read('get')
+    get_many = _read('get_many', level=0)
+    getallsubs = _read('getallsubs')
+    getsubtree = _read('getsubtree')
+    getsubtree_array = _read('getsubtree_array')
+    increment = _write('increment')
+    increment_by = _write('increment_by')
+    iter_allsubs = _read('iter_allsubs')
+    iter_keys = _read('iter_keys')
+    iter_subtree = _read('iter_subtree')
+    kill = _write('kill')
+    lock = _write('lock')
+    mset = _write('mset')
+    next = _read('next', sibling=True)
+    previous = _read('previous', sibling=True)
+    # The next node may be anywhere further on in the global
+    query = _read('query', level=0)
+    queryget = _read('queryget', level=0)
+    set = _write('set')
+    setsubtree = _write('setsubtree')
+    unlock = _write('unlock')
+
+    del _write, _read
+
+    def _all(self):
+        return [self.primary] + self.replicas
+
+    def connect(self):
+        for m in self._all():
+            m.connect()
+
+    def disconnect(self):
+        for m in self._all():
+            m.disconnect()
+
+    def halt(self):
+        return all([m.halt() for m in self._all()])
+
+    def locked(self, node, subscripts, timeout=None):
+        return self.primary.locked(node, subscripts, timeout)
+
+    def ping(self):
+        return all([m.ping() for m in self._all()])
+
+    def unlock_all(self):
+        return self.primary.unlock_all()
+
+    def pipeline(self, flush_size=1000):
+        """
+        Returns a Pipeline on the primary; its reads see its own writes.
+        """
+        return self.primary.pipeline(flush_size)
+
+    def transaction(self):
+        return self.primary.transaction()
+
+    def monitor(self, callback=None, max_queued=10000):
+        return self.primary.monitor(callback, max_queued)
+
+def _counted(items, claim, done, index):
+    claim(index)
+    try:
+        for item in items:
+            yield item
+    finally:
+        done(index)
+
+class ReadCache(object):
+    """
+    A client side cache of GET, EXISTS and QUERY replies, enabled by
+    passing one to M:
+
+        m = M('localhost', 6330, cache=ReadCache(maxsize=5000, ttl=30))
+
+    Holds at most maxsize replies, evicting the least recently used, and
+    each for at most ttl seconds when ttl is given. Writes made through
+    the same client invalidate the replies they could change: GET of the
+    node written or killed, anything below a killed node, EXISTS of the
+    node and its ancestors, and every QUERY of the global.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # command text: (command, node, subscripts, expires, value),
+        # least recently used first
+        self._entries = OrderedDict()
+        # node: set of keys of _entries
+        self._nodes = {}
+        # Bumped by every invalidation so a reply read before a write
+        # completed is not cached after it
+        self.version = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the cached reply for a command, raising KeyError on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] is not None and entry[3] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            self.hits += 1
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[4]
+
+    def put(self, key, command, node, subscripts, value, version):
+        with self._lock:
+            if version != self.version:
+                return
+            if key in self._entries:
+                self._remove(key)
+            elif len(self._entries) >= self.maxsize:
+                self._remove(next(iter(self._entries)))
+            expires = None
+            if self.ttl is not None:
+                expires = time.time() + self.ttl
+            node, subscripts = _write_key(node, subscripts)
+            self._entries[key] = (command, node, subscripts, expires, value)
+            self._nodes.setdefault(node, set()).add(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        keys = self._nodes[entry[1]]
+        keys.discard(key)
+        if not keys:
+            del self._nodes[entry[1]]
+
+    def invalidate(self, node, subscripts, subtree=False):
+        """
+        Drops the replies a write to node[subscripts] could change; with
+        subtree, as for KILL, those for every node below it as well.
+        """
+        node, subscripts = _write_key(node, subscripts)
+        level = len(subscripts)
+        with self._lock:
+            self.version += 1
+            for key in list(self._nodes.get(node, ())):
+                command, node, cached, expires, value = self._entries[key]
+                if (command == 'QUERY' or cached == subscripts
+                        or (subtree and cached[:level] == subscripts)
+                        or (command == 'EXISTS' and subscripts[:len(cached)] == cached)):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            self._nodes.clear()
+
+class Monitor(object):
+    """
+    A subscription to the changes made on an M/Wire server by any client,
+    read with MONITOR on a connection of its own by a background thread:
+
+        monitor = m.monitor()
+        for node, subscripts, operation in monitor:
+            ...
+
+    Each change is a (node, subscripts, operation) tuple, operation being
+    the write command: SET, KILL, INCR and so on. Changes are passed to
+    callback from the background thread if given, and otherwise queued
+    for iteration or get(). A ReadCache, if given, first drops the
+    replies each change could affect.
+
+    At most max_queued changes are queued, None for no limit. Once that
+    many are waiting the oldest is dropped for each new one and counted
+    in dropped, so a reader that falls behind sees the latest changes.
+    With max_queued=0 nothing is queued, for a monitor kept only to
+    invalidate a ReadCache.
+
+    A lost connection is reopened after reconnect_delay seconds, doubling
+    up to max_reconnect_delay while attempts fail. Changes made while it
+    was down are not replayed, so a (None, None, 'RESYNC') change is
+    delivered once it is back and the ReadCache is cleared.
+    """
+
+    def __init__(self, host='localhost', port=6330, callback=None,
+                 cache=None, reconnect_delay=0.1, max_reconnect_delay=5,
+                 max_queued=10000, **connection_kwargs):
+        self.callback = callback
+        self.cache = cache
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_queued = max_queued
+        self.reconnects = 0
+        self.dropped = 0
+        # The last exception raised by callback
+        self.error = None
+        self._connection = Connection(host, port, **connection_kwargs)
+        # Changes may be far apart; close() unblocks the read instead
+        self._connection.socket_timeout = None
+        # Room for the None queued on close() when nothing else is queued
+        self._changes = queue.Queue(1 if max_queued == 0 else max_queued or 0)
+        self._stopped = threading.Event()
+        # Subscribed before returning so no later write is missed
+        self._subscribe()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        while True:
+            change = self._changes.get()
+            if change is None:
+                # Closed; leave the marker for any other iterator
+                self._changes.put(None)
+                return
+            yield change
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, timeout=None):
+        """
+        Returns the next change, raising queue.Empty if none arrives within
+        timeout seconds and None once closed.
+        """
+        change = self._changes.get(timeout=timeout)
+        if change is None:
+            self._changes.put(None)
+        return change
+
+    def close(self):
+        self._stopped.set()
+        sock = self._connection._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+        self._connection.disconnect()
+        self._put(None)
+
+    def _subscribe(self):
+        connection = self._connection
+        connection.connect()
+        connection.send_line('MONITOR')
+        if connection.read() != '+OK':
+            connection.disconnect()
+            raise ProtocolError()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                change = _read_monitor(self._connection)
+            except Exception:
+                if self._stopped.is_set():
+                    return
+                self._connection.disconnect()
+                if not self._reconnect():
+                    return
+                change = (None, None, 'RESYNC')
+            self._deliver(change)
+
+    def _reconnect(self):
+        # Returns True once subscribed again, False if closed first
+        delay = self.reconnect_delay
+        while not self._stopped.wait(delay):
+            try:
+                self._subscribe()
+            except Exception:
+                self._connection.disconnect()
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            self.reconnects += 1
+            return True
+        return False
+
+    def _deliver(self, change):
+        node, subscripts, operation = change
+        if self.cache is not None:
+            if node is None:
+                self.cache.clear()
+            else:
+                self.cache.invalidate(node, subscripts,
+                                      operation in ('KILL', 'SETSUBTREE'))
+        if self.callback is None:
+            if self.max_queued != 0:
+                self._put(change)
+            return
+        try:
+            self.callback(change)
+        except Exception as e:
+            self.error = e
+
+    def _put(self, change):
+        # Queues change, dropping the oldest rather than wait for a reader
+        while True:
+            try:
+                self._changes.put_nowait(change)
+                return
+            except queue.Full:
+                try:
+                    self._changes.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+class CounterAggregator(object):
+    """
+    Adds up increments and decrements of counters in memory and writes
+    each counter's total as a single INCRBY or DECRBY, all of them in one
+    pipeline, every interval seconds from a background thread:
+
+        counters = CounterAggregator(m, interval=1)
+        counters.increment('hits', ['home'])
+        counters.pending('hits', ['home']) # 1 until flushed
+
+    A flush is also started early once max_pending counters have deltas
+    waiting, and by flush() or close(). With flush_at_exit set the last
+    deltas are flushed when the interpreter exits. Deltas that fail to be
+    written for want of a connection are kept for the next flush; the
+    error is kept on error. If the connection is lost once they have been
+    sent, the server may or may not have applied them. They are not sent
+    again, which could count them twice, but are added to lost.
+    """
+
+    def __init__(self, m, interval=1.0, max_pending=1000, flush_at_exit=True):
+        self.m = m
+        self.interval = interval
+        self.max_pending = max_pending
+        self.flushes = 0
+        # Deltas sent by flushes that then failed
+        self.lost = 0
+        self.error = None
+        self._lock = threading.Lock()
+        # Only one flush at a time, so counters are written in order
+        self._flushing = threading.Lock()
+        # reference: [node, subscripts, delta]
+        self._deltas = {}
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._at_exit = None
+        if flush_at_exit:
+            self._at_exit = self.close
+            atexit.register(self._at_exit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def increment(self, node, subscripts):
+        self._add(node, subscripts, 1)
+
+    def increment_by(self, node, subscripts, amount):
+        self._add(node, subscripts, amount)
+
+    def decrement(self, node, subscripts):
+        self._add(node, subscripts, -1)
+
+    def decrement_by(self, node, subscripts, amount):
+        self._add(node, subscripts, -amount)
+
+    def _add(self, node, subscripts, amount):
+        reference = encode_reference(node, subscripts)
+        with self._lock:
+            entry = self._deltas.get(reference)
+            if entry is None:
+                entry = self._deltas[reference] = [node, list(subscripts), 0]
+                if len(self._deltas) >= self.max_pending:
+                    self._wake.set()
+            entry[2] += amount
+
+    def pending(self, node, subscripts):
+        """
+        Returns the delta of node[subscripts] not yet written.
+        """
+        with self._lock:
+            entry = self._deltas.get(encode_reference(node, subscripts))
+            return 0 if entry is None else entry[2]
+
+    def flush(self):
+        """
+        Writes every pending delta in one round trip, returning how many
+        counters were written.
+        """
+        with self._flushing:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+            entries = [entry for entry in deltas.values() if entry[2]]
+            if not entries:
+                return 0
+            p = self.m.pipeline(flush_size=0)
+            for node, subscripts, delta in entries:
+                p.increment_by(node, subscripts, delta)
+            try:
+                results = p.execute()
+            except Exception as e:
+                self.error = e
+                if getattr(p, 'sent', True):
+                    # Perhaps applied; at most once rather than twice
+                    self.lost += len(entries)
+                    raise
+                # Unwritten; merged back with those added since
+                for node, subscripts, delta in entries:
+                    self._add(node, subscripts, delta)
+                raise
+            self.flushes += 1
+            for result in results:
+                if isinstance(result, ResponseError):
+                    self.error = result
+            return len(entries)
+
+    def close(self):
+        """
+        Stops the background thread and flushes what is left.
+        """
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+        if self._at_exit is not None:
+            if hasattr(atexit, 'unregister'):
+                atexit.unregister(self._at_exit)
+            self._at_exit = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopped.is_set():
+                return
+            try:
+                self.flush()
+            except Exception:
+                # Kept on error and tried again next time
+                pass
+
+class WriteBehindQueue(object):
+    """
+    Takes set() and kill() calls without waiting for the server, and
+    writes them from a background thread in pipelined batches of up to
+    batch_size, on a connection of its own:
+
+        writes = WriteBehindQueue(m, max_pending=10000, full='drop')
+        writes.set('audit', [request_id], record)
+
+    Writes waiting to be sent are coalesced: a set replaces a waiting set
+    of the same node, and a kill replaces every waiting write at or below
+    its node. Once max_pending writes are waiting, full='block' makes
+    set() and kill() wait up to timeout seconds (None for as long as it
+    takes) for room, and full='drop' drops the write; either returns
+    whether the write was queued. A batch the server cannot be reached
+    for is retried, in order, until it is written or the queue closed.
+
+    Reads through m do not see writes still queued. metrics() reports
+    the queue depth and the latency of each batch.
+    """
+
+    def __init__(self, m, max_pending=10000, batch_size=1000, full='block',
+                 timeout=None, flush_at_exit=True):
+        if full not in ('block', 'drop'):
+            raise ValueError("full must be 'block' or 'drop'")
+        pool = m._pool
+        self.m = M(connection_pool=ConnectionPool(
+                       pool.host, pool.port, max_connections=1,
+                       connection_class=pool.connection_class,
+                       **pool.connection_kwargs),
+                   cache=m.cache, observers=m.observers, codec=m.codec)
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.full = full
+        self.timeout = timeout
+        self.latency = LatencyHistogram()
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.written = 0
+        self.lost = 0
+        self.batches = 0
+        self.errors = 0
+        # The last exception writing a batch, or the server's last
+        # ResponseError for a write
+        self.error = None
+        self._condition = threading.Condition()
+        # (_write_key, 'SET' or 'KILL'): (node, subscripts, value), oldest
+        # first
+        self._pending = OrderedDict()
+        self._in_flight = 0
+        self._stopped = False
+        # Set with _stopped, to cut short the wait before a retry
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self._at_exit = None
+        if flush_at_exit:
+            self._at_exit = self.close
+            atexit.register(self._at_exit)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set(self, node, subscripts, value):
+        return self._put('SET', node, subscripts, value)
+
+    def kill(self, node, subscripts):
+        return self._put('KILL', node, subscripts, None)
+
+    def _put(self, command, node, subscripts, value):
+        key = _write_key(node, subscripts)
+        with self._condition:
+            if self._stopped:
+                raise ConnectionError("The write-behind queue is closed")
+            if command == 'SET':
+                replaced = [(key, 'SET')]
+            else:
+                level = len(key[1])
+                replaced = [pending for pending in self._pending
+                            if pending[0][0] == key[0] and pending[0][1][:level] == key[1]]
+            removed = 0
+            for pending in replaced:
+                if self._pending.pop(pending, None) is not None:
+                    removed += 1
+            self.coalesced += removed
+            if not removed and len(self._pending) >= self.max_pending:
+                if not self._wait_for_room():
+                    self.dropped += 1
+                    return False
+            self._pending[(key, command)] = (node, list(subscripts), value)
+            self.queued += 1
+            self._condition.notify_all()
+            return True
+
+    def _wait_for_room(self):
+        # Called holding the condition
+        if self.full == 'drop':
+            return False
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while len(self._pending) >= self.max_pending:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            self._condition.wait(remaining)
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Waits until every queued write has been sent, returning False if
+        that takes longer than timeout seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending or self._in_flight:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self):
+        """
+        Sends what is queued, giving each batch one more try if the server
+        cannot be reached, and stops the background thread. Raises the
+        last error if any write was lost.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._closing.set()
+        self._thread.join()
+        if self._at_exit is not None:
+            if hasattr(atexit, 'unregister'):
+                atexit.unregister(self._at_exit)
+            self._at_exit = None
+        self.m.disconnect()
+        if self.lost:
+            raise self.error
+
+    def metrics(self):
+        """
+        Returns {'depth', 'in_flight', 'queued', 'coalesced', 'dropped',
+        'written', 'lost', 'batches', 'errors', 'p50', 'p99', 'p999'},
+        batch latencies being in seconds.
+        """
+        with self._condition:
+            return {
+                'depth': len(self._pending),
+                'in_flight': self._in_flight,
+                'queued': self.queued,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'written': self.written,
+                'lost': self.lost,
+                'batches': self.batches,
+                'errors': self.errors,
+                'p50': self.latency.percentile(50),
+                'p99': self.latency.percentile(99),
+                'p999': self.latency.percentile(99.9),
+            }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popitem(last=False))
+                self._in_flight = len(batch)
+                # Room for blocked writers
+                self._condition.notify_all()
+            self._send(batch)
+            with self._condition:
+                self._in_flight = 0
+                self._condition.notify_all()
+
+    def _send(self, batch):
+        delay = 0.1
+        while True:
+            try:
+                self._write(batch)
+                return
+            except Exception as e:
+                with self._condition:
+                    self.error = e
+                    self.errors += 1
+                    if self._stopped:
+                        self.lost += len(batch)
+                        return
+                self._closing.wait(delay)
+                delay = min(delay * 2, 5)
+
+    def _write(self, batch):
+        p = self.m.pipeline(flush_size=0)
+        for (key, command), (node, subscripts, value) in batch:
+            if command == 'SET':
+                p.set(node, subscripts, value)
+            else:
+                p.kill(node, subscripts)
+        started = _timer()
+        results = p.execute()
+        seconds = _timer() - started
+        with self._condition:
+            self.latency.add(seconds)
+            self.batches += 1
+            self.written += len(batch)
+            for result in results:
+                if isinstance(result, ResponseError):
+                    self.error = result
+                    self.errors += 1
+
+class LoadResult(object):
+    """
+    Progress of a bulk write by M.mset: the number of nodes written so
+    far, how many of them the server did not acknowledge, and the rate.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        # Nodes per second
+        if not self.seconds:
+            return 0.0
+        return self.count / self.seconds
+
+    def __repr__(self):
+        return '<LoadResult %d nodes, %d failed, %.0f nodes/s>' % \
+            (self.count, self.failed, self.rate)
+
+class CommandObserver(object):
+    """
+    Base class for the observers passed to M(observers=[...]). Both
+    callbacks do nothing; override either.
+
+    before_command is called as a command is about to be sent, with its
+    name (GET, SET, ... or PIPELINE for a flushed Pipeline) and the length
+    in bytes of its encoded reference. after_command is called once its
+    reply has been read, adding the bytes sent and received, the seconds
+    taken, and the exception raised or None if it succeeded.
+    """
+
+    def before_command(self, command, key_length):
+        pass
+
+    def after_command(self, command, key_length, sent, received, seconds,
+                      error):
+        pass
+
+class LatencyHistogram(object):
+    """
+    Counts latencies in buckets a quarter of a power of two wide, so a
+    percentile is known to within 19% whatever the spread of latencies,
+    in constant memory.
+    """
+    BUCKETS = 128
+
+    def __init__(self):
+        self.count = 0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, seconds):
+        microseconds = seconds * 1e6
+        if microseconds > 1:
+            index = min(int(math.log(microseconds, 2) * 4) + 1, self.BUCKETS - 1)
+        else:
+            index = 0
+        self.buckets[index] += 1
+        self.count += 1
+
+    def percentile(self, percent):
+        """
+        Returns the upper bound, in seconds, of the bucket holding the
+        given percentile, or None if nothing has been counted.
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+        total = 0
+        for index, count in enumerate(self.buckets):
+            total += count
+            if total >= rank:
+                return pow(2, index / 4.0) / 1e6
+
+class CommandStats(CommandObserver):
+    """
+    A CommandObserver collecting, per command, how many were sent, how
+    many failed, the bytes sent and received, and a LatencyHistogram:
+
+        stats = CommandStats()
+        m = M('localhost', 6330, observers=[stats])
+        ...
+        stats.summary()['GET']['p99']
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commands = {}
+
+    def after_command(self, command, key_length, sent, received, seconds,
+                      error):
+        with self._lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = _CommandCounts()
+            stats.errors += error is not None
+            stats.sent += sent
+            stats.received += received
+            stats.seconds += seconds
+            stats.latency.add(seconds)
+
+    def summary(self):
+        """
+        Returns {command: {'count', 'errors', 'sent', 'received', 'seconds',
+        'p50', 'p99', 'p999'}}, latencies being in seconds.
+        """
+        with self._lock:
+            summary = {}
+            for command, stats in self.commands.items():
+                summary[command] = {
+                    'count': stats.latency.count,
+                    'errors': stats.errors,
+                    'sent': stats.sent,
+                    'received': stats.received,
+                    'seconds': stats.seconds,
+                    'p50': stats.latency.percentile(50),
+                    'p99': stats.latency.percentile(99),
+                    'p999': stats.latency.percentile(99.9),
+                }
+            return summary
+
+    def reset(self):
+        with self._lock:
+            self.commands = {}
+
+class _CommandCounts(object):
+    def __init__(self):
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.seconds = 0.0
+        self.latency = LatencyHistogram()
+
+class _Observation(object):
+    # One command's progress through the observers
+    def __init__(self, observers, line, connection):
+        self.observers = observers
+        self.connection = connection
+        self.command, self.key_length = _command_key(line)
+        for observer in observers:
+            observer.before_command(self.command, self.key_length)
+        self.sent = connection.bytes_sent
+        self.received = connection.bytes_received
+        self.started = _timer()
+
+    def finish(self, error=None):
+        seconds = _timer() - self.started
+        sent = self.connection.bytes_sent - self.sent
+        received = self.connection.bytes_received - self.received
+        for observer in self.observers:
+            observer.after_command(self.command, self.key_length, sent,
+                                   received, seconds, error)
+
+def _command_key(line):
+    # GET test1["a b"] -> ('GET', 10); SET and INCRBY add a number after
+    # the reference
+    command, space, rest = line.partition(' ')
+    end = rest.rfind(']')
+    if end > -1:
+        key = rest[:end + 1]
+    else:
+        key = rest.split(' ', 1)[0]
+    return command, len(_encode(key))
+
+def _call(connection, reply, lines):
+    # Sends a command's lines and parses its reply
+    try:
+        connection.connect()
+        connection.send_lines(lines)
+        return reply(connection)
+    except ResponseError:
+        raise
+    except:
+        # Whatever is left unread would be taken as the next reply
+        connection.disconnect()
+        raise
+
+_CANONIC_NUMBER = re.compile(r'^-?(?:0|[1-9][0-9]*|[1-9][0-9]*\.[0-9]*[1-9]|\.[0-9]*[1-9])$')
+
+def _collation_key(subscript):
+    # Numbers collate before strings, a string holding a canonical
+    # number being the same subscript as that number
+    if isinstance(subscript, (bytes, bytearray, memoryview)) and \
+            not isinstance(subscript, _string_types):
+        # As a binary M returns them
+        subscript = _decode(subscript)
+    if isinstance(subscript, _string_types):
+        if not _CANONIC_NUMBER.match(subscript) or subscript == '-0':
+            return (1, subscript)
+        subscript = float(subscript)
+    return (0, subscript)
+
+def _reference_key(reference):
+    # Collation order of the node a QUERY reply names, test1[1,"x"]
+    if not isinstance(reference, _string_types):
+        reference = _decode(reference)
+    start = reference.find('[')
+    if start < 0:
+        return ()
+    return tuple([_collation_key(s) for s in decode_subscripts(reference[start + 1:-1])])
+
+def _subtree_key(relative):
+    # Collation order of a GETSUBTREE row's subscripts, the node itself
+    # (None) first
+    if relative is None:
+        return ()
+    if not isinstance(relative, _string_types):
+        relative = _decode(relative)
+    return tuple([_collation_key(s) for s in decode_subscripts(relative)])
+
+def _prefetch(items, size):
+    # Runs the items generator on a thread, up to size items ahead
+    items_queue = queue.Queue(size)
+    stopped = threading.Event()
+    end = object()
+    def work():
+        try:
+            for item in items:
+                while not stopped.is_set():
+                    try:
+                        items_queue.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                else:
+                    return
+            items_queue.put((end, None))
+        except Exception as e:
+            items_queue.put((end, e))
+    thread = threading.Thread(target=work)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = items_queue.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+def _subscript_list(subscripts):
+    # A single subscript or a list of them, None for no subscripts
+    if subscripts is None:
+        return []
+    if isinstance(subscripts, (list, tuple)):
+        return list(subscripts)
+    return [subscripts]
+
+class Codec(object):
+    """
+    Converts values between the application and the wire for an M created
+    with codec=. encode() is given each value set and returns text or
+    bytes to send; decode() is given each value read, as text, bytes or a
+    memoryview depending on how the connections read values, and None for
+    a node with no value. Both pass values through unchanged here.
+    """
+
+    def encode(self, value):
+        return value
+
+    def decode(self, data):
+        return data
+
+class TextCodec(Codec):
+    """
+    Text in an encoding other than UTF-8, for a binary M:
+
+        m = M('localhost', 6330, binary=True, codec=TextCodec('latin-1'))
+    """
+
+    def __init__(self, encoding, errors='strict'):
+        self.encoding = encoding
+        self.errors = errors
+
+    def encode(self, value):
+        return value.encode(self.encoding, self.errors)
+
+    def decode(self, data):
+        if data is None:
+            return None
+        return _bytes(data).decode(self.encoding, self.errors)
+
+def _decode_value(value, decode):
+    return decode(value)
+
+def _decode_pair(pair, decode):
+    # [reference, value], None at the end of the global
+    if pair is None:
+        return None
+    return [pair[0], decode(pair[1])]
+
+def _decode_pairs(pairs, decode):
+    # A list, or a generator when iterating
+    if isinstance(pairs, list):
+        return [_decode_pair(pair, decode) for pair in pairs]
+    return (_decode_pair(pair, decode) for pair in pairs)
+
+def _read_nothing(connection):
+    # HALT has no reply
+    return True
+
+def _read_pong(connection):
+    # +PONG
+    if connection.read() == '+PONG':
+        return True
+    else:
+        return False
+
+def _read_integer(connection):
+    # :0, :1, :10, :11
+    text = connection.read()
+    if text[0] != ':':
+        raise ProtocolError()
+    return int(text[1:])
+
+def _read_bulk(connection):
+    # $12
+    text = connection.read()
+    if text[0] != '$':
+        raise ProtocolError()
+    # $-1, $12
+    length = int(text[1:])
+    if length < 0:
+        return None
+    # sub2, 12.98, test1["a","C"]
+    return connection.read(length)
+
+def _read_get(connection):
+    # $5
+    text = connection.read()
+    if text[0] != '$':
+        raise ProtocolError()
+    # $-1
+    length = int(text[1:])
+    if length < 0:
+        return None
+    # $0
+    if length == 0:
+        # Read the last empty line, as an empty value
+        return connection.read(0)
+    # Hello World
+    return connection.read(length)
+
+def _read_getallsubs(connection):
+    return list(_iter_getallsubs(connection))
+
+def _iter_getallsubs(connection, sized=False):
+    # *7
+    text = connection.read()
+    if text[0] != '*':
+        raise ProtocolError()
+    if sized:
+        # The number of subscripts first
+        yield int(text[1:]) // 2
+    # Iterate the number of results
+    for i in range(0, int(text[1:]), 2):
+        item = [None, None]
+        # $1 - subscript
+        text = connection.read()
+        if text[0] != '$':
+            raise ProtocolError()
+        length = int(text[1:])
+        if length > -1:
+            item[0] = connection.read(length)
+            # $51 - data value
+            text = connection.read()
+            if text[0] != '$':
+                raise ProtocolError()
+            length = int(text[1:])
+            if length > -1:
+                item[1] = connection.read(length)
+        yield item
+
+def _read_getsubtree(connection):
+    return list(_iter_getsubtree(connection))
+
+def _iter_getsubtree(connection):
+    # *7
+    text = connection.read()
+    if text[0] != '*':
+        raise ProtocolError()
+    # Iterate the number of results
+    for i in range(0, int(text[1:]), 2):
+        # An empty value is sent as $-1
+        item = [None, connection.empty]
+        # $1 - subscript
+        text = connection.read()
+        if text[0] != '$':
+            raise ProtocolError()
+        length = int(text[1:])
+        if length > -1:
+            item[0] = connection.read(length)
+        # $51 - data value
+        text = connection.read()
+        if text[0] != '$':
+            raise ProtocolError()
+        length = int(text[1:])
+        if length > -1:
+            item[1] = connection.read(length)
+        yield item
+
+# Nodes parsed into the arrays at a time by getsubtree_array
+_ARRAY_CHUNK = 65536
+
+def _read_getsubtree_array(connection, numpy, key_dtype, value_dtype):
+    # *7
+    text = connection.read()
+    if text[0] != '*':
+        raise ProtocolError()
+    count = int(text[1:]) // 2
+    keys = numpy.empty(count, key_dtype)
+    values = numpy.empty(count, value_dtype)
+    # Numbers are gathered as space separated text and parsed a chunk at a
+    # time; other keys and values are decoded one by one
+    numeric_keys = key_dtype.kind in 'biuf'
+    numeric_values = value_dtype.kind in 'biufc'
+    key = bytearray()
+    value = bytearray()
+    key_text = bytearray()
+    value_text = bytearray()
+    key_list = []
+    value_list = []
+    filled = pending = 0
+    for i in range(count):
+        # $1 - subscript
+        del key[:]
+        if connection.read_bulk_into(key) == -1:
+            # node[subscripts] itself
+            connection.read_bulk_into(key)
+            continue
+        if numeric_keys:
+            key_text += key[key.rfind(b',') + 1:]
+            key_text += b' '
+        else:
+            key_list.append(decode_subscripts(_decode(key))[-1])
+        # $51 - data value
+        if numeric_values:
+            if connection.read_bulk_into(value_text) < 1:
+                value_text += b'nan'
+            value_text += b' '
+        else:
+            del value[:]
+            connection.read_bulk_into(value)
+            value_list.append(_decode(value))
+        pending += 1
+        if pending == _ARRAY_CHUNK:
+            _fill_array(numpy, keys, filled, pending, key_text, key_list)
+            _fill_array(numpy, values, filled, pending, value_text, value_list)
+            filled += pending
+            pending = 0
+    _fill_array(numpy, keys, filled, pending, key_text, key_list)
+    _fill_array(numpy, values, filled, pending, value_text, value_list)
+    filled += pending
+    return keys[:filled], values[:filled]
+
+def _fill_array(numpy, array, start, count, text, items=None):
+    # Puts count items, or count space separated numbers parsed from the
+    # bytearray text, into array[start:], emptying them
+    if items:
+        array[start:start + count] = items
+        del items[:]
+        return
+    try:
+        parsed = numpy.fromstring(bytes(text), array.dtype, sep=' ')
+    except ValueError:
+        # Older releases stop at the first bad number instead
+        parsed = ()
+    if len(parsed) != count:
+        raise ProtocolError("Not all %s: %r" % (array.dtype, bytes(text[:80])))
+    array[start:start + count] = parsed
+    del text[:]
+
+def _read_monitor(connection):
+    # +SET test1["a","b"]
+    text = connection.read()
+    if text[:1] != '+' or ' ' not in text:
+        raise ProtocolError(text)
+    operation, reference = text[1:].split(' ', 1)
+    start = reference.find('[')
+    if start < 0:
+        return reference, [], operation
+    if reference[-1:] != ']':
+        raise ProtocolError(text)
+    return reference[:start], decode_subscripts(reference[start + 1:-1]), operation
+
+def _read_ok(connection):
+    # +OK
+    text = connection.read()
+    if text not in ('+OK', '+ok'):
+        raise ProtocolError(text)
+    return True
+
+def _read_kill(connection):
+    text = connection.read()
+    # +ok
+    if text == '+ok':
+        return True
+    else:
+        return False
+
+def _read_queryget(connection):
+    data = [None, None]
+    # *2, $-1
+    text = connection.read()
+    if text == '$-1':
+        pass
+    elif text != '*2':
+        raise ProtocolError()
+    else:
+        # $14 - node and subscript
+        text = connection.read()
+        if text[0] != '$':
+            raise ProtocolError()
+        length = int(text[1:])
+        data[0] = connection.read(length)
+        # $51 - data value
+        text = connection.read()
+        if text[0] != '$':
+            raise ProtocolError()
+        length = int(text[1:])
+        data[1] = connection.read(length)
+    return data
+
+def _read_setsubtree(connection):
+    text = connection.read()
+    # $11
+    if text[:1] == '$':
+        text = connection.read()
+    # {"ok":true}, +OK
+    if text in ('{"ok":true}', '+OK', '+ok'):
+        return True
+    else:
+        return False
+
+def _read_set(connection):
+    # $11
+    text = connection.read()
+    if text[0] != "$":
+        return False
+    text = connection.read()
+    # {"ok":true}
+    if text == '{"ok":true}':
+        return True
+    else:
+        return False
+
+# The most buffers handed to one sendmsg, below every platform's IOV_MAX
+_IOV_MAX = 512
+
+def _frame(lines, scatter=None):
+    # Joins the lines of a command, each followed by CRLF, into as few
+    # buffers as possible: one, unless scatter is given and lines of at
+    # least scatter bytes are left as buffers of their own. Returns the
+    # buffers and their total length.
+    buffers = []
+    pending = []
+    length = 0
+    for line in lines:
+        data = _encode_line(line)
+        length += len(data) + 2
+        if scatter is not None and len(data) >= scatter:
+            if pending:
+                buffers.append(b''.join(pending))
+            buffers.append(data)
+            pending = [CRLF_BYTES]
+        else:
+            if not isinstance(data, bytes):
+                data = _bytes(data)
+            pending.append(data)
+            pending.append(CRLF_BYTES)
+    if pending:
+        buffers.append(b''.join(pending))
+    return buffers, length
+
+def split_csv(line, *args, **kwargs):
+    try:
+        buffer = StringIO(line)
+        reader = csv.reader(buffer, *args, **kwargs)
+        return next(reader)
+    finally:
+        buffer.close()
+        
+class SocketLineReader(object):
+    """
+    Reads reply lines and values through a reusable bytearray filled with
+    recv_into. Lines are found by scanning the buffer for CRLF in place and
+    are decoded straight out of it. A value too large for the buffer is
+    received directly into a bytearray of its own, so no value is copied
+    more than once on its way to the caller.
+
+    With memoryviews set, values are returned as memoryviews over their own
+    bytes rather than decoded, for callers that can consume them directly,
+    and with binary set they are returned as bytes.
+    """
+    MAX_LENGTH = pow(2, 16) # 65,536
+
+    def __init__(self, memoryviews=False, binary=False):
+        self.memoryviews = memoryviews
+        self.binary = binary
+        # An empty value, as read() would return it
+        if memoryviews:
+            self.empty = memoryview(b'')
+        elif binary:
+            self.empty = b''
+        else:
+            self.empty = ''
+        self.bytes_received = 0
+        self._sock = None
+        self._buffer = bytearray(self.MAX_LENGTH)
+        self._view = memoryview(self._buffer)
+        # Unread bytes are self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+
+    def __del__(self):
+        try:
+            self.on_disconnect()
+        except:
+            pass
+
+    def on_connect(self, connection):
+        self._sock = connection._sock
+        self._start = self._end = 0
+
+    def on_disconnect(self):
+        self._sock = None
+        self._start = self._end = 0
+
+    def _fill(self):
+        # Make room after the unread bytes and receive into it, returning
+        # the number of bytes received; 0 once the server has closed.
+        unread = self._end - self._start
+        if self._start > 0:
+            self._view[:unread] = self._view[self._start:self._end]
+            self._start, self._end = 0, unread
+        elif self._end == len(self._buffer):
+            # A single line longer than the buffer
+            buffer = bytearray(2 * len(self._buffer))
+            buffer[:self._end] = self._buffer
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        received = self._sock.recv_into(self._view[self._end:])
+        self._end += received
+        self.bytes_received += received
+        return received
+
+    def _read_line(self):
+        position = self._start
+        while True:
+            end = self._buffer.find(CRLF_BYTES, position, self._end)
+            if end > -1:
+                start, self._start = self._start, end + 2
+                return _decode(self._view[start:end])
+            # The CR may already be buffered without its LF
+            scanned = max(0, self._end - self._start - 1)
+            if not self._fill():
+                # Closed; hand back what there is like file.readline()
+                start, self._start = self._start, self._end
+                return _decode(self._view[start:self._end])
+            position = self._start + scanned
+
+    def _read_length(self, length):
+        remaining = length + 2
+        if remaining <= len(self._buffer):
+            while self._end - self._start < remaining:
+                if not self._fill():
+                    raise ConnectionError("Socket closed reading a value")
+            start = self._start
+            end = start + length
+            self._start = start + remaining
+            if self.memoryviews:
+                return memoryview(bytearray(self._view[start:end]))
+            if self.binary:
+                return self._view[start:end].tobytes()
+            return _decode(self._view[start:end])
+        # Too large for the buffer: take what is already buffered, then
+        # receive the rest straight into the value's own bytearray.
+        data = bytearray(remaining)
+        view = memoryview(data)
+        received = min(self._end - self._start, remaining)
+        view[:received] = self._view[self._start:self._start + received]
+        self._start += received
+        while received < remaining:
+            count = self._sock.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Socket closed reading a value")
+            received += count
+            self.bytes_received += count
+        if self.memoryviews:
+            return view[:length]
+        if self.binary:
+            return view[:length].tobytes()
+        return _decode(view[:length])
+
+    def read_into(self, output, length):
+        """
+        Appends the next length bytes to the bytearray output as they are,
+        and skips the CRLF after them.
+        """
+        try:
+            remaining = length + 2
+            while remaining:
+                if self._start == self._end and not self._fill():
+                    raise ConnectionError("Socket closed reading a value")
+                taken = min(remaining, self._end - self._start)
+                data = min(taken, remaining - 2)
+                if data > 0:
+                    output += self._view[self._start:self._start + data]
+                self._start += taken
+                remaining -= taken
+        except (socket.error, socket.timeout) as e:
+            raise ConnectionError("Error while reading from socket: %s" % (e.args,))
+
+    def read_bulk_into(self, output):
+        """
+        Reads a $length line and the value after it, appending the value
+        to the bytearray output as it is. Returns the length, -1 for none.
+        """
+        try:
+            end = self._buffer.find(CRLF_BYTES, self._start, self._end)
+            if end > -1:
+                line = self._buffer[self._start:end]
+                self._start = end + 2
+            else:
+                line = _encode(self._read_line())
+            if line[:1] != b'$':
+                raise ProtocolError()
+            length = int(line[1:])
+            if length > -1:
+                if self._end - self._start >= length + 2:
+                    output += self._view[self._start:self._start + length]
+                    self._start += length + 2
+                else:
+                    self.read_into(output, length)
+            return length
+        except (socket.error, socket.timeout) as e:
+            raise ConnectionError("Error while reading from socket: %s" % (e.args,))
+
+    def read(self, length=None):
+        try:
+            if length is None:
+                response = self._read_line()
+                # -ERR unknown command
+                if response[:1] == '-':
+                    return ResponseError(response[1:])
+                return response
+            else:
+                return self._read_length(length)
+        except (socket.error, socket.timeout) as e:
+            raise ConnectionError("Error while reading from socket: %s" % (e.args,))
+
+class Connection(object):
+    """
+    A socket to an M/Wire server.
+
+    Every command is written in a single send so that Nagle's algorithm
+    never holds back the end of a command waiting for the ACK of its
+    start, and tcp_nodelay turns Nagle's algorithm off altogether.
+    keepalive turns on TCP keepalives, and if it is a number also sets
+    the seconds a connection is idle before they are sent where the
+    platform allows. send_buffer and receive_buffer set the socket buffer
+    sizes in bytes.
+    """
+    # Values at least this large are handed to sendmsg alongside the rest
+    # of the command rather than copied into it
+    SCATTER_SIZE = pow(2, 16) # 65,536
+
+    def __init__(self, host='localhost', port=6330, memoryviews=False,
+                 binary=False, tcp_nodelay=True, keepalive=False,
+                 send_buffer=None, receive_buffer=None):
+        self.host = host
+        self.port = port
+        self.socket_timeout = 5
+        self.tcp_nodelay = tcp_nodelay
+        self.keepalive = keepalive
+        self.send_buffer = send_buffer
+        self.receive_buffer = receive_buffer
+        self.bytes_sent = 0
+        self._sock = None
+        self._reader = SocketLineReader(memoryviews, binary)
+
+    @property
+    def bytes_received(self):
+        return self._reader.bytes_received
+
+    @property
+    def empty(self):
+        return self._reader.empty
+
+    def __del__(self):
+        try:
+            self.disconnect()
+        except:
+            pass
+
+    def connect(self):
+        if self._sock:
+            return
+        try:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.settimeout(self.socket_timeout)
+            self._set_options()
+            self._sock.connect((self.host, self.port))
+        except socket.error as e:
+            self._sock = None
+            raise ConnectionError(self._error_message(e))
+        self.on_connect()
+
+    def _set_options(self):
+        # Before connecting, so the buffer sizes count towards the window
+        sock = self._sock
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if self.keepalive is not True and hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                                int(self.keepalive))
+        if self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def _error_message(self, exception):
+        if len(exception.args) == 1:
+            return "Error connecting to %s:%s. %s." % \
+                (self.host, self.port, exception.args[0])
+        else:
+            return "Error %s connecting %s:%s. %s." % \
+                (exception.args[0], self.host, self.port, exception.args[1])
+
+    def on_connect(self):
+        self._reader.on_connect(self)
+
+    def disconnect(self):
+        self._reader.on_disconnect()
+        if self._sock is None:
+            return
+        try:
+            self._sock.close()
+        except socket.error:
+            pass
+        self._sock = None
+
+    def send_line(self, text):
+        self.send_lines([text])
+
+    def send_lines(self, lines):
+        """
+        Sends lines, text or bytes, each followed by CRLF, in one write.
+        """
+        scatter = self.SCATTER_SIZE if hasattr(self._sock, 'sendmsg') else None
+        buffers, length = _frame(lines, scatter)
+        try:
+            if len(buffers) == 1:
+                self._sock.sendall(buffers[0])
+            else:
+                self._sendmsg(buffers)
+            self.bytes_sent += length
+        except socket.error as e:
+            self.disconnect()
+            raise ConnectionError("Error while writing to socket: %s" % (e.args,))
+
+    def _sendmsg(self, buffers):
+        # sendall for a list of buffers, gathered by the kernel
+        buffers = [memoryview(buffer) for buffer in buffers]
+        while buffers:
+            sent = self._sock.sendmsg(buffers[:_IOV_MAX])
+            while sent:
+                if sent >= len(buffers[0]):
+                    sent -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][sent:]
+                    sent = 0
+
+    def read_bulk_into(self, output):
+        try:
+            return self._reader.read_bulk_into(output)
+        except:
+            self.disconnect()
+            raise
+
+    def read(self, length=None):
+        try:
+            response = self._reader.read(length)
+        except:
+            self.disconnect()
+            raise
+        if response.__class__ == ResponseError:
+            raise response
+        return response
+
+# Sockets a ConnectionPool opens at most unless given max_connections
+MAX_CONNECTIONS = 50
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of connections to one M/Wire server.
+
+    At most max_connections sockets are opened, MAX_CONNECTIONS by
+    default or any number if None. When they are all in use
+    get_connection() waits up to timeout seconds, or for as long as it
+    takes if None, for one to be released, or raises ConnectionError
+    straight away if block is False. Idle
+    connections unused for idle_timeout seconds are closed, and a forked
+    child process starts with an empty pool rather than sharing its
+    parent's sockets. Any other keyword arguments, such as memoryviews or
+    binary, are passed on to each new Connection.
+    """
+
+    def __init__(self, host='localhost', port=6330,
+                 max_connections=MAX_CONNECTIONS, block=True, timeout=None,
+                 idle_timeout=None, connection_class=Connection,
+                 **connection_kwargs):
+        self.host = host
+        self.port = port
+        self.connection_kwargs = connection_kwargs
+        self.max_connections = max_connections
+        self.block = block
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.connection_class = connection_class
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        # Most recently released last
+        self._available = []
+        self._in_use = set()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # The sockets belong to the parent process, leave them be
+            self._reset()
+
+    def _close_idle(self):
+        if self.idle_timeout is None:
+            return
+        expired = time.time() - self.idle_timeout
+        while self._available and self._available[0].last_used < expired:
+            self._available.pop(0).disconnect()
+
+    def get_connection(self):
+        self._check_pid()
+        self._condition.acquire()
+        try:
+            self._close_idle()
+            if not self._available:
+                self._wait()
+            if self._available:
+                connection = self._available.pop()
+            else:
+                connection = self.connection_class(self.host, self.port,
+                                                   **self.connection_kwargs)
+            self._in_use.add(connection)
+            return connection
+        finally:
+            self._condition.release()
+
+    def _wait(self):
+        # Called with the condition held and nothing available
+        if self.max_connections is None:
+            return
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while len(self._in_use) >= self.max_connections:
+            if not self.block:
+                raise ConnectionError("Too many connections")
+            if self.timeout is None:
+                self._condition.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConnectionError("Timed out waiting for a connection")
+                self._condition.wait(remaining)
+            if self._available:
+                return
+
+    def release(self, connection):
+        self._check_pid()
+        self._condition.acquire()
+        try:
+            if connection not in self._in_use:
+                # Checked out before a fork
+                return
+            self._in_use.remove(connection)
+            connection.last_used = time.time()
+            self._available.append(connection)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def disconnect(self):
+        """
+        Closes the sockets of the idle connections; they reconnect the
+        next time they are checked out.
+        """
+        self._condition.acquire()
+        try:
+            for connection in self._available:
+                connection.disconnect()
+        finally:
+            self._condition.release()
+
+class MWireError(Exception):
+    pass
+
+class ToDoError(MWireError):
+    pass
+
+class LockError(MWireError):
+    pass
+
+class ProtocolError(MWireError):
+    pass
+
+class ConnectionError(MWireError):
+    pass
+
+class ResponseError(MWireError):
+    pass
+
+class CommitError(ResponseError):
+    # A transaction was committed with some of its writes rejected;
+    # results holds the reply to each write, a ResponseError if rejected
+    def __init__(self, message, results):
+        ResponseError.__init__(self, message)
+        self.results = results
     
\ No newline at end of file
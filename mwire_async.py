@@ -0,0 +1,285 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
+
+# asyncio client for the M/Wire protocol, requires Python 3.5 or later.
+#
+# AsyncM shares mwire.M's command encoding and reply parsing: M builds each
+# command and hands it to _execute() along with the function that parses its
+# reply. AsyncM's _execute() writes the command to a stream straight away and
+# returns a coroutine that waits for the reply, so many requests can be in
+# flight on one connection. A reader task takes the raw reply frames off the
+# stream in order and runs the same parsing functions over them.
+
+import asyncio
+import collections
+import itertools
+import time
+
+import mwire
+
+CRLF = b'\r\n'
+
+
+class AsyncM(mwire.M):
+    """
+    asyncio implementation of the M/Wire protocol.
+
+    Every command method of mwire.M returns an awaitable here:
+
+        m = AsyncM('localhost', 6330)
+        await m.set('test1', ['a'], 'hello')
+        values = await asyncio.gather(*[m.get('test1', [i]) for i in range(100)])
+
+    Commands are pipelined on the stream rather than waiting for the
+    previous reply. With connections > 1 each command goes to the
+    connection with the fewest replies outstanding. binary and codec are
+    as for mwire.M.
+
+    The streaming iterators, transactions, locks and monitor() of mwire.M
+    hold a connection or a thread and raise ToDoError here.
+    """
+
+    def __init__(self, host='localhost', port=6330, connections=1,
+                 binary=False, codec=None):
+        self._connections = [AsyncConnection(host, port, binary)
+                             for i in range(connections)]
+        self.cache = None
+        self.codec = codec
+
+    async def connect(self):
+        for connection in self._connections:
+            await connection.connect()
+
+    async def disconnect(self):
+        for connection in self._connections:
+            await connection.disconnect()
+
+    def _execute(self, reply, *lines):
+        connection = min(self._connections, key=len)
+        return connection.execute(reply, lines)
+
+    async def _many(self, name, node, keys, chunk_size, concurrency):
+        # Commands are already pipelined, so every key is in flight at once
+        keys = [tuple(mwire._subscript_list(key)) for key in keys]
+        command = getattr(self, name)
+        replies = await asyncio.gather(
+            *[command(node, list(key)) for key in keys])
+        return collections.OrderedDict(zip(keys, replies))
+
+    async def mset(self, node, subscripts, items, chunk_size=1000,
+                   setsubtree=False, progress=None):
+        result = mwire.LoadResult()
+        started = time.time()
+        subscripts = list(subscripts)
+        items = iter(items)
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if not chunk:
+                break
+            if setsubtree:
+                if await self._setsubtree(node, subscripts, chunk) is not True:
+                    result.failed += len(chunk)
+            else:
+                # A None value has no node to set
+                replies = await asyncio.gather(
+                    *[self.set(node, subscripts + mwire._subscript_list(relative), value)
+                      for relative, value in chunk if value is not None],
+                    return_exceptions=True)
+                for reply in replies:
+                    if isinstance(reply, Exception) and \
+                            not isinstance(reply, mwire.ResponseError):
+                        raise reply
+                    if reply is not True:
+                        result.failed += 1
+            result.count += len(chunk)
+            result.seconds = time.time() - started
+            if progress is not None:
+                progress(result)
+        return result
+
+    async def setsubtree(self, node, subscripts, data):
+        result = await self.mset(node, subscripts, data)
+        return result.failed == 0
+
+    def iter_allsubs(self, node, subscripts):
+        # A generator cannot await its reply; use getallsubs()
+        raise mwire.ToDoError()
+
+    def iter_subtree(self, node, subscripts):
+        raise mwire.ToDoError()
+
+    def iter_keys(self, node, subscripts, reverse=False, prefetch=100,
+                  start=None, stop=None):
+        raise mwire.ToDoError()
+
+    def monitor(self, callback=None, max_queued=10000):
+        raise mwire.ToDoError()
+
+    def pipeline(self, flush_size=1000):
+        # Commands are already pipelined, gather them instead
+        raise mwire.ToDoError()
+
+    def transaction(self):
+        # Transaction queues onto a blocking Pipeline
+        raise mwire.ToDoError()
+
+    def transaction_start(self):
+        raise mwire.ToDoError()
+
+    def lock(self, node, subscripts, timeout=None):
+        # mwire.M's locks are held by threads, not tasks
+        raise mwire.ToDoError()
+
+    def locked(self, node, subscripts, timeout=None):
+        raise mwire.ToDoError()
+
+    def unlock(self, node, subscripts):
+        raise mwire.ToDoError()
+
+    def unlock_all(self):
+        raise mwire.ToDoError()
+
+
+class AsyncConnection(object):
+    def __init__(self, host='localhost', port=6330, binary=False):
+        self.host = host
+        self.port = port
+        self.binary = binary
+        self.socket_timeout = 5
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        # (reply, future) in the order the commands were written
+        self._waiting = collections.deque()
+        self._connect_lock = asyncio.Lock()
+        self._drain_lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port),
+                    self.socket_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise mwire.ConnectionError(
+                    "Error connecting to %s:%s. %s." % (self.host, self.port, e))
+            self._read_task = asyncio.ensure_future(self._read_replies())
+
+    async def disconnect(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        self._reader = None
+        await self._read_task
+
+    async def execute(self, reply, lines):
+        await self.connect()
+        writer = self._writer
+        data = CRLF.join([mwire._encode_line(line) for line in lines]) + CRLF
+        if reply is mwire._read_nothing:
+            writer.write(data)
+            return reply(None)
+        future = asyncio.get_event_loop().create_future()
+        # Queue the reply before writing so the reader task always finds it
+        self._waiting.append((reply, future))
+        writer.write(data)
+        async with self._drain_lock:
+            await writer.drain()
+        return await future
+
+    async def _read_replies(self):
+        reader = self._reader
+        try:
+            while True:
+                frame = await self._read_frame(reader)
+                reply, future = self._waiting.popleft()
+                if future.cancelled():
+                    continue
+                try:
+                    future.set_result(reply(FrameReader(frame, self.binary)))
+                except Exception as e:
+                    # The frame was read whole, so the stream is still in
+                    # step; only this command fails
+                    future.set_exception(e)
+        except (OSError, EOFError, asyncio.IncompleteReadError,
+                asyncio.CancelledError) as e:
+            error = mwire.ConnectionError(
+                "Error while reading from socket: %s" % (e.args,))
+        except Exception as e:
+            error = e
+        # Nothing more can be matched up, fail whatever is still waiting
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._reader = None
+        while self._waiting:
+            reply, future = self._waiting.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+    async def _read_frame(self, reader):
+        # Reads one complete reply: a single line, a $n bulk value, or a
+        # *n multi-bulk header followed by n bulk values.
+        line = await reader.readuntil(CRLF)
+        frame = [line]
+        if line[:1] == b'$':
+            length = int(line[1:-2])
+            if length > -1:
+                frame.append(await reader.readexactly(length + 2))
+        elif line[:1] == b'*':
+            for i in range(int(line[1:-2])):
+                line = await reader.readuntil(CRLF)
+                frame.append(line)
+                length = int(line[1:-2])
+                if length > -1:
+                    frame.append(await reader.readexactly(length + 2))
+        return b''.join(frame)
+
+
+class FrameReader(object):
+    """
+    Presents a reply already read off the stream through the same read()
+    interface as mwire.Connection, for mwire's reply parsing functions.
+    """
+
+    def __init__(self, data, binary=False):
+        self._data = data
+        self._binary = binary
+        self.empty = b'' if binary else ''
+        self._position = 0
+
+    def read(self, length=None):
+        start = self._position
+        if length is None:
+            end = self._data.find(CRLF, start)
+            if end < 0:
+                raise mwire.ProtocolError()
+            self._position = end + 2
+            response = mwire._decode(self._data[start:end])
+            # -ERR unknown command
+            if response[:1] == '-':
+                raise mwire.ResponseError(response[1:])
+            return response
+        self._position = start + length + 2
+        if self._binary:
+            return self._data[start:start + length]
+        return mwire._decode(self._data[start:start + length])
+
+    def read_bulk_into(self, output):
+        # $5, then the value appended to output as it is
+        line = mwire._encode(self.read())
+        if line[:1] != b'$':
+            raise mwire.ProtocolError()
+        length = int(line[1:])
+        if length > -1:
+            start = self._position
+            output += self._data[start:start + length]
+            self._position = start + length + 2
+        return length
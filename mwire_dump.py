@@ -0,0 +1,264 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
+
+"""
+Dumps a global to a file and restores it, over several connections at once.
+
+    python -m mwire_dump dump --workers 8 orders orders.dump
+    python -m mwire_dump restore --workers 8 orders.dump
+    python -m mwire_dump restore --node orders_copy orders.dump
+
+A dump is split into partitions, one per first level subscript of the
+global. Worker threads stream the partitions out with GETSUBTREE, each on
+a connection of its own, while the calling thread appends their nodes to
+the file a chunk at a time. A restore reads the file a chunk at a time
+and workers write the chunks with M.mset. Neither holds more than a few
+chunks in memory.
+
+The file is UTF-8 text with one JSON value per line. The first line is a
+header, {"format": "mwire-dump", "version": 1, "node": "orders"}. Every
+other line is a [subscripts, value] pair, where subscripts are the node's
+subscripts below the global as GETSUBTREE encodes them, "" for the global
+itself. Lines may come in any order.
+"""
+
+import json
+import optparse
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import mwire
+
+FORMAT = 'mwire-dump'
+VERSION = 1
+
+def dump(m, node, output, workers=4, chunk_size=1000, progress=None):
+    """
+    Writes every node of the global node to the file object output and
+    returns a mwire.LoadResult. progress, if given, is called with the
+    LoadResult after every chunk written.
+    """
+    result = mwire.LoadResult()
+    started = time.time()
+    output.write(json.dumps({'format': FORMAT, 'version': VERSION,
+                             'node': node}) + '\n')
+    # The global's own value belongs to no partition
+    if m.exists(node, []) % 10:
+        output.write(json.dumps(['', m.get(node, [])]) + '\n')
+        result.count += 1
+
+    partitions = queue.Queue()
+    for key in m.iter_keys(node, []):
+        partitions.put(key)
+    chunks = queue.Queue(workers * 2)
+    stopped = threading.Event()
+
+    def export():
+        while not stopped.is_set():
+            try:
+                key = partitions.get_nowait()
+            except queue.Empty:
+                return
+            prefix = mwire.encode_subscript(key)
+            lines = []
+            for subscripts, value in m.iter_subtree(node, [key]):
+                if subscripts is None:
+                    subscripts = prefix
+                else:
+                    subscripts = prefix + ',' + subscripts
+                if value is None:
+                    # GETSUBTREE sends an empty value as $-1
+                    value = ''
+                lines.append(json.dumps([subscripts, value]) + '\n')
+                if len(lines) >= chunk_size:
+                    if not _put(chunks, lines, stopped):
+                        return
+                    lines = []
+            if lines:
+                _put(chunks, lines, stopped)
+
+    def write():
+        # On this thread while the workers export
+        while not stopped.is_set():
+            try:
+                lines = chunks.get(timeout=0.1)
+            except queue.Empty:
+                if not any([thread.is_alive() for thread in threads]):
+                    if chunks.empty():
+                        return
+                continue
+            output.write(''.join(lines))
+            result.count += len(lines)
+            result.seconds = time.time() - started
+            if progress is not None:
+                progress(result)
+
+    threads = _start(export, workers, stopped)
+    _finish(write, threads, stopped)
+    result.seconds = time.time() - started
+    return result
+
+def restore(m, input, node=None, workers=4, chunk_size=1000, progress=None):
+    """
+    Sets every node in the dump read from the file object input, below
+    node if given rather than the global it was dumped from, and returns
+    a mwire.LoadResult. Workers each write a chunk at a time with
+    M.mset, on connections of their own.
+    """
+    result = mwire.LoadResult()
+    started = time.time()
+    header = json.loads(input.readline())
+    if header.get('format') != FORMAT or header.get('version') != VERSION:
+        raise mwire.ProtocolError("Not a version %d %s file" % (VERSION, FORMAT))
+    if node is None:
+        node = _native(header['node'])
+    chunks = queue.Queue(workers * 2)
+    stopped = threading.Event()
+    done = object()
+    lock = threading.Lock()
+
+    def load():
+        while not stopped.is_set():
+            try:
+                chunk = chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk is done:
+                # Let the other workers see it too
+                chunks.put(done)
+                return
+            items = [(mwire.decode_subscripts(_native(subscripts)), _native(value))
+                     for subscripts, value in chunk]
+            loaded = m.mset(node, [], items, chunk_size=len(items))
+            with lock:
+                result.count += loaded.count
+                result.failed += loaded.failed
+                result.seconds = time.time() - started
+                if progress is not None:
+                    progress(result)
+
+    def read():
+        # On this thread while the workers load
+        chunk = []
+        for line in input:
+            if line.strip():
+                chunk.append(json.loads(line))
+            if len(chunk) >= chunk_size:
+                if not _put(chunks, chunk, stopped):
+                    return
+                chunk = []
+        if chunk:
+            _put(chunks, chunk, stopped)
+        _put(chunks, done, stopped)
+
+    threads = _start(load, workers, stopped)
+    _finish(read, threads, stopped)
+    result.seconds = time.time() - started
+    return result
+
+def _start(work, workers, stopped):
+    # Starts workers threads running work; the first to fail keeps its
+    # error on the thread and sets stopped
+    def guarded():
+        try:
+            work()
+        except Exception as e:
+            threading.current_thread().error = e
+            stopped.set()
+    threads = [threading.Thread(target=guarded) for i in range(workers)]
+    for thread in threads:
+        thread.error = None
+        thread.daemon = True
+        thread.start()
+    return threads
+
+def _finish(work, threads, stopped):
+    # Runs work on this thread alongside the workers, then waits for
+    # them, raising the first error on either side
+    try:
+        work()
+    except:
+        stopped.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    for thread in threads:
+        if thread.error is not None:
+            raise thread.error
+
+def _put(items, item, stopped):
+    # Waits for room on the queue unless the other side has stopped,
+    # returning whether the item was put
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _native(text):
+    # json gives unicode on Python 2, where commands are byte strings
+    if bytes is str and not isinstance(text, bytes):
+        return text.encode('utf-8')
+    return text
+
+def _report(result):
+    sys.stderr.write('\r%d nodes, %.0f nodes/s' % (result.count, result.rate))
+    sys.stderr.flush()
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='python -m mwire_dump dump [options] NODE FILE\n'
+              '       python -m mwire_dump restore [options] FILE')
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', type='int', default=6330)
+    parser.add_option('--workers', type='int', default=4,
+                      help='connections to dump or restore over')
+    parser.add_option('--chunk-size', type='int', default=1000,
+                      help='nodes written at a time')
+    parser.add_option('--node', help='restore into NODE rather than the '
+                      'global that was dumped')
+    parser.add_option('--quiet', action='store_true',
+                      help='do not report progress')
+    options, args = parser.parse_args(argv)
+    progress = None if options.quiet else _report
+    pool = mwire.ConnectionPool(options.host, options.port,
+                                max_connections=options.workers + 1)
+    m = mwire.M(connection_pool=pool)
+    if args[:1] == ['dump'] and len(args) == 3:
+        if args[2] == '-':
+            output = sys.stdout
+        else:
+            output = open(args[2], 'w')
+        try:
+            result = dump(m, args[1], output, options.workers,
+                          options.chunk_size, progress)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    elif args[:1] == ['restore'] and len(args) == 2:
+        if args[1] == '-':
+            input = sys.stdin
+        else:
+            input = open(args[1])
+        try:
+            result = restore(m, input, options.node, options.workers,
+                             options.chunk_size, progress)
+        finally:
+            if input is not sys.stdin:
+                input.close()
+    else:
+        parser.error('expected dump NODE FILE or restore FILE')
+    if not options.quiet:
+        sys.stderr.write('\n%r\n' % (result,))
+    return result
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,672 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
+
+# In-process M/Wire stand-in server for tests and benchmarks.
+#
+# Globals are held in memory as sorted lists of subscript tuples, so the
+# ordering commands (NEXT, PREVIOUS, QUERY, GETSUBTREE...) follow M
+# collation: numbers before strings, numbers in numeric order and strings
+# in byte order. Replies keep the quirks noted at the top of mwire.py:
+#   - SET replies $11 {"ok":true} and KILL replies +ok
+#   - GET and GETALLSUBS send an empty value as $0, GETSUBTREE as $-1
+#   - HALT closes the connection without a reply
+# LOCK reference [timeout] waits up to timeout seconds, none by default, and
+# replies :1 once locked or :0; UNLOCK reference replies +OK. Locks belong to
+# the connection that took them, are counted, and are dropped with it.
+# TSTART, TCOMMIT and TROLLBACK reply +OK; a connection's writes between
+# TSTART and TCOMMIT are undone by TROLLBACK or by closing the connection.
+# MONITOR replies +OK, then sends +COMMAND reference, e.g. +SET test1[1,"a"],
+# for every write made by any client until the connection is closed. A
+# monitor that falls more than MONITOR_QUEUE changes behind is disconnected.
+#
+#   python mwire_server.py --port 6330 --latency 0.001
+
+import bisect
+import io
+import re
+import socket
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import mwire
+
+CRLF = b'\r\n'
+
+# Commands sent to monitors, and those whose last argument is not part of
+# the reference
+_WRITES = ('SET', 'KILL', 'INCR', 'INCRBY', 'DECR', 'DECRBY', 'SETSUBTREE')
+_VALUED = ('SET', 'INCRBY', 'DECRBY')
+
+# Changes waiting to be sent to a monitor before it is dropped
+MONITOR_QUEUE = 10000
+
+_NUMBER = re.compile(r'^-?(?:[1-9][0-9]*|0)?(?:\.[0-9]*[1-9])?$')
+
+def _number(text):
+    if text in ('', '-', '.', '-.') or not _NUMBER.match(text):
+        return None
+    if '.' in text:
+        return float(text)
+    return int(text)
+
+def parse_reference(text):
+    """
+    Splits test1[1,"a""b"] into ('test1', (1, 'a"b')).
+    """
+    start = text.find('[')
+    if start < 0:
+        return text, ()
+    node = text[:start]
+    subscripts = []
+    i = start + 1
+    end = len(text) - 1
+    while i < end:
+        if text[i] == '"':
+            i += 1
+            chars = []
+            while True:
+                if text[i] == '"':
+                    if text[i + 1:i + 2] == '"':
+                        chars.append('"')
+                        i += 2
+                        continue
+                    i += 1
+                    break
+                chars.append(text[i])
+                i += 1
+            value = ''.join(chars)
+            number = _number(value)
+            subscripts.append(value if number is None else number)
+        else:
+            comma = text.find(',', i)
+            if comma < 0 or comma > end:
+                comma = end
+            value = text[i:comma]
+            number = _number(value)
+            subscripts.append(value if number is None else number)
+            i = comma
+        # skip the separating comma
+        i += 1
+    return node, tuple(subscripts)
+
+def format_subscripts(subscripts):
+    return ','.join([mwire.encode_subscript(s) for s in subscripts])
+
+def format_reference(node, subscripts):
+    if not subscripts:
+        return node
+    return node + '[' + format_subscripts(subscripts) + ']'
+
+def _raw(value):
+    if isinstance(value, (int, float)):
+        return mwire.encode_number(value)
+    return value
+
+def _collate(subscripts):
+    return tuple([(0, s) if isinstance(s, (int, float)) else (1, s)
+                  for s in subscripts])
+
+# Sorts after every (0, n) and (1, s) element
+_HIGH = (2,)
+
+class Global(object):
+    """
+    The nodes of a single global, kept in M collation order.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.values = {}
+
+    def set(self, subscripts, value):
+        key = _collate(subscripts)
+        if key not in self.values:
+            bisect.insort(self.keys, key)
+        self.values[key] = (subscripts, value)
+
+    def get(self, subscripts):
+        item = self.values.get(_collate(subscripts))
+        if item is None:
+            return None
+        return item[1]
+
+    def _descendants(self, key):
+        """
+        Returns the (start, end) slice of keys under key, including key.
+        """
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_left(self.keys, key + (_HIGH,), start)
+        return start, end
+
+    def kill(self, subscripts):
+        start, end = self._descendants(_collate(subscripts))
+        for key in self.keys[start:end]:
+            del self.values[key]
+        del self.keys[start:end]
+
+    def data(self, subscripts):
+        key = _collate(subscripts)
+        start, end = self._descendants(key)
+        result = 0
+        if key in self.values:
+            result += 1
+            start += 1
+        if start < end:
+            result += 10
+        return result
+
+    def subtree(self, subscripts):
+        start, end = self._descendants(_collate(subscripts))
+        return [self.values[key] for key in self.keys[start:end]]
+
+    def children(self, subscripts):
+        level = len(subscripts)
+        start, end = self._descendants(_collate(subscripts))
+        children = []
+        for key in self.keys[start:end]:
+            if len(key) > level:
+                child = self.values[key][0][level]
+                if not children or children[-1] != child:
+                    children.append(child)
+        return children
+
+    def next(self, subscripts):
+        parent = _collate(subscripts[:-1])
+        level = len(parent)
+        if subscripts[-1] == '':
+            pos = bisect.bisect_right(self.keys, parent)
+        else:
+            pos = bisect.bisect_left(self.keys,
+                                     _collate(subscripts) + (_HIGH,))
+        if pos < len(self.keys):
+            key = self.keys[pos]
+            if len(key) > level and key[:level] == parent:
+                return self.values[key][0][level]
+        return None
+
+    def previous(self, subscripts):
+        parent = _collate(subscripts[:-1])
+        level = len(parent)
+        if subscripts[-1] == '':
+            pos = bisect.bisect_left(self.keys, parent + (_HIGH,)) - 1
+        else:
+            pos = bisect.bisect_left(self.keys, _collate(subscripts)) - 1
+        if pos >= 0:
+            key = self.keys[pos]
+            if len(key) > level and key[:level] == parent:
+                return self.values[key][0][level]
+        return None
+
+    def query(self, subscripts):
+        pos = bisect.bisect_right(self.keys, _collate(subscripts))
+        if pos < len(self.keys):
+            return self.values[self.keys[pos]]
+        return None
+
+class DelayedSender(object):
+    """
+    Sends each reply latency seconds after it was made, from a thread of
+    its own so that commands still arriving are not held up, as over a
+    slow network. With max_queued set, sendall() raises queue.Full rather
+    than queue more than that.
+    """
+
+    def __init__(self, sock, latency, max_queued=0):
+        self.latency = latency
+        self._sock = sock
+        self._queue = queue.Queue(max_queued)
+        self._thread = threading.Thread(target=self._send)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def sendall(self, data):
+        self._queue.put_nowait((time.time() + self.latency, data))
+
+    def abort(self):
+        # Hangs up, so the connection's thread and this one finish
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        # Returns once the replies already made have been sent
+        self._queue.put((None, None))
+        self._thread.join()
+
+    def _send(self):
+        while True:
+            due, data = self._queue.get()
+            if data is None:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self._sock.sendall(data)
+            except socket.error:
+                pass
+
+class MWireServer(object):
+    """
+    A threaded M/Wire server holding its globals in memory.
+
+    Replies are delayed by latency seconds to simulate a network hop;
+    pipelined commands are delayed together rather than one after another.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self._globals = {}
+        self._lock = threading.RLock()
+        self._sock = None
+        self._thread = None
+        self._clients = []
+        # Senders of the connections that issued MONITOR
+        self._monitors = []
+        # (node, collated subscripts): [owning connection's thread, count]
+        self._locks = {}
+        self._unlocked = threading.Condition(self._lock)
+        # Thread of a connection in a transaction: [level, {node: the
+        # Global before the transaction wrote to it, None if it had none}]
+        self._transactions = {}
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen(128)
+        self.port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+            self._sock = None
+        for client in list(self._clients):
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+                client.close()
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _serve(self):
+        while True:
+            try:
+                client, address = self._sock.accept()
+            except (socket.error, AttributeError):
+                return
+            self._clients.append(client)
+            thread = threading.Thread(target=self._handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, client):
+        stream = client.makefile('rb')
+        sender = client
+        if self.latency:
+            sender = DelayedSender(client, self.latency)
+        try:
+            while True:
+                line = stream.readline()
+                if not line:
+                    return
+                text = line[:-2].decode('utf-8')
+                if not text:
+                    continue
+                space = text.find(' ')
+                if space < 0:
+                    command, argument = text.upper(), ''
+                else:
+                    command, argument = text[:space].upper(), text[space + 1:]
+                if command == 'HALT':
+                    return
+                if command == 'MONITOR':
+                    # Changes are queued for a thread of its own to send,
+                    # so a monitor slow to read never holds up writers
+                    if sender is not client:
+                        sender.close()
+                    sender = DelayedSender(client, self.latency, MONITOR_QUEUE)
+                    # +OK goes before any change
+                    with self._lock:
+                        sender.sendall(b'+OK' + CRLF)
+                        self._monitors.append(sender)
+                    continue
+                handler = getattr(self, '_do_' + command.lower(), None)
+                if handler is None:
+                    reply = b'-ERR unknown command ' + command.encode('utf-8')
+                else:
+                    try:
+                        # Read off the socket before taking the lock
+                        payload = self._payload(command, argument, stream)
+                        with self._lock:
+                            if command in _WRITES:
+                                node, subscripts = self._written(command, argument)
+                                self._journal(node)
+                            reply = handler(argument, payload)
+                            if command in _WRITES:
+                                self._publish(command, node, subscripts)
+                    except Exception as e:
+                        reply = b'-ERR ' + str(e).encode('utf-8')
+                sender.sendall(reply + CRLF)
+        except socket.error:
+            pass
+        finally:
+            with self._lock:
+                if sender in self._monitors:
+                    self._monitors.remove(sender)
+                self._release_locks()
+                self._do_trollback('', None)
+            if sender is not client:
+                sender.close()
+            stream.close()
+            client.close()
+            if client in self._clients:
+                self._clients.remove(client)
+
+    # Helpers
+
+    def _global(self, node, create=False):
+        if create:
+            return self._globals.setdefault(node, Global())
+        return self._globals.get(node, Global())
+
+    def _reference(self, argument, create=False):
+        node, subscripts = parse_reference(argument)
+        return self._global(node, create), node, subscripts
+
+    @staticmethod
+    def _written(command, argument):
+        # The node and subscripts a write command writes to
+        if command in _VALUED:
+            argument = argument.rsplit(' ', 1)[0]
+        return parse_reference(argument)
+
+    @staticmethod
+    def _payload(command, argument, stream):
+        # The data sent after a command line, read into a stream of its own
+        # so the handler can run holding the lock without waiting on the
+        # client; stream itself for commands with none
+        if command == 'SET':
+            length = int(argument.rsplit(' ', 1)[1])
+            return io.BytesIO(stream.read(length + 2))
+        if command != 'SETSUBTREE':
+            return stream
+        # *4, then $length and the data of each subscript and value
+        lines = [stream.readline()]
+        for i in range(int(lines[0][1:-2])):
+            line = stream.readline()
+            lines.append(line)
+            length = int(line[1:-2])
+            if length > -1:
+                lines.append(stream.read(length + 2))
+        return io.BytesIO(b''.join(lines))
+
+    def _journal(self, node):
+        # Keeps the global as it was before a transaction's first write to it
+        transaction = self._transactions.get(threading.current_thread())
+        if transaction is None or node in transaction[1]:
+            return
+        saved = self._globals.get(node)
+        if saved is not None:
+            copy = Global()
+            copy.keys = list(saved.keys)
+            copy.values = dict(saved.values)
+            saved = copy
+        transaction[1][node] = saved
+
+    def _publish(self, command, node, subscripts):
+        # Called holding the lock, so monitors see writes in order; the
+        # changes are only queued, each monitor's sender writing them out
+        if not self._monitors:
+            return
+        line = ('+' + command + ' ' + format_reference(node, subscripts))
+        line = line.encode('utf-8') + CRLF
+        for sender in list(self._monitors):
+            try:
+                sender.sendall(line)
+            except queue.Full:
+                # Too far behind; the client sees it closed and resubscribes
+                self._monitors.remove(sender)
+                sender.abort()
+
+    def _lock_key(self, argument):
+        # A connection is served by a thread of its own, which owns its locks
+        node, subscripts = parse_reference(argument)
+        return node, _collate(subscripts)
+
+    def _lock_conflict(self, key):
+        node, subscripts = key
+        thread = threading.current_thread()
+        for (held_node, held), entry in self._locks.items():
+            level = min(len(held), len(subscripts))
+            if (held_node == node and entry[0] is not thread and
+                    held[:level] == subscripts[:level]):
+                return True
+        return False
+
+    def _release_locks(self):
+        thread = threading.current_thread()
+        for key, entry in list(self._locks.items()):
+            if entry[0] is thread:
+                del self._locks[key]
+        self._unlocked.notify_all()
+
+    @staticmethod
+    def _bulk(value):
+        if value is None:
+            return b'$-1'
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return b'$' + str(len(value)).encode('ascii') + CRLF + value
+
+    @staticmethod
+    def _multi(items):
+        return CRLF.join([b'*' + str(len(items)).encode('ascii')] + items)
+
+    @staticmethod
+    def _integer(value):
+        return b':' + str(value).encode('ascii')
+
+    # Commands
+
+    def _do_ping(self, argument, stream):
+        return b'+PONG'
+
+    def _do_set(self, argument, stream):
+        reference, length = argument.rsplit(' ', 1)
+        value = stream.read(int(length) + 2)[:-2]
+        store, node, subscripts = self._reference(reference, True)
+        store.set(subscripts, value)
+        return self._bulk(b'{"ok":true}')
+
+    def _do_get(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        return self._bulk(store.get(subscripts))
+
+    def _do_kill(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        store.kill(subscripts)
+        return b'+ok'
+
+    def _do_exists(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        return self._integer(store.data(subscripts))
+
+    def _increment(self, reference, amount):
+        store, node, subscripts = self._reference(reference, True)
+        value = store.get(subscripts) or b'0'
+        value = _number(value.decode('utf-8')) or 0
+        value = mwire.encode_number(value + amount)
+        store.set(subscripts, value.encode('utf-8'))
+        return self._integer(value)
+
+    def _do_incr(self, argument, stream):
+        return self._increment(argument, 1)
+
+    def _do_incrby(self, argument, stream):
+        reference, amount = argument.rsplit(' ', 1)
+        return self._increment(reference, int(amount))
+
+    def _do_decr(self, argument, stream):
+        return self._increment(argument, -1)
+
+    def _do_decrby(self, argument, stream):
+        reference, amount = argument.rsplit(' ', 1)
+        return self._increment(reference, -int(amount))
+
+    def _do_next(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        if not subscripts:
+            return self._bulk(None)
+        result = store.next(subscripts)
+        return self._bulk(None if result is None else _raw(result))
+
+    def _do_previous(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        if not subscripts:
+            return self._bulk(None)
+        result = store.previous(subscripts)
+        return self._bulk(None if result is None else _raw(result))
+
+    def _do_query(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        item = store.query(subscripts)
+        if item is None:
+            return self._bulk(None)
+        return self._bulk(format_reference(node, item[0]))
+
+    def _do_queryget(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        item = store.query(subscripts)
+        if item is None:
+            return self._bulk(None)
+        return self._multi([self._bulk(format_reference(node, item[0])),
+                            self._bulk(item[1])])
+
+    def _do_getsubtree(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        level = len(subscripts)
+        items = []
+        for key, value in store.subtree(subscripts):
+            if len(key) == level:
+                items.append(self._bulk(None))
+            else:
+                items.append(self._bulk(format_subscripts(key[level:])))
+            # An empty value is sent as $-1 here, unlike GET
+            items.append(self._bulk(value or None))
+        return self._multi(items)
+
+    def _do_setsubtree(self, argument, stream):
+        # Records of relative subscripts and quoted values, as mwire sends
+        store, node, subscripts = self._reference(argument, True)
+        count = int(stream.readline()[1:-2])
+        for i in range(0, count, 2):
+            length = int(stream.readline()[1:-2])
+            relative = stream.read(length + 2)[:-2].decode('utf-8')
+            relative = parse_reference('[' + relative + ']')[1]
+            length = int(stream.readline()[1:-2])
+            if length < 0:
+                continue
+            value = stream.read(length + 2)[1:-3].replace(b'""', b'"')
+            store.set(subscripts + relative, value)
+        return b'+OK'
+
+    def _do_lock(self, argument, stream):
+        # LOCK test1["a b"] 5; the reference may hold spaces itself
+        timeout = 0
+        head, space, tail = argument.rpartition(' ')
+        if space and _number(tail) is not None and (head.endswith(']') or '[' not in head):
+            argument, timeout = head, _number(tail)
+        key = self._lock_key(argument)
+        deadline = time.time() + timeout
+        while self._lock_conflict(key):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return self._integer(0)
+            self._unlocked.wait(remaining)
+        entry = self._locks.setdefault(key, [threading.current_thread(), 0])
+        entry[1] += 1
+        return self._integer(1)
+
+    def _do_unlock(self, argument, stream):
+        key = self._lock_key(argument)
+        entry = self._locks.get(key)
+        if entry is not None and entry[0] is threading.current_thread():
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+                self._unlocked.notify_all()
+        return b'+OK'
+
+    def _do_tstart(self, argument, stream):
+        transaction = self._transactions.setdefault(threading.current_thread(), [0, {}])
+        transaction[0] += 1
+        return b'+OK'
+
+    def _do_tcommit(self, argument, stream):
+        thread = threading.current_thread()
+        transaction = self._transactions.get(thread)
+        if transaction is None:
+            return b'-ERR no transaction'
+        transaction[0] -= 1
+        if not transaction[0]:
+            del self._transactions[thread]
+        return b'+OK'
+
+    def _do_trollback(self, argument, stream):
+        # Every level, as in M
+        transaction = self._transactions.pop(threading.current_thread(), None)
+        if transaction is not None:
+            for node, saved in transaction[1].items():
+                if saved is None:
+                    self._globals.pop(node, None)
+                else:
+                    self._globals[node] = saved
+        return b'+OK'
+
+    def _do_getallsubs(self, argument, stream):
+        store, node, subscripts = self._reference(argument)
+        items = []
+        for child in store.children(subscripts):
+            items.append(self._bulk(_raw(child)))
+            items.append(self._bulk(store.get(subscripts + (child,))))
+        return self._multi(items)
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=6330)
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds to delay every reply')
+    options, args = parser.parse_args()
+    server = MWireServer(options.host, options.port, options.latency).start()
+    print('M/Wire stand-in server listening on %s:%s' %
+          (server.host, server.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
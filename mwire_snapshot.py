@@ -0,0 +1,226 @@
+# Copyright 2011 Kurt Le Breton, All Rights Reserved
+
+"""
+Binary snapshots of globals, read back through mmap.
+
+    count = mwire_snapshot.write_snapshot(m, 'fixtures.snap', ['test1', 'test2'])
+    with mwire_snapshot.Snapshot('fixtures.snap') as snapshot:
+        for node, subscripts, value in snapshot.records('test1', [5], [10]):
+            ...
+        mwire_snapshot.restore(m, snapshot)
+
+A snapshot is a header, the records, a sparse index and a trailer:
+
+    header   MWSNAP1\\n
+    record   >HII lengths of node, subscripts and value, then their UTF-8
+             bytes; subscripts as GETSUBTREE encodes them, empty for the
+             global itself
+    index    >Q offset of every index_interval'th record, then its node
+             and subscripts as above with no value
+    trailer  >QQQ offset of the index, index entries, records, then
+             MWSNAPIX
+
+Records are kept in global then M collation order, so the index can be
+binary searched to start reading a range of keys part way through the
+file. Reading needs no parsing beyond the lengths: values come back as
+memoryviews over the mapped file, copied only if the caller decodes them
+(on Python 3; Python 2 cannot take a memoryview of an mmap).
+"""
+
+import bisect
+import itertools
+import mmap
+import struct
+
+import mwire
+
+MAGIC = b'MWSNAP1\n'
+INDEX_MAGIC = b'MWSNAPIX'
+
+_RECORD = struct.Struct('>HII')
+_OFFSET = struct.Struct('>Q')
+_TRAILER = struct.Struct('>QQQ8s')
+
+def write_snapshot(m, path, nodes, index_interval=64):
+    """
+    Streams every node of the given globals into a snapshot at path with
+    M.iter_subtree, and returns the number of records written.
+    """
+    with open(path, 'wb') as output:
+        writer = SnapshotWriter(output, index_interval)
+        for node in sorted(nodes):
+            for subscripts, value in m.iter_subtree(node, []):
+                writer.write(node, subscripts or '', value or '')
+        writer.close()
+    return writer.count
+
+class SnapshotWriter(object):
+    """
+    Writes records to a snapshot file object opened for binary writing.
+    Records must be written in global then collation order, as
+    GETSUBTREE returns them; close() adds the index.
+    """
+
+    def __init__(self, output, index_interval=64):
+        self.output = output
+        self.index_interval = index_interval
+        self.count = 0
+        self._index = []
+        self._offset = len(MAGIC)
+        output.write(MAGIC)
+
+    def write(self, node, subscripts, value):
+        node = mwire._encode(node)
+        subscripts = mwire._encode(subscripts)
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            value = mwire._encode(value)
+        if self.count % self.index_interval == 0:
+            self._index.append((self._offset, node, subscripts))
+        header = _RECORD.pack(len(node), len(subscripts), len(value))
+        self.output.write(header + node + subscripts)
+        self.output.write(value)
+        self._offset += len(header) + len(node) + len(subscripts) + len(value)
+        self.count += 1
+
+    def close(self):
+        for offset, node, subscripts in self._index:
+            self.output.write(_OFFSET.pack(offset) +
+                              _RECORD.pack(len(node), len(subscripts), 0) +
+                              node + subscripts)
+        self.output.write(_TRAILER.pack(self._offset, len(self._index),
+                                        self.count, INDEX_MAGIC))
+
+class Snapshot(object):
+    """
+    Reads a snapshot through a read-only mmap of its file. Iterating over
+    it, or records(), yields (node, subscripts, value) with value a
+    memoryview over the mapping. A value still referenced when the
+    snapshot is closed keeps the mapping alive until it is released.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        try:
+            self._view = memoryview(self._map)
+        except TypeError:
+            # Python 2's mmap has no buffer interface; slices are copies
+            self._view = self._map
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise mwire.ProtocolError("%s is not a snapshot" % path)
+        trailer = self._map[len(self._map) - _TRAILER.size:]
+        self._end, entries, self.count, magic = _TRAILER.unpack(trailer)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise mwire.ProtocolError("%s is incomplete" % path)
+        # The offset and (node, collation key) of every index entry
+        self._offsets = []
+        self._keys = []
+        position = self._end
+        for i in range(entries):
+            offset, = _OFFSET.unpack_from(self._map, position)
+            position += _OFFSET.size
+            node, subscripts, value, position = self._read(position)
+            self._offsets.append(offset)
+            self._keys.append(_key(mwire._decode(node), mwire._decode(subscripts)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return self.records()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            try:
+                if isinstance(self._view, memoryview):
+                    self._view.release()
+                self._map.close()
+            except BufferError:
+                # Values handed out are still in use; the map is unmapped
+                # once the last of them is garbage collected
+                pass
+            self._view = None
+            self._map = None
+            self._file.close()
+
+    def _read(self, position):
+        # Returns the node, subscripts and value memoryviews of the record
+        # at position, and the position of the next one
+        node_length, subscripts_length, value_length = \
+            _RECORD.unpack_from(self._map, position)
+        start = position + _RECORD.size
+        end = start + node_length
+        node = self._view[start:end]
+        start, end = end, end + subscripts_length
+        subscripts = self._view[start:end]
+        start, end = end, end + value_length
+        return node, subscripts, self._view[start:end], end
+
+    def records(self, node=None, start=None, stop=None):
+        """
+        Yields the (node, subscripts, value) records of every global, or
+        of node only, from the subscripts start (inclusive) to stop
+        (exclusive) in collation order when given.
+        """
+        position = len(MAGIC)
+        low = None
+        if node is not None:
+            low = (node, _collation(start or []))
+            index = bisect.bisect_right(self._keys, low) - 1
+            if index >= 0:
+                position = self._offsets[index]
+        high = None
+        if stop is not None:
+            high = (node, _collation(stop))
+        while position < self._end:
+            record_node, subscripts, value, position = self._read(position)
+            record_node = mwire._decode(record_node)
+            subscripts = mwire._decode(subscripts)
+            if low is not None:
+                if record_node < node:
+                    continue
+                if record_node > node:
+                    return
+                if start is not None or high is not None:
+                    key = (record_node, _collation(mwire.decode_subscripts(subscripts)))
+                    if start is not None and key < low:
+                        continue
+                    if high is not None and key >= high:
+                        return
+            yield record_node, subscripts, value
+
+def restore(m, records, node=None, chunk_size=1000, progress=None):
+    """
+    Writes records, a Snapshot or the records() of part of one, with
+    M.mset, below node if given rather than the globals they were taken
+    from, and returns the mwire.LoadResult.
+    """
+    result = mwire.LoadResult()
+    for record_node, records in itertools.groupby(records, lambda r: r[0]):
+        items = ((mwire.decode_subscripts(subscripts), mwire._decode(value))
+                 for unused, subscripts, value in records)
+        loaded = m.mset(node or record_node, [], items, chunk_size)
+        result.count += loaded.count
+        result.failed += loaded.failed
+        result.seconds += loaded.seconds
+        if progress is not None:
+            progress(result)
+    return result
+
+def _collation(subscripts):
+    return tuple([mwire._collation_key(s) for s in subscripts])
+
+def _key(node, subscripts):
+    return node, _collation(mwire.decode_subscripts(subscripts))
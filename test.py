@@ -1,12 +1,151 @@
 # Copyright 2011 Kurt Le Breton, All Rights Reserved
 
+import json
 import mwire
+import mwire_dump
+import mwire_server
+import mwire_snapshot
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Set MWIRE_SERVER=host:port to run against a real M/Wire server rather
+# than the in-process stand-in
+server = None
+
+def setUpModule():
+    global server
+    if 'MWIRE_SERVER' not in os.environ:
+        server = mwire_server.MWireServer().start()
+
+def tearDownModule():
+    if server is not None:
+        server.stop()
+
+def server_address():
+    if server is not None:
+        return server.host, server.port
+    host, port = os.environ['MWIRE_SERVER'].rsplit(':', 1)
+    return host, int(port)
 
 class MWireFunctions(unittest.TestCase):
 
     def setUp(self):
-        self.m = mwire.M('192.168.0.6', 6330)
+        self.m = mwire.M(*server_address())
+
+    def test_dump_01(self):
+        """
+        A global dumped in partitions restores node for node
+        """
+
+        self.m.kill('test1', [])
+        self.m.kill('test2', [])
+        self.m.set('test1', [], 'root')
+        self.m.set('test1', [1, 'y', 'ad'], '')
+        self.m.set('test1', ['a"b', 2.5], 'line\nbreak')
+        self.m.mset('test1', [], (([i % 7, 'x', i], str(i)) for i in range(3000)))
+
+        output = StringIO()
+        result = mwire_dump.dump(self.m, 'test1', output, workers=3, chunk_size=100)
+        self.assertEqual(3003, result.count)
+        input = StringIO(output.getvalue())
+        result = mwire_dump.restore(self.m, input, 'test2', workers=3, chunk_size=100)
+        self.assertEqual((3003, 0), (result.count, result.failed))
+        self.assertEqual(self.m.getsubtree('test1', []), self.m.getsubtree('test2', []))
+
+    def test_snapshot_01(self):
+        """
+        A snapshot reads back a range of keys through its sparse index and
+        restores with the bulk write path
+        """
+
+        self.m.kill('test1', [])
+        self.m.kill('test2', [])
+        self.m.set('test1', [], 'root')
+        self.m.mset('test1', [], (([i, 'x'], str(i)) for i in range(1000)))
+        self.m.set('test1', ['y', 2.5], '')
+
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            self.assertEqual(1002, mwire_snapshot.write_snapshot(
+                self.m, path, ['test1'], index_interval=10))
+            with mwire_snapshot.Snapshot(path) as snapshot:
+                self.assertEqual(1002, len(snapshot))
+                records = [(node, subscripts, mwire._decode(value)) for
+                           node, subscripts, value in snapshot.records('test1', [500], [502])]
+                self.assertEqual([('test1', '500,"x"', '500'), ('test1', '501,"x"', '501')],
+                                 records)
+                self.assertEqual(['"y",2.5'], [subscripts for node, subscripts, value in
+                                               snapshot.records('test1', ['y'])])
+                self.assertEqual([], list(snapshot.records('test0')))
+                result = mwire_snapshot.restore(self.m, snapshot, 'test2')
+                self.assertEqual((1002, 0), (result.count, result.failed))
+        finally:
+            os.remove(path)
+        self.assertEqual(self.m.getsubtree('test1', []), self.m.getsubtree('test2', []))
+
+    def test_snapshot_02(self):
+        """
+        A snapshot closes at the end of a with block while the last value
+        read is still referenced
+        """
+
+        self.m.kill('test1', [])
+        self.m.mset('test1', [], (([i], str(i)) for i in range(10)))
+
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            mwire_snapshot.write_snapshot(self.m, path, ['test1'])
+            with mwire_snapshot.Snapshot(path) as snapshot:
+                for node, subscripts, value in snapshot.records():
+                    pass
+            self.assertEqual('9', mwire._decode(value))
+            self.assertEqual(None, snapshot._map)
+        finally:
+            os.remove(path)
+
+    def test_decode_subscripts_01(self):
+        """
+        GETSUBTREE's encoded subscripts decode to subscripts that encode
+        back the same
+        """
+
+        for text in ('', '1', '""', '"a ""b"" c",.5,-3', '"x,y",1.25,"1"'):
+            subscripts = mwire.decode_subscripts(text)
+            self.assertEqual(text, ','.join([mwire.encode_subscript(s) for s in subscripts]))
+        self.assertEqual([1, 'a', '1'], mwire.decode_subscripts('1,"a","1"'))
+        self.assertRaises(mwire.ProtocolError, mwire.decode_subscripts, '"a')
+        self.assertRaises(mwire.ProtocolError, mwire.decode_subscripts, 'a')
+
+    def test_encode_reference_01(self):
+        """
+        Strings are quoted with embedded quotes doubled, numbers are in M
+        canonical form
+        """
+
+        for i in range(2):
+            self.assertEqual('test1', mwire.encode_reference('test1', []))
+            self.assertEqual('test1[1,"a","say ""hi"""]',
+                             mwire.encode_reference('test1', [1, 'a', 'say "hi"']))
+            self.assertEqual('test1[.5,-.25,2,100000000000000000000,-1.5]',
+                             mwire.encode_reference('test1', [0.5, -0.25, 2.0, 1e20, -1.5]))
+            self.assertEqual('test1["1",1]',
+                             mwire.encode_reference('test1', ('1', 1)))
 
     def test_exists_01(self):
         """
@@ -110,6 +249,137 @@ class MWireFunctions(unittest.TestCase):
         for i in range(2):
             self.assertEqual('', self.m.get('test1', ['yyy']))
     
+    def test_get_04(self):
+        """
+        Values larger than the reader's buffer are received into their own
+        """
+
+        for length in (0, 1, 65534, 65535, 65536, 1000000):
+            value = ''.join([chr(65 + i % 26) for i in range(length)])
+            self.m.set('test1', ['big'], value)
+            for i in range(2):
+                self.assertEqual(value, self.m.get('test1', ['big']))
+
+    def test_get_05(self):
+        """
+        Values can be returned as memoryviews rather than decoded
+        """
+
+        pool = mwire.ConnectionPool(self.m._pool.host, self.m._pool.port,
+                                    memoryviews=True)
+        m = mwire.M(connection_pool=pool)
+        for value in ('Hello', 'x' * 1000000):
+            m.set('test1', ['a', 'b'], value)
+            data = m.get('test1', ['a', 'b'])
+            self.assertTrue(isinstance(data, memoryview))
+            self.assertEqual(value.encode('ascii'), data.tobytes())
+
+    def test_get_06(self):
+        """
+        A binary M sends and returns values as bytes, untouched
+        """
+
+        m = mwire.M(*server_address(), binary=True)
+        m.kill('test1', [])
+        blob = bytes(bytearray(range(256))) * 300
+        for value in (blob, bytearray(blob), memoryview(blob)):
+            self.assertEqual(True, m.set('test1', ['blob'], value))
+            data = m.get('test1', ['blob'])
+            self.assertTrue(isinstance(data, bytes))
+            self.assertEqual(blob, data)
+        m.set('test1', ['empty'], b'')
+        self.assertEqual(b'', m.get('test1', ['empty']))
+        key = m.next('test1', [''])
+        self.assertTrue(isinstance(key, bytes))
+        self.assertEqual(b'empty', m.next('test1', [key]))
+        # Names and subscripts read back can be used as they are
+        self.assertEqual([[None, b'']], m.getsubtree('test1', ['empty']))
+        self.assertEqual(b'', m.get(b'test1', [b'empty']))
+        m.set('test1', ['c'], b'x')
+        self.assertEqual([b'blob', b'c'],
+                         list(m.iter_keys('test1', [], start='a', stop=b'empty')))
+        self.assertEqual([b'c', b'empty'],
+                         list(m.iter_keys('test1', [], start=b'c', prefetch=0)))
+        self.assertEqual([b'c'], list(m.iter_keys('test1', [], reverse=True,
+                                                   start='c', stop='blob')))
+
+        m = mwire.M(*server_address(), binary=True,
+                    codec=mwire.TextCodec('latin-1'))
+        m.set('test1', ['text'], u'caf\xe9')
+        self.assertEqual(u'caf\xe9', m.get('test1', ['text']))
+        self.assertEqual(u'caf\xe9'.encode('latin-1'),
+                         mwire.M(*server_address(), binary=True).get('test1', ['text']))
+
+    def test_get_07(self):
+        """
+        A value cut short by the server closing the connection raises
+        ConnectionError rather than returning what arrived
+        """
+
+        # Starts a value, then hangs up partway through it
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(2)
+        # Not left waiting for a connection should the first case fail
+        listener.settimeout(10)
+        def hang_up():
+            for length in (10, 100000):
+                connection = listener.accept()[0]
+                connection.recv(1024)
+                connection.sendall(('$%d\r\nabc' % length).encode())
+                connection.close()
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        try:
+            # Within the read buffer, then larger than it
+            for i in range(2):
+                m = mwire.M(*listener.getsockname())
+                self.assertRaises(mwire.ConnectionError, m.get, 'test1', ['a'])
+                m.disconnect()
+        finally:
+            thread.join()
+            listener.close()
+
+    def test_codec_01(self):
+        """
+        A codec converts every value set and read
+        """
+
+        class ReverseCodec(mwire.Codec):
+            def encode(self, value):
+                return value[::-1]
+            def decode(self, data):
+                return None if data is None else data[::-1]
+
+        m = mwire.M(*server_address(), codec=ReverseCodec())
+        m.kill('test1', [])
+        m.set('test1', ['a'], 'hello')
+        m.mset('test1', [], [(['b'], 'world')])
+        self.assertEqual('olleh', self.m.get('test1', ['a']))
+        self.assertEqual('hello', m.get('test1', ['a']))
+        self.assertEqual(None, m.get('test1', ['c']))
+        self.assertEqual([['a', 'hello'], ['b', 'world']], m.getallsubs('test1', []))
+        self.assertEqual([['"a"', 'hello'], ['"b"', 'world']], list(m.iter_subtree('test1', [])))
+        self.assertEqual(['test1["a"]', 'hello'], m.queryget('test1', []))
+        self.assertEqual(['hello', True], m.pipeline().get('test1', ['a']).set('test1', ['a'], 'x').execute())
+
+    def test_get_many_01(self):
+        """
+        Many nodes of a global are read in chunks over several connections
+        and returned in the order asked for
+        """
+
+        self.m.kill('test1', [])
+        self.m.mset('test1', [], [([i, 'x'], str(i)) for i in range(0, 200, 2)])
+        keys = [[i, 'x'] for i in reversed(range(200))]
+        values = self.m.get_many('test1', keys, chunk_size=7, concurrency=3)
+        self.assertEqual([(i, 'x') for i in reversed(range(200))], list(values))
+        self.assertEqual('198', values[198, 'x'])
+        self.assertEqual(None, values[199, 'x'])
+        exists = self.m.exists_many('test1', [[4], [4, 'x'], [5]])
+        self.assertEqual([10, 1, 0], list(exists.values()))
+        self.assertEqual({}, self.m.get_many('test1', []))
+
     def test_getsubtree_01(self):
         """
         test1="aaa"
@@ -179,6 +449,55 @@ class MWireFunctions(unittest.TestCase):
             self.assertEqual(data[4][0], '"ad"')
             self.assertEqual(data[4][1], '')
 
+    def test_getsubtree_02(self):
+        """
+        iter_subtree and iter_allsubs yield the same pairs as getsubtree
+        and getallsubs, and an abandoned iterator leaves the client usable
+        """
+
+        p = self.m.pipeline()
+        p.kill('test1', [])
+        for i in range(1000):
+            p.set('test1', [i % 10, i], str(i))
+        p.execute()
+
+        self.assertEqual(self.m.getsubtree('test1', []),
+                         list(self.m.iter_subtree('test1', [])))
+        self.assertEqual(self.m.getallsubs('test1', [3]),
+                         list(self.m.iter_allsubs('test1', [3])))
+
+        items = self.m.iter_subtree('test1', [])
+        self.assertEqual(['0,0', '0'], next(items))
+        items.close()
+        self.assertEqual('999', self.m.get('test1', [9, 999]))
+
+    @unittest.skipIf(numpy is None, "needs numpy")
+    def test_getsubtree_array_01(self):
+        """
+        ts[42,t]=v is read into arrays of t and v, NaN where there is no
+        value
+        """
+
+        self.m.kill('test1', [])
+        self.m.set('test1', [42], 'not read')
+        self.m.mset('test1', [42], [(1000 + i, str(i / 4.0)) for i in range(50)])
+        self.m.set('test1', [42, 2000], '')
+        chunk = mwire._ARRAY_CHUNK
+        mwire._ARRAY_CHUNK = 7
+        try:
+            keys, values = self.m.getsubtree_array('test1', [42], 'int64')
+        finally:
+            mwire._ARRAY_CHUNK = chunk
+        self.assertEqual(numpy.dtype('int64'), keys.dtype)
+        self.assertEqual(list(range(1000, 1050)) + [2000], list(keys))
+        self.assertEqual([i / 4.0 for i in range(50)], list(values[:50]))
+        self.assertTrue(numpy.isnan(values[50]))
+
+        self.m.set('test1', [43, 'x'], 'abc')
+        self.assertRaises(mwire.ProtocolError, self.m.getsubtree_array, 'test1', [43])
+        keys, values = self.m.getsubtree_array('test1', [43], 'U1', 'U3')
+        self.assertEqual((['x'], ['abc']), (list(keys), list(values)))
+
     def test_halt_01(self):
         """
         Client: HALT
@@ -203,6 +522,54 @@ class MWireFunctions(unittest.TestCase):
         for i in range(20):
             self.assertEqual(i + 1, self.m.increment('test1', ['a', 'b']))
 
+    def test_iter_keys_01(self):
+        """
+        The level below test1["k"] walked in either direction and over a
+        range, with and without prefetching
+        """
+
+        p = self.m.pipeline()
+        p.kill('test1', [])
+        for i in range(20):
+            p.set('test1', ['k', i], str(i))
+            p.set('test1', ['k', 'n' + str(i)], str(i))
+        p.set('test1', ['k', 5, 'x'], '')
+        p.execute()
+
+        numbers = [str(i) for i in range(20)]
+        strings = sorted(['n' + str(i) for i in range(20)])
+        keys = numbers + strings
+        for prefetch in (0, 5):
+            self.assertEqual(keys, list(self.m.iter_keys('test1', ['k'], prefetch=prefetch)))
+            self.assertEqual(keys[::-1], list(self.m.iter_keys(
+                'test1', ['k'], reverse=True, prefetch=prefetch)))
+            self.assertEqual(numbers[5:] + strings[:2], list(self.m.iter_keys(
+                'test1', ['k'], prefetch=prefetch, start=5, stop=strings[2])))
+            self.assertEqual(['12', '11', '10'], list(self.m.iter_keys(
+                'test1', ['k'], reverse=True, prefetch=prefetch, start=12.5, stop=9)))
+
+        keys = self.m.iter_keys('test1', ['k'], prefetch=2, start=0)
+        self.assertEqual('0', next(keys))
+        keys.close()
+
+        # A forward range of a small level is a single GETALLSUBS, of a
+        # wider one a walk with NEXT
+        stats = mwire.CommandStats()
+        m = mwire.M(*server_address(), observers=[stats])
+        self.assertEqual(numbers[5:10], list(m.iter_keys('test1', ['k'], start=5, stop=10)))
+        self.assertEqual(['GETALLSUBS'], list(stats.summary()))
+        self.assertEqual(1, stats.summary()['GETALLSUBS']['count'])
+        size = mwire.SCAN_SIZE
+        mwire.SCAN_SIZE = 10
+        try:
+            for prefetch in (0, 5):
+                self.assertEqual(numbers[5:] + strings[:2], list(m.iter_keys(
+                    'test1', ['k'], prefetch=prefetch, start=5, stop=strings[2])))
+        finally:
+            mwire.SCAN_SIZE = size
+        self.assertEqual(3, stats.summary()['GETALLSUBS']['count'])
+        self.assertEqual(2 * 17, stats.summary()['NEXT']['count'])
+
     def test_kill_01(self):
         """
         Client: KILL test1["a","b"]
@@ -335,6 +702,69 @@ class MWireFunctions(unittest.TestCase):
         for i in range(2):
             self.assertEqual(None, self.m.next('test1', [1,'z']))
 
+    def test_readcache_01(self):
+        """
+        Reads are served from the cache until a write through the same
+        client could change them
+        """
+
+        cache = mwire.ReadCache(maxsize=3)
+        m = mwire.M(connection_pool=self.m._pool, cache=cache)
+        m.kill('test1', [])
+        m.set('test1', [1, 'x'], 'hello')
+
+        for i in range(2):
+            self.assertEqual('hello', m.get('test1', [1, 'x']))
+            self.assertEqual(1, m.exists('test1', [1, 'x']))
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+
+        # Another client's write is not seen until invalidated
+        self.m.set('test1', [1, 'x'], 'world')
+        self.assertEqual('hello', m.get('test1', [1, 'x']))
+        m.set('test1', [1, 'x', 'y'], '')
+        self.assertEqual('hello', m.get('test1', [1, 'x']))
+        self.assertEqual(11, m.exists('test1', [1, 'x']))
+        m.kill('test1', [1])
+        self.assertEqual(None, m.get('test1', [1, 'x']))
+        self.assertEqual(0, m.exists('test1', [1]))
+
+        # Least recently used evicted
+        m.get('test1', ['a'])
+        m.get('test1', ['b'])
+        m.get('test1', ['c'])
+        self.assertEqual(3, len(cache))
+        self.assertRaises(KeyError, cache.get, 'GET test1[1,"x"]')
+
+    def test_readcache_02(self):
+        """
+        Entries expire after ttl seconds and writes queued on a pipeline
+        invalidate once flushed
+        """
+
+        cache = mwire.ReadCache(ttl=0.2)
+        m = mwire.M(connection_pool=self.m._pool, cache=cache)
+        m.set('test1', ['a'], 'hello')
+        self.assertEqual('hello', m.get('test1', ['a']))
+        self.m.set('test1', ['a'], 'world')
+        self.assertEqual('hello', m.get('test1', ['a']))
+        time.sleep(0.3)
+        self.assertEqual('world', m.get('test1', ['a']))
+
+        p = m.pipeline()
+        p.set('test1', ['a'], 'again')
+        self.assertEqual('world', m.get('test1', ['a']))
+        p.execute()
+        self.assertEqual('again', m.get('test1', ['a']))
+
+        # However the node written is spelt
+        m.set('test1', [1], 'one')
+        self.assertEqual('one', m.get('test1', [1]))
+        m.set(b'test1', ['1'], 'uno')
+        self.assertEqual('uno', m.get('test1', [1]))
+        self.assertEqual('uno', m.get('test1', [1.0]))
+        m.kill('test1', [b'1'])
+        self.assertEqual(None, m.get('test1', [1.0]))
+
     def test_previous_01(self):
         """
         test1="aaa"
@@ -388,11 +818,360 @@ class MWireFunctions(unittest.TestCase):
             self.assertEqual(data[2][0], 'z')
             self.assertEqual(data[2][1], '')
 
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio requires Python 3.5")
+    def test_asyncm_01(self):
+        """
+        Many concurrent requests in flight on one connection
+        """
+
+        import asyncio
+        import mwire_async
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        run = loop.run_until_complete
+        m = mwire_async.AsyncM(self.m._pool.host, self.m._pool.port)
+        try:
+            self.assertEqual(True, run(m.kill('test1', [])))
+            self.assertEqual(True, run(m.set('test1', [1, 'x'], 'hello')))
+            self.assertEqual(True, run(m.set('test1', [1, 'y'], '')))
+            counts = run(asyncio.gather(
+                *[m.increment('test1', ['a']) for i in range(100)]))
+            self.assertEqual(list(range(1, 101)), sorted(counts))
+            self.assertEqual(['hello', '', None], run(asyncio.gather(
+                m.get('test1', [1, 'x']), m.get('test1', [1, 'y']),
+                m.get('test1', [2]))))
+            self.assertEqual('x', run(m.next('test1', [1, ''])))
+            self.assertEqual(['test1[1,"x"]', 'hello'],
+                             run(m.queryget('test1', [1])))
+            self.assertEqual(self.m.getsubtree('test1', []),
+                             run(m.getsubtree('test1', [])))
+        finally:
+            run(m.disconnect())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio requires Python 3.5")
+    def test_asyncm_02(self):
+        """
+        A reply that fails to parse fails only its own command
+        """
+
+        import asyncio
+        import mwire_async
+
+        class Strict(mwire.Codec):
+            def encode(self, value):
+                return value
+
+            def decode(self, data):
+                if data != 'ok':
+                    raise ValueError(data)
+                return data
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        run = loop.run_until_complete
+        m = mwire_async.AsyncM(self.m._pool.host, self.m._pool.port,
+                               codec=Strict())
+        try:
+            self.assertEqual(True, run(m.set('test1', ['a'], 'bad')))
+            self.assertEqual(True, run(m.set('test1', ['b'], 'ok')))
+            results = run(asyncio.wait_for(asyncio.gather(
+                m.get('test1', ['a']), m.get('test1', ['b']),
+                return_exceptions=True), 5))
+            self.assertTrue(isinstance(results[0], ValueError))
+            self.assertEqual('ok', results[1])
+            self.assertEqual('ok', run(m.get('test1', ['b'])))
+        finally:
+            run(m.disconnect())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio requires Python 3.5")
+    def test_asyncm_03(self):
+        """
+        Every command of M either works on AsyncM or raises ToDoError
+        """
+
+        import asyncio
+        import mwire_async
+
+        # Inherited as they are, since they go through _execute() or _many()
+        inherited = set(['decrement', 'decrement_by', 'exists', 'exists_many',
+                         'function', 'get', 'get_many', 'getallsubs',
+                         'getsubtree', 'getsubtree_array', 'halt', 'increment',
+                         'increment_by', 'kill', 'mdate', 'mversion', 'next',
+                         'previous', 'ping', 'query', 'queryget', 'set',
+                         'transaction_commit', 'transaction_rollback',
+                         'version'])
+        for name in dir(mwire.M):
+            if name.startswith('_') or name in inherited:
+                continue
+            self.assertTrue(name in mwire_async.AsyncM.__dict__,
+                            "AsyncM inherits M.%s unchecked" % name)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        run = loop.run_until_complete
+        m = mwire_async.AsyncM(self.m._pool.host, self.m._pool.port)
+        try:
+            run(m.kill('test1', []))
+            result = run(m.mset('test1', ['a'], [(i, str(i)) for i in range(10)],
+                                chunk_size=3))
+            self.assertEqual((10, 0), (result.count, result.failed))
+            self.assertEqual(True, run(m.setsubtree('test1', ['b'], [[1, 'x']])))
+            self.assertEqual('x', self.m.get('test1', ['b', 1]))
+            values = run(m.get_many('test1', [['a', 2], ['a', 20], ['a', 1]]))
+            self.assertEqual([(('a', 2), '2'), (('a', 20), None), (('a', 1), '1')],
+                             list(values.items()))
+            self.assertEqual([1, 0], list(run(m.exists_many(
+                'test1', [['a', 2], ['a', 20]])).values()))
+            if numpy is not None:
+                keys, values = run(m.getsubtree_array('test1', ['a'], 'int64'))
+                self.assertEqual(list(range(10)), list(keys))
+                self.assertEqual(list(range(10)), list(values))
+            for call in (lambda: m.iter_subtree('test1', []),
+                         lambda: m.iter_allsubs('test1', []),
+                         lambda: m.iter_keys('test1', []),
+                         lambda: m.monitor(),
+                         lambda: m.pipeline(),
+                         lambda: m.transaction(),
+                         lambda: m.transaction_start(),
+                         lambda: m.lock('test1', [])):
+                self.assertRaises(mwire.ToDoError, call)
+        finally:
+            run(m.disconnect())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_connection_01(self):
+        """
+        Socket options are set before connecting, a command goes out in a
+        single send and a large value is handed to sendmsg uncopied
+        """
+
+        class Recording(object):
+            # The socket's sends, recorded before being made
+            def __init__(self, sock):
+                self.sock = sock
+                self.sends = []
+            def sendall(self, data):
+                self.sends.append(('sendall', [data]))
+                return self.sock.sendall(data)
+            def sendmsg(self, buffers):
+                self.sends.append(('sendmsg', list(buffers)))
+                return self.sock.sendmsg(buffers)
+            def __getattr__(self, name):
+                return getattr(self.sock, name)
+
+        c = mwire.Connection(*server_address(), keepalive=30,
+                             send_buffer=65536, receive_buffer=131072)
+        c.connect()
+        try:
+            sock = c._sock
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                self.assertEqual(30, sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE))
+            # Linux doubles the sizes asked for
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 65536)
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 131072)
+
+            c._sock = Recording(sock)
+            c.send_lines(['SET test1["a"] 5', b'hello'])
+            self.assertEqual(True, mwire._read_set(c))
+            self.assertEqual([('sendall', [b'SET test1["a"] 5\r\nhello\r\n'])], c._sock.sends)
+
+            if hasattr(sock, 'sendmsg'):
+                del c._sock.sends[:]
+                value = b'x' * c.SCATTER_SIZE
+                c.send_lines(['SET test1["b"] %d' % len(value), value])
+                self.assertEqual(True, mwire._read_set(c))
+                (send, buffers), = c._sock.sends
+                self.assertEqual('sendmsg', send)
+                self.assertEqual(3, len(buffers))
+                self.assertTrue(buffers[1].obj is value)
+                self.assertEqual(value, mwire.M(*server_address(), binary=True).get('test1', ['b']))
+        finally:
+            c.disconnect()
+
+        self.assertEqual(([b'a\r\nbcd\r\ne\r\n'], 11), mwire._frame(['a', b'bcd', u'e']))
+        self.assertEqual(([b'a\r\n', b'bcd', b'\r\ne\r\n'], 11),
+                         mwire._frame(['a', b'bcd', u'e'], scatter=3))
+
+        class Trickle(object):
+            # Takes a few bytes of each sendmsg
+            received = b''
+            def sendmsg(self, buffers):
+                data = b''.join([buffer.tobytes() for buffer in buffers])[:4]
+                self.received += data
+                return len(data)
+
+        c = mwire.Connection()
+        c._sock = Trickle()
+        c._sendmsg([b'abc', b'defghij', b'k'])
+        self.assertEqual(b'abcdefghijk', c._sock.received)
+        c._sock = None
+
+        c = mwire.Connection(*server_address(), tcp_nodelay=False)
+        c.connect()
+        try:
+            self.assertFalse(c._sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertFalse(c._sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE))
+        finally:
+            c.disconnect()
+
+    def test_connectionpool_01(self):
+        """
+        A single M shared by many threads uses a bounded number of sockets
+        """
+
+        pool = mwire.ConnectionPool(self.m._pool.host, self.m._pool.port,
+                                    max_connections=4)
+        m = mwire.M(connection_pool=pool)
+        m.kill('test1', [])
+
+        def work():
+            for i in range(50):
+                m.increment('test1', ['a'])
+        threads = [threading.Thread(target=work) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual('1000', m.get('test1', ['a']))
+        self.assertTrue(len(pool._available) <= 4)
+
+    def test_connectionpool_02(self):
+        """
+        A non-blocking pool raises ConnectionError once exhausted
+        """
+
+        pool = mwire.ConnectionPool(self.m._pool.host, self.m._pool.port,
+                                    max_connections=1, block=False)
+        connection = pool.get_connection()
+        self.assertRaises(mwire.ConnectionError, pool.get_connection)
+        pool.release(connection)
+        self.assertEqual(connection, pool.get_connection())
+
+        # Bounded by default
+        pool = mwire.ConnectionPool(self.m._pool.host, self.m._pool.port,
+                                    block=False)
+        connections = [pool.get_connection() for i in range(mwire.MAX_CONNECTIONS)]
+        self.assertRaises(mwire.ConnectionError, pool.get_connection)
+        pool.release(connections[0])
+        self.assertEqual(connections[0], pool.get_connection())
+
+    def test_observers_01(self):
+        """
+        Observers see every command with its key length, bytes, duration
+        and outcome; CommandStats totals them per command
+        """
+
+        class Recorder(mwire.CommandObserver):
+            def __init__(self):
+                self.before = []
+                self.after = []
+            def before_command(self, command, key_length):
+                self.before.append((command, key_length))
+            def after_command(self, command, key_length, sent, received,
+                              seconds, error):
+                self.after.append((command, key_length, sent, received, error))
+
+        recorder = Recorder()
+        stats = mwire.CommandStats()
+        m = mwire.M(*server_address(), observers=[recorder, stats])
+        m.set('test1', ['a b'], 'hello')
+        # SET test1["a b"] 5 / hello
+        self.assertEqual([('SET', 12)], recorder.before)
+        self.assertEqual([('SET', 12, 27, 18, None)], recorder.after)
+
+        self.assertRaises(mwire.ResponseError, m._execute, mwire._read_get, 'BOGUS')
+        self.assertTrue(isinstance(recorder.after[-1][-1], mwire.ResponseError))
+
+        m.pipeline().get('test1', ['a b']).ping().execute()
+        self.assertEqual('PIPELINE', recorder.after[-1][0])
+        list(m.iter_subtree('test1', []))
+        self.assertEqual('GETSUBTREE', recorder.after[-1][0])
+
+        summary = stats.summary()
+        self.assertEqual(['BOGUS', 'GETSUBTREE', 'PIPELINE', 'SET'], sorted(summary))
+        self.assertEqual(1, summary['BOGUS']['errors'])
+        self.assertEqual(0, summary['SET']['errors'])
+        self.assertEqual(27, summary['SET']['sent'])
+        self.assertTrue(summary['SET']['seconds'] <= summary['SET']['p999'])
+
+        histogram = mwire.LatencyHistogram()
+        for i in range(1, 1001):
+            histogram.add(i / 1e6)
+        self.assertTrue(500e-6 <= histogram.percentile(50) < 600e-6)
+        self.assertTrue(990e-6 <= histogram.percentile(99) < 1200e-6)
+
     def test_ping_01(self):
         m = self.m
         for i in range(2):
             self.assertEqual(True, m.ping())
-            
+
+    def test_pipeline_01(self):
+        """
+        Client: KILL test1
+        Client: SET test1["a"] 5
+        Client: hello
+        Client: GET test1["a"]
+        Client: INCR test1["b"]
+        Client: EXISTS test1
+        Server: +ok
+        Server: $11
+        Server: {"ok":true}
+        Server: $5
+        Server: hello
+        Server: :1
+        Server: :10
+        """
+
+        for i in range(2):
+            p = self.m.pipeline()
+            p.kill('test1', []).set('test1', ['a'], 'hello').get('test1', ['a'])
+            p.increment('test1', ['b'])
+            p.exists('test1', [])
+            self.assertEqual([True, True, 'hello', 1, 10], p.execute())
+            self.assertEqual([], p.execute())
+
+    def test_pipeline_02(self):
+        """
+        Commands are flushed every flush_size commands but all results
+        are returned by execute()
+        """
+
+        self.m.kill('test1', [])
+        p = self.m.pipeline(flush_size=7)
+        for i in range(100):
+            p.increment('test1', ['a'])
+            self.assertTrue(len(p) < 7)
+        self.assertEqual(list(range(1, 101)), p.execute())
+        self.assertEqual('100', self.m.get('test1', ['a']))
+
+    def test_pipeline_03(self):
+        """
+        mset, setsubtree, get_many and exists_many are queued in order
+        behind the commands before them
+        """
+
+        self.m.kill('test1', [])
+        p = self.m.pipeline()
+        p.set('test1', ['x'], 'first')
+        self.assertTrue(p.mset('test1', [], [(['x'], 'second'), (['y'], None)]) is p)
+        self.assertTrue(p.get_many('test1', [['x'], ['y']]) is p)
+        p.setsubtree('test1', ['z'], [[1, 'a'], [2, 'b']])
+        p.exists_many('test1', [['z'], ['y']])
+        self.assertEqual(None, self.m.get('test1', ['x']))
+        self.assertEqual([True, True, 'second', None, True, True, 10, 0], p.execute())
+        self.assertEqual('second', self.m.get('test1', ['x']))
+        self.assertEqual('b', self.m.get('test1', ['z', 2]))
+        self.assertRaises(mwire.ToDoError, p.iter_keys, 'test1', [])
+
     def test_query_01(self):
         """
         test1="aaa"
@@ -521,11 +1300,472 @@ class MWireFunctions(unittest.TestCase):
             self.assertEqual('test1[1,"x"]', data[0])
             self.assertEqual('hello', data[1])
 
+    def test_server_01(self):
+        """
+        Injected latency delays every reply, but pipelined commands are
+        delayed together
+        """
+
+        with mwire_server.MWireServer(latency=0.05) as slow:
+            m = mwire.M(slow.host, slow.port)
+            started = time.time()
+            for i in range(4):
+                m.ping()
+            self.assertTrue(time.time() - started >= 0.2)
+
+            started = time.time()
+            p = m.pipeline()
+            for i in range(20):
+                p.ping()
+            self.assertEqual([True] * 20, p.execute())
+            self.assertTrue(time.time() - started < 0.5)
+
+    def test_server_02(self):
+        """
+        A client slow to send a value, or to read its monitor, does not
+        hold up other clients
+        """
+
+        queued = mwire_server.MONITOR_QUEUE
+        mwire_server.MONITOR_QUEUE = 10
+        with mwire_server.MWireServer() as local:
+            m = mwire.M(local.host, local.port)
+            slow = socket.create_connection((local.host, local.port))
+            slow.sendall(b'SET test1["a"] 5\r\nhel')
+            time.sleep(0.05)
+            started = time.time()
+            self.assertEqual(None, m.get('test1', ['a']))
+            self.assertTrue(time.time() - started < 1)
+            slow.sendall(b'lo\r\n')
+            self.assertEqual(b'$11\r\n{"ok":true}\r\n', slow.recv(100))
+            slow.close()
+
+            monitor = socket.socket()
+            monitor.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            monitor.connect((local.host, local.port))
+            monitor.sendall(b'MONITOR\r\n')
+            for i in range(50):
+                if local._monitors:
+                    break
+                time.sleep(0.01)
+            started = time.time()
+            name = 'x' * 1000
+            for i in range(5):
+                p = m.pipeline(flush_size=0)
+                for j in range(1000):
+                    p.set('test1', [name, j], '')
+                p.execute()
+            self.assertTrue(time.time() - started < 10)
+            self.assertEqual([], local._monitors)
+            monitor.close()
+        mwire_server.MONITOR_QUEUE = queued
+
+    def test_benchmarks_01(self):
+        """
+        python -m benchmarks runs a command a few times and writes its
+        results as JSON
+        """
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'benchmarks', '--server', '%s:%s' % server_address(),
+                 '--commands', 'get', '--value-size', '16', '--number', '5',
+                 '--output', path],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = process.communicate()
+            self.assertEqual(0, process.returncode, errors)
+            self.assertTrue(b'ops/sec' in output)
+            with open(path) as f:
+                document = json.load(f)
+        finally:
+            os.remove(path)
+        for field in ('created', 'revision', 'python', 'platform', 'server',
+                      'latency', 'results'):
+            self.assertTrue(field in document, field)
+        self.assertEqual('%s:%s' % server_address(), document['server'])
+        result, = document['results']
+        self.assertEqual(('get', 16, None, 5), (result['command'], result['value_size'],
+                                                 result['width'], result['ops']))
+        self.assertTrue(result['ops_per_sec'] > 0)
+        self.assertTrue(0 < result['p50_us'] <= result['p99_us'] <= result['p999_us'])
+        self.assertEqual(None, self.m.get('mwirebench', ['get', 16, 0]))
+
+    def test_hashring_01(self):
+        """
+        Adding a member to the ring only moves keys onto that member
+        """
+
+        ring = mwire.HashRing(['a', 'b', 'c'])
+        keys = ['test%d' % i for i in range(3000)]
+        before = dict([(key, ring.get(key)) for key in keys])
+        self.assertEqual(set(['a', 'b', 'c']), set(before.values()))
+        ring.add('d')
+        moved = [key for key in keys if ring.get(key) != before[key]]
+        self.assertTrue(400 < len(moved) < 1200)
+        for key in moved:
+            self.assertEqual('d', ring.get(key))
+        ring.remove('d')
+        self.assertEqual(before, dict([(key, ring.get(key)) for key in keys]))
+
+    def test_shardedm_01(self):
+        """
+        Globals, or their first level subscripts, are spread over servers
+        """
+
+        servers = [mwire_server.MWireServer().start() for i in range(3)]
+        try:
+            addresses = [(s.host, s.port) for s in servers]
+            m = mwire.ShardedM(addresses)
+            self.assertTrue(m.ping())
+            for i in range(30):
+                m.set('test%d' % i, [1], str(i))
+            self.assertEqual([str(i) for i in range(30)],
+                             [m.get('test%d' % i, [1]) for i in range(30)])
+            counts = [len(s._globals) for s in servers]
+            self.assertEqual(30, sum(counts))
+            self.assertTrue(min(counts) > 0)
+
+            m = mwire.ShardedM(addresses, shard_by_subscript=True)
+            m.kill('test1', [])
+            m.set('test1', [], 'root')
+            result = m.mset('test1', [], [([i, 'x'], str(i)) for i in range(50)])
+            self.assertEqual(50, result.count)
+            self.assertEqual(3, len([s for s in servers if 'test1' in s._globals]))
+            self.assertEqual('7', m.get('test1', ['7', 'x']))
+            self.assertEqual(11, m.exists('test1', []))
+            self.assertEqual(10, m.exists('test1', [7]))
+            self.assertEqual('0', m.next('test1', ['']))
+            self.assertEqual('10', m.next('test1', [9]))
+            self.assertEqual('49', m.previous('test1', ['']))
+            self.assertEqual(None, m.next('test1', []))
+            self.assertEqual(None, m.previous('test1', []))
+            self.assertEqual([str(i) for i in range(50)],
+                             list(m.iter_keys('test1', [])))
+            m.set('test1', ['a'], 'a')
+            m.set('test1', [7], 'seven')
+            rows = [[None, 'root'], ['7', 'seven']]
+            for i in range(50):
+                rows.insert(i + 1 + (i > 6), ['%d,"x"' % i, str(i)])
+            rows.append(['"a"', 'a'])
+            self.assertEqual(rows, m.getsubtree('test1', []))
+            self.assertEqual(rows, list(m.iter_subtree('test1', [])))
+            if numpy is not None:
+                keys, values = m.getsubtree_array('test1', [], 'U5', 'U5')
+                self.assertEqual([row[0][-3:].strip('"') for row in rows[1:]], list(keys))
+                self.assertEqual([row[1] for row in rows[1:]], list(values))
+                keys, values = m.getsubtree_array('test1', [7], 'U1')
+                self.assertEqual((['x'], [7.0]), (list(keys), list(values)))
+            self.assertRaises(mwire.ToDoError, m.monitor)
+            self.assertRaises(mwire.ToDoError, m.transaction)
+            m.kill('test1', [7])
+            m.kill('test1', ['a'])
+            m.set('test1', [7, 'x'], '7')
+            self.assertEqual('test1[0,"x"]', m.query('test1', []))
+            references = [m.query('test1', [i, 'x']) for i in range(49)]
+            self.assertEqual(['test1[%d,"x"]' % i for i in range(1, 50)], references)
+            self.assertEqual(None, m.query('test1', [49, 'x']))
+            self.assertEqual(['test1[10,"x"]', '10'], m.queryget('test1', [9, 'x']))
+            self.assertEqual([None, None], m.queryget('test1', [49, 'x']))
+
+            p = m.pipeline()
+            self.assertRaises(mwire.ToDoError, p.query, 'test1', [1])
+            self.assertRaises(mwire.ToDoError, p.next, 'test1', [1])
+            for i in range(50):
+                p.get('test1', [i, 'x'])
+            p.set('test1', [99], 'y')
+            self.assertEqual([str(i) for i in range(50)] + [True], p.execute())
+            values = m.get_many('test1', [[i, 'x'] for i in range(50)])
+            self.assertEqual([str(i) for i in range(50)], list(values.values()))
+            self.assertEqual([11, 1], list(m.exists_many('test1', [[], [99]]).values()))
+
+            other = mwire.ShardedM(addresses, shard_by_subscript=True)
+            self.assertTrue(m.lock('test1', []))
+            self.assertEqual([False] * 5,
+                             [other.lock('test1', [i], 0) for i in range(5)])
+            self.assertFalse(other.lock('test1', [], 0))
+            self.assertTrue(m.unlock('test1', []))
+            self.assertTrue(other.lock('test1', [4]))
+            self.assertFalse(m.lock('test1', [], 0.1))
+            # Nothing is left held by the failed attempt
+            self.assertTrue(other.lock('test1', [1], 0))
+            self.assertEqual(2, other.unlock_all())
+
+            m.kill('test1', [])
+            self.assertEqual(0, m.exists('test1', []))
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_replicatedm_01(self):
+        """
+        Writes go to the primary, reads to the least busy replica unless
+        the node was written within the read_your_writes window
+        """
+
+        servers = [mwire_server.MWireServer().start() for i in range(3)]
+        try:
+            addresses = [(s.host, s.port) for s in servers]
+            for i, (host, port) in enumerate(addresses):
+                mwire.M(host, port).set('test1', ['a'], str(i))
+                mwire.M(host, port).set('test1', ['b'], str(i))
+
+            m = mwire.ReplicatedM(addresses[0], addresses[1:])
+            self.assertEqual(set(['1', '2']),
+                             set([m.get('test1', ['a']) for i in range(4)]))
+            m.set('test1', ['a'], 'x')
+            self.assertEqual('x', mwire.M(*addresses[0]).get('test1', ['a']))
+            self.assertTrue(m.get('test1', ['a']) in ('1', '2'))
+
+            m = mwire.ReplicatedM(addresses[0], addresses[1:],
+                                  read_your_writes=60)
+            m.set('test1', ['a'], 'y')
+            self.assertEqual('y', m.get('test1', ['a']))
+            self.assertEqual('a', m.next('test1', ['']))
+            self.assertTrue(['"a"', 'y'] in m.getsubtree('test1', []))
+            self.assertTrue(m.get('test1', ['b']) in ('1', '2'))
+            self.assertEqual([0, 0], m._outstanding)
+            # Counted while iterated, and not at all if never started
+            keys = m.iter_keys('test1', ['b'])
+            m.iter_subtree('test1', ['b'])
+            self.assertEqual([0, 0], m._outstanding)
+            self.assertEqual([], list(keys))
+            self.assertEqual([0, 0], m._outstanding)
+            self.assertEqual('y', m.getallsubs('test1', [])[0][1])
+            if numpy is not None:
+                keys, values = m.getsubtree_array('test1', [], 'U1', 'U1')
+                self.assertEqual(['a', 'b'], list(keys))
+                self.assertEqual('y', values[0])
+                self.assertEqual([0, 0], m._outstanding)
+            monitor = m.monitor()
+            try:
+                m.set('test1', ['c'], 'z')
+                self.assertEqual(('test1', ['c'], 'SET'), monitor.get(timeout=5))
+            finally:
+                monitor.close()
+            self.assertEqual('y', m.get_many('test1', [['a']])[('a',)])
+
+            # Writes outside the window are forgotten on the next write
+            m = mwire.ReplicatedM(addresses[0], addresses[1:],
+                                  read_your_writes=0.05)
+            for i in range(20):
+                m.set('test2', [i, 'x'], 'z')
+            self.assertEqual(20, len(m._written))
+            time.sleep(0.1)
+            m.set('test2', ['a'], 'z')
+            self.assertEqual(1, len(m._written))
+            self.assertEqual(2, len(m._expiries))
+            mwire.M(*addresses[0]).kill('test2', [])
+        finally:
+            for server in servers:
+                server.stop()
+
+    def test_counteraggregator_01(self):
+        """
+        Increments are added up locally and written as one INCRBY or
+        DECRBY a counter
+        """
+
+        self.m.kill('test1', [])
+        counters = mwire.CounterAggregator(self.m, interval=60, max_pending=4)
+        for i in range(5):
+            counters.increment('test1', ['a'])
+        counters.decrement_by('test1', ['b'], 3)
+        counters.increment('test1', ['c'])
+        counters.decrement('test1', ['c'])
+        self.assertEqual(5, counters.pending('test1', ['a']))
+        self.assertEqual(0, counters.pending('test1', ['d']))
+        self.assertEqual(None, self.m.get('test1', ['a']))
+        # c's delta came to nothing
+        self.assertEqual(2, counters.flush())
+        self.assertEqual(0, counters.pending('test1', ['a']))
+        self.assertEqual('5', self.m.get('test1', ['a']))
+        self.assertEqual('-3', self.m.get('test1', ['b']))
+        self.assertEqual(None, self.m.get('test1', ['c']))
+
+        # Four counters waiting start a flush straight away
+        for subscript in ('a', 'b', 'c', 'e'):
+            counters.increment_by('test1', [subscript], 2)
+        for i in range(500):
+            if counters.flushes == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual('7', self.m.get('test1', ['a']))
+
+        counters.increment('test1', ['d'])
+        counters.close()
+        self.assertEqual('1', self.m.get('test1', ['d']))
+
+    def test_counteraggregator_02(self):
+        """
+        Deltas that never reached the server are kept for the next flush;
+        those sent before the connection was lost are not sent again
+        """
+
+        self.m.kill('test1', [])
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+        counters = mwire.CounterAggregator(mwire.M('127.0.0.1', port),
+                                           interval=60, flush_at_exit=False)
+        counters.increment('test1', ['a'])
+        self.assertRaises(mwire.ConnectionError, counters.flush)
+        self.assertEqual((1, 0), (counters.pending('test1', ['a']), counters.lost))
+        counters.m = self.m
+        counters.close()
+        self.assertEqual('1', self.m.get('test1', ['a']))
+
+        # Reads the commands, then hangs up without replying
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        def hang_up():
+            connection = listener.accept()[0]
+            connection.recv(1024)
+            connection.close()
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        try:
+            counters = mwire.CounterAggregator(
+                mwire.M(*listener.getsockname()), interval=60, flush_at_exit=False)
+            counters.increment('test1', ['a'])
+            counters.increment('test1', ['b'])
+            self.assertRaises(Exception, counters.flush)
+            self.assertEqual((0, 2), (counters.pending('test1', ['a']), counters.lost))
+        finally:
+            thread.join()
+            listener.close()
+        counters.m = self.m
+        counters.close()
+        self.assertEqual('1', self.m.get('test1', ['a']))
+
+    def test_writebehindqueue_01(self):
+        """
+        Queued writes are coalesced and written in batches in the
+        background, with backpressure once the queue is full
+        """
+
+        self.m.kill('test1', [])
+        writes = mwire.WriteBehindQueue(self.m, batch_size=10)
+        # Holding the queue's lock keeps the writer from taking a batch
+        with writes._condition:
+            for i in range(5):
+                writes.set('test1', ['a', i], str(i))
+            writes.set('test1', ['a', 0], 'again')
+            writes.set('test1', ['b'], 'x')
+            writes.kill('test1', ['a'])
+            writes.set('test1', ['a', 1], 'after')
+            self.assertEqual(3, len(writes))
+            self.assertEqual(6, writes.coalesced)
+        self.assertEqual(True, writes.flush(timeout=5))
+        self.assertEqual('after', self.m.get('test1', ['a', 1]))
+        self.assertEqual(None, self.m.get('test1', ['a', 0]))
+        self.assertEqual('x', self.m.get('test1', ['b']))
+        metrics = writes.metrics()
+        self.assertEqual(0, metrics['depth'])
+        self.assertEqual(3, metrics['written'])
+        self.assertTrue(metrics['p50'] > 0)
+        writes.close()
+        self.assertRaises(mwire.ConnectionError, writes.set, 'test1', ['c'], 'y')
+
+        writes = mwire.WriteBehindQueue(self.m, max_pending=2, full='drop')
+        with writes._condition:
+            self.assertEqual(True, writes.set('test1', ['c'], '1'))
+            self.assertEqual(True, writes.set('test1', ['d'], '2'))
+            self.assertEqual(False, writes.set('test1', ['e'], '3'))
+            self.assertEqual(True, writes.set('test1', ['d'], '4'))
+        writes.close()
+        self.assertEqual(1, writes.dropped)
+        self.assertEqual('4', self.m.get('test1', ['d']))
+        self.assertEqual(None, self.m.get('test1', ['e']))
+
+        writes = mwire.WriteBehindQueue(self.m, max_pending=2, timeout=5)
+        with writes._condition:
+            writes.set('test1', ['c'], '5')
+            writes.set('test1', ['d'], '6')
+            # Waits for the writer to take a batch
+            self.assertEqual(True, writes.set('test1', ['e'], '7'))
+        writes.close()
+        self.assertEqual('7', self.m.get('test1', ['e']))
+
+    def test_writebehindqueue_02(self):
+        """
+        A batch is retried until the server can be reached
+        """
+
+        down = mwire_server.MWireServer().start()
+        writes = mwire.WriteBehindQueue(mwire.M(down.host, down.port))
+        writes.set('test1', [1], 'x')
+        writes.flush(timeout=5)
+        down.stop()
+        writes.set('test1', [2], 'y')
+        time.sleep(0.2)
+        self.assertTrue(writes.errors > 0)
+        up = mwire_server.MWireServer(port=down.port).start()
+        try:
+            self.assertEqual(True, writes.flush(timeout=10))
+            self.assertEqual('y', mwire.M(up.host, up.port).get('test1', [2]))
+            writes.close()
+            self.assertEqual(0, writes.lost)
+        finally:
+            up.stop()
+
     def test_set_01_MORE_TO_BE_DONE(self):
         m = self.m
         for i in range(2):
             self.assertEqual(True, m.set('KLB', ['test_set', i, 'b'], 'Kurt Le Breton'))
     
+    def test_mset_01(self):
+        """
+        Pairs are taken from a generator in chunks, each written with one
+        pipeline of SETs
+        """
+
+        self.m.kill('test1', [])
+        chunks = []
+        result = self.m.mset('test1', ['ts'],
+                             ((i, str(i * 10)) for i in range(2500)),
+                             chunk_size=1000,
+                             progress=lambda result: chunks.append(result.count))
+
+        self.assertEqual([1000, 2000, 2500], chunks)
+        self.assertEqual(2500, result.count)
+        self.assertEqual(0, result.failed)
+        self.assertTrue(result.rate > 0)
+        self.assertEqual('24990', self.m.get('test1', ['ts', 2499]))
+        self.assertEqual(2500, len(self.m.getallsubs('test1', ['ts'])))
+
+        data = [[['a', 1], 'hello'], ['b', 'world']]
+        self.assertEqual(True, self.m.setsubtree('test1', [1], data))
+        self.assertEqual('hello', self.m.get('test1', [1, 'a', 1]))
+        self.assertEqual('world', self.m.get('test1', [1, 'b']))
+
+    @unittest.skipIf('MWIRE_SERVER' in os.environ,
+                     "SETSUBTREE needs to be addressed by mgateway.com")
+    def test_mset_02(self):
+        """
+        Client: SETSUBTREE test1["ts"]
+        Client: *4
+        Client: $1
+        Client: 0
+        Client: $3
+        Client: "0"
+        Client: $1
+        Client: 1
+        Client: $12
+        Client: "a ""b"" c"
+        """
+
+        self.m.kill('test1', [])
+        values = ['0', 'a "b" c', 'x']
+        result = self.m.mset('test1', ['ts'], enumerate(values),
+                             chunk_size=2, setsubtree=True)
+        self.assertEqual((3, 0), (result.count, result.failed))
+        self.assertEqual(values, [self.m.get('test1', ['ts', i]) for i in range(3)])
+
     @unittest.skip("error in protocol needing to be addressed by mgateway.com")
     def test_setsubtree_01(self):
         """
@@ -568,25 +1808,185 @@ class MWireFunctions(unittest.TestCase):
             self.assertEqual(data[0], 'ab')
             self.assertEqual(data[1], '23.45')
 
-    @unittest.skip("todo")
     def test_lock_01(self):
-        pass
+        """
+        Locks exclude other clients and this client's other threads, and
+        are re-entrant without a round trip
+        """
+
+        other = mwire.M(*server_address())
+        self.assertEqual(True, self.m.lock('test1', [1]))
+        sent = self.m._lock_table._connection.bytes_sent
+        self.assertEqual(True, self.m.lock('test1', [1]))
+        self.assertEqual(sent, self.m._lock_table._connection.bytes_sent)
+
+        self.assertEqual(False, other.lock('test1', [1, 'a'], timeout=0.05))
+        self.assertEqual(True, other.lock('test1', [2], timeout=0))
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.m.lock('test1', [], timeout=0.05)))
+        thread.start()
+        thread.join()
+        self.assertEqual([False], results)
+
+        self.assertEqual(True, self.m.unlock('test1', [1]))
+        self.assertEqual(False, other.lock('test1', [1], timeout=0))
+        self.m.unlock('test1', [1])
+        self.assertEqual(True, other.lock('test1', [1, 'a'], timeout=1))
+        other.unlock_all()
 
-    @unittest.skip("todo")
     def test_unlock_01(self):
-        pass
+        """
+        unlock_all releases every lock held in one round trip
+        """
+
+        other = mwire.M(*server_address())
+        self.m.lock('test1', ['a'])
+        self.m.lock('test1', ['b'])
+        self.m.lock('test1', ['a'])
+        self.assertEqual(2, self.m.unlock_all())
+        self.assertEqual(0, self.m.unlock_all())
+        self.assertRaises(mwire.LockError, self.m.unlock, 'test1', ['a'])
+
+        with other.locked('test1', ['a']):
+            self.assertRaises(mwire.LockError, self.m.locked('test1', [], 0.01).__enter__)
+        with self.m.locked('test1', [], 1):
+            self.assertEqual(False, other.lock('test1', ['b'], timeout=0))
+        self.assertEqual(True, other.lock('test1', ['b'], timeout=0))
+        other.unlock_all()
 
-    @unittest.skip("todo")
     def test_transaction_start_01(self):
-        pass
+        """
+        Reads of nodes written in a transaction come from its buffer
+        """
+
+        self.m.kill('test1', [])
+        self.m.set('test1', [1], '10')
+        self.m.set('test1', [2, 'a'], 'x')
+        t = self.m.transaction_start()
+        t.set('test1', ['a'], 'hello')
+        t.increment_by('test1', [1], 5)
+        t.increment('test1', [3])
+        t.kill('test1', [2])
+        self.assertEqual('hello', t.get('test1', ['a']))
+        self.assertEqual('15', t.get('test1', [1]))
+        self.assertEqual('1', t.get('test1', [3]))
+        self.assertEqual(None, t.get('test1', [2, 'a']))
+        t.increment('test1', [2, 'a'])
+        self.assertEqual('1', t.get('test1', [2, 'a']))
+        # Nothing has been sent
+        self.assertEqual(None, self.m.get('test1', ['a']))
+        self.assertEqual('x', self.m.get('test1', [2, 'a']))
+        self.m.transaction_rollback(t)
+
+        # Values come back as a binary M, or its codec, returns them
+        binary = mwire.M(*server_address(), binary=True)
+        t = binary.transaction()
+        t.increment_by('test1', [1], 5)
+        t.increment('test1', [3])
+        self.assertEqual([b'15', b'1'], [t.get('test1', [1]), t.get('test1', [3])])
+        t.set('test1', [4], b'2')
+        t.increment('test1', [4])
+        self.assertEqual(b'3', t.get('test1', [4]))
+        t.rollback()
+        coded = mwire.M(*server_address(), binary=True,
+                        codec=mwire.TextCodec('latin-1'))
+        t = coded.transaction()
+        t.increment('test1', [1])
+        self.assertEqual(u'11', t.get('test1', [1]))
+        t.rollback()
+
+        # Other reads go to the server at once
+        self.m.set('test1', [4, 'b'], 'y')
+        t = self.m.transaction()
+        t.set('test1', ['a'], 'hello')
+        self.assertEqual('1', t.next('test1', ['']))
+        self.assertEqual('test1[1]', t.query('test1', []))
+        self.assertEqual(['test1[1]', '10'], t.queryget('test1', []))
+        self.assertEqual([['"b"', 'y']], t.getsubtree('test1', [4]))
+        self.assertTrue(t.ping())
+        self.assertEqual(1, len(t))
+        # exists() sees the buffered writes
+        self.assertEqual(1, t.exists('test1', ['a']))
+        self.assertEqual(10, t.exists('test1', []))
+        self.assertEqual(10, t.exists('test1', [2]))
+        t.kill('test1', [2, 'a'])
+        self.assertEqual(0, t.exists('test1', [2]))
+        t.kill('test1', [4])
+        t.increment('test1', [4, 'c', 1])
+        self.assertEqual(10, t.exists('test1', [4]))
+        self.assertEqual(0, t.exists('test1', [4, 'b']))
+        t.set('test1', [1, 'z'], 'z')
+        self.assertEqual(11, t.exists('test1', [1]))
+        self.assertEqual([0, 10, 11],
+                         list(t.exists_many('test1', [[2], [4, 'c'], [1]]).values()))
+        self.assertEqual(['hello', None, '10'],
+                         list(t.get_many('test1', [['a'], [2, 'a'], [1]]).values()))
+        t.rollback()
 
-    @unittest.skip("todo")
     def test_transaction_commit_01(self):
-        pass
+        """
+        Every buffered write is sent in one round trip on commit
+        """
+
+        self.m.kill('test1', [])
+        stats = mwire.CommandStats()
+        m = mwire.M(*server_address(), observers=[stats])
+        with m.transaction() as t:
+            for i in range(50):
+                t.set('test1', [i], str(i))
+            t.increment('test1', [0])
+        self.assertEqual(1, stats.summary()['PIPELINE']['count'])
+        self.assertEqual('1', self.m.get('test1', [0]))
+        self.assertEqual('49', self.m.get('test1', [49]))
+        self.assertEqual([], self.m.transaction_commit(t))
+
+        t = self.m.transaction()
+        t.set('test1', ['b'], 'y').kill('test1', [1])
+        self.assertEqual([True, True], self.m.transaction_commit(t))
+        self.assertEqual(10, self.m.exists('test1', []))
+
+        # A rejected write does not stop the others being committed
+        t = self.m.transaction()
+        t.set('test1', ['c'], 'x')
+        t._execute(mwire._read_ok, 'BOGUS')
+        t.set('test1', ['d'], 'y')
+        try:
+            t.commit()
+            self.fail("CommitError not raised")
+        except mwire.CommitError as e:
+            self.assertEqual(3, len(e.results))
+            self.assertEqual(True, e.results[0])
+            self.assertTrue(isinstance(e.results[1], mwire.ResponseError))
+            self.assertTrue('1 of 3' in str(e))
+        self.assertEqual(['x', 'y'], [self.m.get('test1', ['c']),
+                                      self.m.get('test1', ['d'])])
 
-    @unittest.skip("todo")
     def test_transaction_rollback_01(self):
-        pass
+        """
+        Rolling back discards the buffer, and an exception in a with block
+        rolls back
+        """
+
+        self.m.kill('test1', [])
+        try:
+            with self.m.transaction() as t:
+                t.set('test1', ['a'], 'x')
+                raise KeyError()
+        except KeyError:
+            pass
+        self.assertEqual(0, len(t))
+        self.assertEqual(0, self.m.exists('test1', []))
+
+        if server is not None:
+            # Undone by the server
+            c = mwire.Connection(*server_address())
+            c.connect()
+            c.send_lines(['TSTART', 'SET test1["a"] 1', 'x', 'TROLLBACK'])
+            self.assertEqual(['+OK', '$11', '{"ok":true}', '+OK'],
+                             [c.read() for i in range(4)])
+            c.disconnect()
+            self.assertEqual(None, self.m.get('test1', ['a']))
 
     @unittest.skip("todo")
     def test_version_01(self):
@@ -596,9 +1996,78 @@ class MWireFunctions(unittest.TestCase):
     def test_mversion_01(self):
         pass
 
-    @unittest.skip("todo")
+    @unittest.skipIf('MWIRE_SERVER' in os.environ,
+                     "MONITOR's reply format needs to be addressed by mgateway.com")
     def test_monitor_01(self):
-        pass
+        """
+        Changes made by any client are pushed to a monitor, which resumes
+        after losing its connection
+        """
+
+        monitor = self.m.monitor()
+        try:
+            self.m.kill('test1', [])
+            self.m.set('test1', [1, 'a'], 'x')
+            self.m.increment('test1', [2])
+            self.assertEqual([('test1', [], 'KILL'),
+                              ('test1', [1, 'a'], 'SET'),
+                              ('test1', [2], 'INCR')],
+                             [monitor.get(timeout=5) for i in range(3)])
+
+            monitor._connection._sock.shutdown(socket.SHUT_RDWR)
+            self.assertEqual((None, None, 'RESYNC'), monitor.get(timeout=5))
+            self.assertEqual(1, monitor.reconnects)
+            self.m.set('test1', [3], 'y')
+            self.assertEqual(('test1', [3], 'SET'), monitor.get(timeout=5))
+        finally:
+            monitor.close()
+        self.assertEqual(None, monitor.get(timeout=5))
+        self.assertEqual([], list(monitor))
+
+        # A cache invalidated by another client's writes
+        m = mwire.M(*server_address(), cache=mwire.ReadCache())
+        changes = []
+        with m.monitor(changes.append):
+            self.assertEqual('x', m.get('test1', [1, 'a']))
+            self.m.set('test1', [1, 'a'], 'z')
+            for i in range(500):
+                if changes:
+                    break
+                time.sleep(0.01)
+            self.assertEqual('z', m.get('test1', [1, 'a']))
+
+    def test_monitor_02(self):
+        """
+        A monitor nobody reads keeps only the latest max_queued changes,
+        or none at all while it only invalidates a cache
+        """
+
+        monitor = self.m.monitor(max_queued=2)
+        try:
+            for i in range(5):
+                self.m.set('test1', [i], str(i))
+            for i in range(500):
+                if monitor.dropped == 3:
+                    break
+                time.sleep(0.01)
+            self.assertEqual([('test1', [3], 'SET'), ('test1', [4], 'SET')],
+                             [monitor.get(timeout=5) for i in range(2)])
+        finally:
+            monitor.close()
+        self.assertEqual(None, monitor.get(timeout=5))
+
+        m = mwire.M(*server_address(), cache=mwire.ReadCache())
+        with m.monitor(max_queued=0) as monitor:
+            self.assertEqual('1', m.get('test1', [1]))
+            for i in range(5):
+                self.m.set('test1', [1], str(i))
+            for i in range(500):
+                if m.get('test1', [1]) == '4':
+                    break
+                time.sleep(0.01)
+            self.assertEqual('4', m.get('test1', [1]))
+            self.assertEqual((0, 0), (monitor._changes.qsize(), monitor.dropped))
+        self.assertEqual(None, monitor.get(timeout=5))
 
     @unittest.skip("todo")
     def test_mdate_01(self):